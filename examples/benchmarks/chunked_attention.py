@@ -0,0 +1,77 @@
+import time
+import torch
+from x_transformers.attend import Attend
+
+# benchmarks the chunked (online softmax) attention against the regular math attention path
+# on forward and backward, with a causal mask, key padding mask and an additive bias (as from t5 relative positional bias)
+# peak memory is only reported on cuda
+
+# constants
+
+SEQ_LENS = (512, 1024, 2048, 4096)
+BATCH_SIZE = 1
+HEADS = 8
+DIM_HEAD = 64
+Q_BUCKET_SIZE = 512
+K_BUCKET_SIZE = 1024
+WARMUP = 1
+RUNS = 3
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+# helpers
+
+def make_inputs(seq_len):
+    q, k, v = (torch.randn(BATCH_SIZE, HEADS, seq_len, DIM_HEAD, device = device, requires_grad = True) for _ in range(3))
+    attn_bias = torch.randn(HEADS, seq_len, seq_len, device = device, requires_grad = True)
+    mask = torch.ones(BATCH_SIZE, 1, 1, seq_len, device = device, dtype = torch.bool)
+    mask[..., -seq_len // 8:] = False
+    return q, k, v, mask, attn_bias
+
+def step(attend, q, k, v, mask, attn_bias):
+    out, _ = attend(q, k, v, mask = mask, attn_bias = attn_bias, capture = 'none')
+    out.sum().backward()
+    return out
+
+def benchmark(attend, inputs):
+    for _ in range(WARMUP):
+        step(attend, *inputs)
+
+    if device == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        step(attend, *inputs)
+
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+    elapsed = (time.perf_counter() - start) / RUNS
+    peak_memory = torch.cuda.max_memory_allocated() / 2 ** 20 if device == 'cuda' else float('nan')
+    return elapsed, peak_memory
+
+# run
+
+regular = Attend(causal = True)
+chunked = Attend(causal = True, chunked = True, q_bucket_size = Q_BUCKET_SIZE, k_bucket_size = K_BUCKET_SIZE)
+
+for seq_len in SEQ_LENS:
+    inputs = make_inputs(seq_len)
+
+    regular_out = step(regular, *inputs)
+    regular_grads = [t.grad.clone() for t in (inputs[0], inputs[1], inputs[2], inputs[4])]
+
+    for t in (inputs[0], inputs[1], inputs[2], inputs[4]):
+        t.grad = None
+
+    chunked_out = step(chunked, *inputs)
+    chunked_grads = [t.grad.clone() for t in (inputs[0], inputs[1], inputs[2], inputs[4])]
+
+    max_diff = max((regular_out - chunked_out).abs().max().item(), *[(a - b).abs().max().item() for a, b in zip(regular_grads, chunked_grads)])
+
+    regular_time, regular_memory = benchmark(regular, inputs)
+    chunked_time, chunked_memory = benchmark(chunked, inputs)
+
+    print(f'seq len: {seq_len:>5} | regular: {regular_time * 1e3:8.1f}ms {regular_memory:8.1f}MiB | chunked: {chunked_time * 1e3:8.1f}ms {chunked_memory:8.1f}MiB | max abs diff: {max_diff:.2e}')
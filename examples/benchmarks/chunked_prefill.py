@@ -0,0 +1,65 @@
+import time
+import torch
+from x_transformers import TransformerWrapper, Decoder, AutoregressiveWrapper
+
+# measures the prefill of a long prompt through `generate`, in one forward against chunks of increasing size extending the kv cache
+# on the math attention path. peak memory is only reported on cuda, otherwise the size of the largest attention scores is reported
+
+# constants
+
+NUM_TOKENS = 256
+DIM = 512
+DEPTH = 6
+HEADS = 8
+BATCH_SIZE = 2
+PROMPT_LEN = 4096
+CHUNK_SIZES = (None, 2048, 1024, 512, 256)
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+# helpers
+
+def sync():
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+@torch.no_grad()
+def prefill(model, prompts, chunk_size = None):
+    # generates a single token, so that the time is dominated by the prefill
+    # returns the time taken, and the peak memory allocated on cuda
+
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+    sync()
+    start = time.perf_counter()
+
+    out = model.generate(prompts, 1, cache_kv = True, prefill_chunk_size = chunk_size, temperature = 0.)
+
+    sync()
+    elapsed = time.perf_counter() - start
+
+    query_len = min(chunk_size, PROMPT_LEN) if chunk_size is not None else PROMPT_LEN
+    peak_memory = torch.cuda.max_memory_allocated() if device == 'cuda' else BATCH_SIZE * HEADS * query_len * PROMPT_LEN * 4
+    return out, elapsed, peak_memory
+
+# run
+
+torch.manual_seed(0)
+
+model = AutoregressiveWrapper(TransformerWrapper(
+    num_tokens = NUM_TOKENS,
+    max_seq_len = PROMPT_LEN + 1,
+    attn_layers = Decoder(dim = DIM, depth = DEPTH, heads = HEADS, rotary_pos_emb = True)
+)).to(device).eval()
+
+prompts = torch.randint(0, NUM_TOKENS, (BATCH_SIZE, PROMPT_LEN), device = device)
+
+memory_label = 'peak memory' if device == 'cuda' else 'attention scores'
+
+reference, *_ = prefill(model, prompts)
+
+for chunk_size in CHUNK_SIZES:
+    out, elapsed, memory = prefill(model, prompts, chunk_size)
+    name = f'chunks of {chunk_size}' if chunk_size is not None else 'one forward'
+    print(f'{name:>16} | {elapsed * 1e3:.1f}ms | {memory_label}: {memory / 2 ** 20:.1f}MiB | same token: {torch.equal(out, reference)}')
@@ -0,0 +1,72 @@
+import time
+import torch
+from x_transformers import TransformerWrapper, Decoder, AutoregressiveWrapper
+from x_transformers.continuous_batching import ContinuousBatchingEngine
+
+# benchmarks the continuous batching engine against static batches of generate, on requests of mixed prompt and output lengths
+# static batches run until their longest request is done, and the next batch waits for them, while the engine refills freed rows every step
+
+# constants
+
+NUM_REQUESTS = 64
+BATCH_SIZE = 16
+NUM_TOKENS = 256
+PROMPT_LENS = (8, 128)
+OUTPUT_LENS = (4, 128)
+BLOCK_SIZE = 16
+PREFILL_CHUNK_SIZE = 128
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+# helpers
+
+def make_requests():
+    prompt_lens = torch.randint(*PROMPT_LENS, (NUM_REQUESTS,)).tolist()
+    output_lens = torch.randint(*OUTPUT_LENS, (NUM_REQUESTS,)).tolist()
+    return [(torch.randint(0, NUM_TOKENS, (prompt_len,), device = device), output_len) for prompt_len, output_len in zip(prompt_lens, output_lens)]
+
+def run_static(wrapper, requests):
+    start = time.perf_counter()
+    latencies = []
+
+    for i in range(0, len(requests), BATCH_SIZE):
+        batch = requests[i:(i + BATCH_SIZE)]
+        prompt_lens = torch.tensor([len(prompt) for prompt, _ in batch], device = device)
+        prompts = torch.nn.utils.rnn.pad_sequence([prompt for prompt, _ in batch], batch_first = True)
+
+        wrapper.generate(prompts, max(output_len for _, output_len in batch), prompt_lens = prompt_lens, temperature = 0.)
+        latencies.extend([time.perf_counter() - start] * len(batch))
+
+    elapsed = time.perf_counter() - start
+    return sum(output_len for _, output_len in requests) / elapsed, sum(latencies) / len(latencies)
+
+def run_engine(engine, requests):
+    start = time.perf_counter()
+    ids = [engine.submit(prompt, output_len, temperature = 0.) for prompt, output_len in requests]
+    engine.run_until_complete()
+
+    elapsed = time.perf_counter() - start
+    latencies = [engine.poll(i).finished_at - start for i in ids]
+    return engine.stats['num_generated_tokens'] / elapsed, sum(latencies) / len(latencies)
+
+# run
+
+torch.manual_seed(0)
+
+net = TransformerWrapper(
+    num_tokens = NUM_TOKENS,
+    max_seq_len = PROMPT_LENS[1] + OUTPUT_LENS[1],
+    attn_layers = Decoder(dim = 256, depth = 4, heads = 4, rotary_pos_emb = True)
+).to(device)
+
+wrapper = AutoregressiveWrapper(net)
+requests = make_requests()
+
+num_blocks = BATCH_SIZE * (PROMPT_LENS[1] + OUTPUT_LENS[1]) // BLOCK_SIZE
+engine = ContinuousBatchingEngine(wrapper, num_blocks = num_blocks, block_size = BLOCK_SIZE, max_batch_size = BATCH_SIZE, prefill_chunk_size = PREFILL_CHUNK_SIZE)
+
+static_tokens_per_sec, static_latency = run_static(wrapper, requests)
+engine_tokens_per_sec, engine_latency = run_engine(engine, requests)
+
+print(f'static batches | {static_tokens_per_sec:8.1f} tokens/s | mean request latency: {static_latency:.2f}s')
+print(f'engine         | {engine_tokens_per_sec:8.1f} tokens/s | mean request latency: {engine_latency:.2f}s | mean queue latency: {engine.stats["mean_queue_latency"]:.2f}s | mean time to first token: {engine.stats["mean_time_to_first_token"]:.2f}s')
@@ -0,0 +1,62 @@
+import torch
+import torch.nn.functional as F
+from x_transformers import TransformerWrapper, Decoder
+from x_transformers.kv_cache import to_static_kv_cache
+
+# measures the accuracy delta of decoding with an int8 quantized key / value cache against the full precision cache
+# on a reference decoder with grouped query attention, teacher forced over the same tokens, along with the memory held by each cache
+
+# constants
+
+NUM_TOKENS = 256
+DIM = 512
+DEPTH = 6
+HEADS = 8
+KV_HEADS = 2
+BATCH_SIZE = 4
+PROMPT_LEN = 64
+DECODE_LEN = 448
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+# helpers
+
+def cache_bytes(cache):
+    return sum(t.numel() * t.element_size() for inter in cache.attn_intermediates for t in inter.cached_kv.buffers)
+
+@torch.no_grad()
+def decode(net, seq, quantize):
+    # prefill on the prompt, then feed the rest of the sequence one token at a time, returning the logits of every decoded position
+
+    logits, cache = net(seq[:, :PROMPT_LEN], return_intermediates = True, capture = 'kv_only')
+    to_static_kv_cache(cache, max_len = seq.shape[-1], quantize = quantize)
+
+    all_logits = [logits[:, -1]]
+
+    for i in range(PROMPT_LEN + 1, seq.shape[-1]):
+        logits, cache = net(seq[:, :i], cache = cache, return_intermediates = True, capture = 'kv_only')
+        all_logits.append(logits[:, -1])
+
+    return torch.stack(all_logits, dim = 1), cache_bytes(cache)
+
+# run
+
+torch.manual_seed(0)
+
+net = TransformerWrapper(
+    num_tokens = NUM_TOKENS,
+    max_seq_len = PROMPT_LEN + DECODE_LEN,
+    attn_layers = Decoder(dim = DIM, depth = DEPTH, heads = HEADS, attn_kv_heads = KV_HEADS, rotary_pos_emb = True)
+).to(device).eval()
+
+seq = torch.randint(0, NUM_TOKENS, (BATCH_SIZE, PROMPT_LEN + DECODE_LEN), device = device)
+
+full_logits, full_bytes = decode(net, seq, quantize = False)
+int8_logits, int8_bytes = decode(net, seq, quantize = True)
+
+kl_div = F.kl_div(int8_logits.log_softmax(dim = -1), full_logits.log_softmax(dim = -1), log_target = True, reduction = 'none').sum(dim = -1)
+top1_agreement = (int8_logits.argmax(dim = -1) == full_logits.argmax(dim = -1)).float().mean()
+max_abs_diff = (int8_logits - full_logits).abs().max()
+
+print(f'cache memory | full: {full_bytes / 2 ** 20:.1f}MiB | int8: {int8_bytes / 2 ** 20:.1f}MiB | ratio: {full_bytes / int8_bytes:.2f}x')
+print(f'logits | max abs diff: {max_abs_diff:.2e} | mean kl: {kl_div.mean():.2e} | max kl: {kl_div.max():.2e} | top-1 agreement: {top1_agreement * 100:.2f}%')
@@ -0,0 +1,83 @@
+import os
+import time
+import torch
+from torch import nn
+from x_transformers import MultiIOTransformerWrapper
+from x_transformers.x_transformers import AttentionLayers
+
+# benchmarks running the input / output attention layers of each stream concurrently (branch_threads)
+# against running them one after another, for an increasing number of streams, on cpu
+# while concurrent, the intra-op threads are split between the branches - the worker threads get their share through branch_intra_op_threads,
+# and the calling thread is set to its own share around the concurrent runs - so the speedup needs at least as many cores as concurrent branches
+
+# constants
+
+STREAM_COUNTS = (2, 4, 8, 16)
+BRANCH_THREADS = 4
+STREAM_DIM = 64
+BATCH_SIZE = 8
+SEQ_LEN = 256
+NUM_TOKENS = 32
+WARMUP = 2
+RUNS = 5
+
+# helpers
+
+def make_model(num_streams, branch_threads, branch_intra_op_threads = None):
+    return MultiIOTransformerWrapper(
+        num_tokens = [NUM_TOKENS] * num_streams,
+        max_seq_len = SEQ_LEN,
+        autoregressive = True,
+        branch_threads = branch_threads,
+        branch_intra_op_threads = branch_intra_op_threads,
+        input_attn_layers = nn.ModuleList([AttentionLayers(dim = STREAM_DIM, depth = 2, heads = 4, causal = True) for _ in range(num_streams)]),
+        output_attn_layers = nn.ModuleList([AttentionLayers(dim = STREAM_DIM * num_streams, depth = 1, heads = 4, causal = True) for _ in range(num_streams)]),
+        attn_layers = AttentionLayers(dim = STREAM_DIM * num_streams, depth = 2, heads = 8, causal = True)
+    )
+
+def benchmark(model, x, train = False):
+    def step():
+        if not train:
+            with torch.no_grad():
+                return model(x)
+
+        loss = sum(logits.sum() for logits in model(x))
+        loss.backward()
+
+    for _ in range(WARMUP):
+        step()
+
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        step()
+
+    return (time.perf_counter() - start) / RUNS
+
+# run
+
+num_concurrent = BRANCH_THREADS + 1
+intra_op_threads = torch.get_num_threads()
+intra_op_threads_per_branch = max(1, intra_op_threads // num_concurrent)
+
+print(f'cores: {os.cpu_count()}, intra-op threads: {intra_op_threads}, concurrent branches: {num_concurrent}, intra-op threads per branch: {intra_op_threads_per_branch}')
+
+if os.cpu_count() < num_concurrent:
+    print(f'note: fewer cores than concurrent branches, the branches cannot overlap and no speedup is expected')
+
+for train in (False, True):
+    for num_streams in STREAM_COUNTS:
+        torch.manual_seed(0)
+        sequential = make_model(num_streams, branch_threads = 0)
+        concurrent = make_model(num_streams, branch_threads = BRANCH_THREADS, branch_intra_op_threads = intra_op_threads_per_branch)
+        concurrent.load_state_dict(sequential.state_dict())
+
+        x = torch.randint(0, NUM_TOKENS, (BATCH_SIZE, SEQ_LEN, num_streams))
+
+        sequential_time = benchmark(sequential, x, train = train)
+
+        torch.set_num_threads(intra_op_threads_per_branch)
+        concurrent_time = benchmark(concurrent, x, train = train)
+        torch.set_num_threads(intra_op_threads)
+
+        mode = 'train' if train else 'inference'
+        print(f'{mode:>9} | streams: {num_streams:>2} | sequential: {sequential_time * 1e3:8.1f}ms | concurrent: {concurrent_time * 1e3:8.1f}ms | speedup: {sequential_time / concurrent_time:.2f}x')
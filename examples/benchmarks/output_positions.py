@@ -0,0 +1,60 @@
+import time
+import torch
+from x_transformers import TransformerWrapper, Decoder
+
+# measures the prefill of long prompts with a large vocabulary, projecting the logits of every position against only those of the last one,
+# which is all that sampling the next token needs. the last self attention and feedforward layers then also only run for the last position
+
+# constants
+
+NUM_TOKENS = 50257
+DIM = 512
+DEPTH = 6
+HEADS = 8
+BATCH_SIZE = 2
+PROMPT_LENS = (512, 1024, 2048)
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+# helpers
+
+def sync():
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+@torch.no_grad()
+def prefill(net, prompts, output_positions = None):
+    # returns the time taken, and the peak memory allocated on cuda
+
+    if device == 'cuda':
+        torch.cuda.reset_peak_memory_stats()
+
+    net(prompts, output_positions = output_positions)
+    sync()
+
+    start = time.perf_counter()
+    logits = net(prompts, output_positions = output_positions)
+    sync()
+    elapsed = time.perf_counter() - start
+
+    peak_memory = torch.cuda.max_memory_allocated() if device == 'cuda' else logits.numel() * logits.element_size()
+    return elapsed, peak_memory
+
+# run
+
+torch.manual_seed(0)
+
+net = TransformerWrapper(
+    num_tokens = NUM_TOKENS,
+    max_seq_len = max(PROMPT_LENS),
+    attn_layers = Decoder(dim = DIM, depth = DEPTH, heads = HEADS, rotary_pos_emb = True)
+).to(device).eval()
+
+memory_label = 'peak memory' if device == 'cuda' else 'logits'
+
+for prompt_len in PROMPT_LENS:
+    prompts = torch.randint(0, NUM_TOKENS, (BATCH_SIZE, prompt_len), device = device)
+
+    for name, output_positions in (('all positions', None), ('last position', -1)):
+        elapsed, memory = prefill(net, prompts, output_positions)
+        print(f'prompt {prompt_len:>5} | {name:>14} | {elapsed * 1e3:.1f}ms | {memory_label}: {memory / 2 ** 20:.1f}MiB')
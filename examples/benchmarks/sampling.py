@@ -0,0 +1,66 @@
+import time
+import torch
+import torch.nn.functional as F
+from x_transformers.autoregressive_wrapper import top_k, top_p, top_a
+from x_transformers.sampling import Sampler
+
+# measures one sampling step over a large vocabulary, the filter functions of the wrappers (chained where there is more than one) followed by
+# the softmax and multinomial, against the fused sampler, on logits falling off with the rank of the token as those of a language model do
+# the last run gives every row of the batch its own parameters, which the filter functions cannot
+
+# constants
+
+NUM_TOKENS = 50257
+BATCH_SIZE = 32
+RUNS = 20
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+# helpers
+
+def sync():
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+def sample_with_filters(logits, filters, temperature = 1.):
+    for fn, kwargs in filters:
+        logits = fn(logits, **kwargs)
+
+    probs = F.softmax(logits / temperature, dim = -1)
+    return torch.multinomial(probs, 1)
+
+def benchmark(fn, logits):
+    fn(logits)
+    sync()
+
+    start = time.perf_counter()
+    for _ in range(RUNS):
+        fn(logits)
+
+    sync()
+    return (time.perf_counter() - start) / RUNS
+
+# run
+
+torch.manual_seed(0)
+
+ranks = torch.stack([torch.randperm(NUM_TOKENS, device = device) for _ in range(BATCH_SIZE)]) + 1
+logits = -1.2 * ranks.float().log() + torch.randn(BATCH_SIZE, NUM_TOKENS, device = device) * 0.1
+
+runs = (
+    ('top-k', [(top_k, dict(k = 50))], Sampler(top_k = 50)),
+    ('top-p', [(top_p, dict(thres = 0.9))], Sampler(top_p = 0.9)),
+    ('top-k, top-p', [(top_k, dict(k = 50)), (top_p, dict(thres = 0.9))], Sampler(top_k = 50, top_p = 0.9)),
+    ('top-a', [(top_a, dict())], Sampler(top_a = 0.02)),
+    ('per row', None, Sampler(
+        temperature = torch.linspace(0., 1.5, BATCH_SIZE, device = device),
+        top_k = torch.randint(0, 100, (BATCH_SIZE,), device = device),
+        top_p = torch.rand(BATCH_SIZE, device = device),
+        min_p = torch.rand(BATCH_SIZE, device = device) * 0.1
+    ))
+)
+
+for name, filters, sampler in runs:
+    filters_time = benchmark(lambda t: sample_with_filters(t, filters), logits) if filters is not None else float('nan')
+    sampler_time = benchmark(sampler, logits)
+    print(f'{name:>12} | filters: {filters_time * 1e3:7.2f}ms | sampler: {sampler_time * 1e3:7.2f}ms')
@@ -0,0 +1,109 @@
+import time
+import torch
+from x_transformers import TransformerWrapper, Decoder, AutoregressiveWrapper
+
+# benchmarks speculative decoding against regular cached decoding, for a draft that agrees with the network closely and for an unrelated one
+# without trained models at hand, the aligned draft is made by giving the network the draft's layers followed by layers whose outputs
+# are near zero, so the speedup it shows is close to the best possible, and the unrelated draft shows the worst case
+
+# the speedup is bounded by the cost of the forwards - with every draft accepted, a round yields k + 1 tokens for k draft forwards and one
+# network forward over k + 1 tokens, so the bound is (k + 1) / (k * draft cost + scoring cost), both relative to a network forward over one token
+# the 2 - 3x of the paper needs the scoring cost near 1 (memory bound decoding, on GPU) and a draft cost near 0.1. they are printed below,
+# on CPU the scoring cost grows with k and the fixed cost of a forward weighs on the small draft, so the bound and the speedup are lower
+
+# constants
+
+NUM_TOKENS = 256
+DIM = 512
+DEPTH = 12
+DRAFT_DEPTH = 2
+BATCH_SIZE = 1
+PROMPT_LEN = 16
+SEQ_LEN = 128
+NUM_DRAFT_TOKENS = (2, 3, 4, 6)
+TAIL_NOISE = 1e-3
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+# helpers
+
+def make_net(depth):
+    return TransformerWrapper(
+        num_tokens = NUM_TOKENS,
+        max_seq_len = PROMPT_LEN + SEQ_LEN + max(NUM_DRAFT_TOKENS),
+        attn_layers = Decoder(dim = DIM, depth = depth, heads = 8, rotary_pos_emb = True)
+    ).to(device)
+
+def timed(fn):
+    fn()
+    start = time.perf_counter()
+    out = fn()
+    return out, time.perf_counter() - start
+
+@torch.no_grad()
+def forward_time(net, num_tokens, repeats = 10):
+    # time of a forward over num_tokens new tokens, after the prompt is cached
+
+    net.eval()
+    x = torch.randint(0, NUM_TOKENS, (BATCH_SIZE, PROMPT_LEN + num_tokens), device = device)
+    _, cache = net(x[:, :PROMPT_LEN], return_intermediates = True)
+
+    forward = lambda: net(x, cache = cache, cache_age = num_tokens, output_positions = torch.arange(-num_tokens, 0, device = device))
+    _, total_time = timed(lambda: [forward() for _ in range(repeats)])
+    return total_time / repeats
+
+# run
+
+torch.manual_seed(0)
+
+net = make_net(DEPTH)
+aligned_draft = make_net(DRAFT_DEPTH)
+unrelated_draft = make_net(DRAFT_DEPTH)
+
+# aligned draft - the network runs the draft layers first, and its remaining layers barely change the output
+
+with torch.no_grad():
+    for name, param in aligned_draft.state_dict().items():
+        net.state_dict()[name].copy_(param)
+
+    for layer in net.attn_layers.layers[(DRAFT_DEPTH * 2):]:
+        to_out = layer[1].to_out if hasattr(layer[1], 'to_out') else layer[1].ff[-1]
+
+        for param in to_out.parameters():
+            param.mul_(TAIL_NOISE)
+
+wrapper = AutoregressiveWrapper(net)
+prompts = torch.randint(0, NUM_TOKENS, (BATCH_SIZE, PROMPT_LEN), device = device)
+
+# costs of the forwards, relative to a network forward over one token
+
+net_time = forward_time(net, 1)
+draft_cost = forward_time(aligned_draft, 1) / net_time
+
+print(f'draft cost: {draft_cost:.2f}')
+
+for num_draft_tokens in NUM_DRAFT_TOKENS:
+    scoring_cost = forward_time(net, num_draft_tokens + 1) / net_time
+    print(f'{num_draft_tokens} draft tokens - scoring cost: {scoring_cost:.2f} | speedup bound: {(num_draft_tokens + 1) / (num_draft_tokens * draft_cost + scoring_cost):.2f}x')
+
+regular_out, regular_time = timed(lambda: wrapper.generate(prompts, SEQ_LEN, temperature = 0.))
+print(f'regular                      | {SEQ_LEN / regular_time:8.1f} tokens/s')
+
+# the network is called once per round, which yields the accepted drafts and one more token
+
+num_net_calls = 0
+
+def count_net_call(*_):
+    global num_net_calls
+    num_net_calls += 1
+
+net.register_forward_hook(count_net_call)
+
+for draft_name, draft in (('aligned', aligned_draft), ('unrelated', unrelated_draft)):
+    for num_draft_tokens in NUM_DRAFT_TOKENS:
+        out, spec_time = timed(lambda: wrapper.generate(prompts, SEQ_LEN, temperature = 0., draft_model = draft, num_draft_tokens = num_draft_tokens))
+
+        num_net_calls = 0
+        wrapper.generate(prompts, SEQ_LEN, temperature = 0., draft_model = draft, num_draft_tokens = num_draft_tokens)
+
+        print(f'{draft_name:>9} draft, {num_draft_tokens} tokens   | {SEQ_LEN / spec_time:8.1f} tokens/s | speedup: {regular_time / spec_time:.2f}x | tokens per round: {SEQ_LEN / num_net_calls:.2f} | same greedy output: {torch.equal(out, regular_out)}')
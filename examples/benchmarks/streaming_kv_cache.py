@@ -0,0 +1,80 @@
+import time
+import torch
+from x_transformers import TransformerWrapper, Decoder
+from x_transformers.kv_cache import StreamingKVCache, RecentWindow, AttentionSinks, HeavyHitters
+
+# measures the per token latency and cache memory of decoding far past the cache budget, with an unbounded cache against
+# a streaming cache under each eviction policy, on a rotary decoder fed one token at a time
+
+# constants
+
+NUM_TOKENS = 256
+DIM = 512
+DEPTH = 6
+HEADS = 8
+BATCH_SIZE = 4
+PROMPT_LEN = 64
+DECODE_LEN = 2048
+CACHE_LEN = 256
+REPORT_EVERY = 512
+
+device = 'cuda' if torch.cuda.is_available() else 'cpu'
+
+# helpers
+
+def cache_bytes(cache):
+    return sum(t.numel() * t.element_size() for inter in cache.attn_intermediates for t in inter.cached_kv)
+
+def sync():
+    if device == 'cuda':
+        torch.cuda.synchronize()
+
+@torch.no_grad()
+def decode(net, seq, policy = None):
+    # prefill on the prompt, then feed the rest of the sequence one token at a time
+    # returns the mean latency of the decoding steps over each stretch of REPORT_EVERY tokens, and the memory of the cache at the end
+
+    if policy is not None:
+        cache = net.attn_layers.init_cache(lambda: StreamingKVCache(CACHE_LEN, policy = policy))
+        _, cache = net(seq[:, :PROMPT_LEN], cache = cache, cache_age = PROMPT_LEN, return_intermediates = True, capture = 'kv_only')
+    else:
+        _, cache = net(seq[:, :PROMPT_LEN], return_intermediates = True, capture = 'kv_only')
+
+    latencies = []
+
+    for i in range(PROMPT_LEN, seq.shape[-1]):
+        sync()
+        start = time.perf_counter()
+
+        _, cache = net(seq[:, i:(i + 1)], cache = cache, return_intermediates = True, capture = 'kv_only')
+
+        sync()
+        latencies.append(time.perf_counter() - start)
+
+    stretches = [latencies[i:(i + REPORT_EVERY)] for i in range(0, len(latencies), REPORT_EVERY)]
+    return [sum(stretch) / len(stretch) for stretch in stretches], cache_bytes(cache)
+
+# run
+
+torch.manual_seed(0)
+
+net = TransformerWrapper(
+    num_tokens = NUM_TOKENS,
+    max_seq_len = CACHE_LEN,
+    use_abs_pos_emb = False,
+    attn_layers = Decoder(dim = DIM, depth = DEPTH, heads = HEADS, rotary_pos_emb = True)
+).to(device).eval()
+
+seq = torch.randint(0, NUM_TOKENS, (BATCH_SIZE, PROMPT_LEN + DECODE_LEN), device = device)
+
+runs = (
+    ('unbounded', None),
+    ('recent window', RecentWindow()),
+    ('attention sinks', AttentionSinks(num_sinks = 4)),
+    ('heavy hitters', HeavyHitters(num_recent = CACHE_LEN // 2))
+)
+
+for name, policy in runs:
+    latencies, num_bytes = decode(net, seq, policy)
+    latencies = ' | '.join(f'{latency * 1e3:.2f}ms' for latency in latencies)
+    print(f'{name:>16} | ms / token every {REPORT_EVERY} tokens: {latencies} | cache: {num_bytes / 2 ** 20:.1f}MiB')
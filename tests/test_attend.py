@@ -0,0 +1,135 @@
+import pytest
+
+import torch
+
+from x_transformers import TransformerWrapper, Decoder, AutoregressiveWrapper
+from x_transformers.attend import Attend
+
+# chunked (online softmax) attention against the regular math attention it stands in for
+
+@pytest.mark.parametrize('causal', (True, False))
+@pytest.mark.parametrize('use_mask', (True, False))
+@pytest.mark.parametrize('use_bias', (True, False))
+@pytest.mark.parametrize('num_cached', (0, 5))
+@pytest.mark.parametrize('single_kv_head', (True, False))
+def test_chunked_attend_parity(
+    causal,
+    use_mask,
+    use_bias,
+    num_cached,
+    single_kv_head
+):
+    torch.manual_seed(0)
+
+    batch, heads, i, dim_head = 2, 4, 19, 8
+    j = i + num_cached
+
+    q = torch.randn(batch, heads, i, dim_head, requires_grad = True)
+    kv_shape = (batch, j, dim_head) if single_kv_head else (batch, heads, j, dim_head)
+    k = torch.randn(kv_shape, requires_grad = True)
+    v = torch.randn(kv_shape, requires_grad = True)
+
+    mask = torch.rand(batch, 1, 1, j) > 0.3 if use_mask else None
+    attn_bias = torch.randn(heads, i, j, requires_grad = True) if use_bias else None
+
+    regular = Attend(causal = causal)
+    chunked = Attend(causal = causal, chunked = True, q_bucket_size = 4, k_bucket_size = 6)
+
+    inputs = [t for t in (q, k, v, attn_bias) if t is not None]
+
+    def run(attend):
+        out, _ = attend(q, k, v, mask = mask, attn_bias = attn_bias, capture = 'none')
+        grads = torch.autograd.grad(out.pow(2).sum(), inputs)
+        return out, grads
+
+    regular_out, regular_grads = run(regular)
+    chunked_out, chunked_grads = run(chunked)
+
+    assert torch.allclose(regular_out, chunked_out, atol = 1e-5)
+
+    for regular_grad, chunked_grad in zip(regular_grads, chunked_grads):
+        assert torch.allclose(regular_grad, chunked_grad, atol = 1e-5)
+
+@pytest.mark.parametrize('position_kwargs', (
+    dict(rel_pos_bias = True),
+    dict(alibi_pos_bias = True),
+    dict(rotary_pos_emb = True, attn_kv_heads = 2),
+))
+def test_chunked_attention_transformer_parity(position_kwargs):
+    # logits, loss and the gradients of every parameter of a decoder, with and without chunked attention
+
+    torch.manual_seed(0)
+
+    make = lambda chunked: TransformerWrapper(
+        num_tokens = 32,
+        max_seq_len = 64,
+        attn_layers = Decoder(
+            dim = 32,
+            depth = 2,
+            heads = 4,
+            attn_chunked = chunked,
+            attn_q_bucket_size = 8,
+            attn_k_bucket_size = 16,
+            **position_kwargs
+        )
+    )
+
+    regular, chunked = make(False), make(True)
+    chunked.load_state_dict(regular.state_dict())
+
+    x = torch.randint(0, 32, (2, 50))
+    mask = torch.ones(2, 50).bool()
+    mask[1, :7] = False
+
+    assert torch.allclose(regular(x, mask = mask), chunked(x, mask = mask), atol = 1e-5)
+
+    regular_loss = AutoregressiveWrapper(regular)(x)
+    chunked_loss = AutoregressiveWrapper(chunked)(x)
+
+    assert torch.allclose(regular_loss, chunked_loss, atol = 1e-5)
+
+    regular_loss.backward()
+    chunked_loss.backward()
+
+    for (name, regular_param), chunked_param in zip(regular.named_parameters(), chunked.parameters()):
+        assert torch.allclose(regular_param.grad, chunked_param.grad, atol = 1e-5), name
+
+def test_chunked_attention_captured_attention_maps():
+    # the attention maps are never materialized by the chunked attention, so the regular attention steps in whenever they are captured
+
+    torch.manual_seed(0)
+
+    make = lambda chunked: TransformerWrapper(
+        num_tokens = 32,
+        max_seq_len = 64,
+        attn_layers = Decoder(
+            dim = 32,
+            depth = 2,
+            heads = 4,
+            rel_pos_bias = True,
+            attn_chunked = chunked,
+            attn_q_bucket_size = 8,
+            attn_k_bucket_size = 16
+        )
+    )
+
+    regular, chunked = make(False), make(True)
+    chunked.load_state_dict(regular.state_dict())
+
+    x = torch.randint(0, 32, (2, 50))
+
+    regular_logits, regular_attn_maps = regular(x, return_attn = True)
+    chunked_logits, chunked_attn_maps = chunked(x, return_attn = True)
+
+    assert torch.allclose(regular_logits, chunked_logits, atol = 1e-5)
+    assert all(torch.allclose(regular_attn_map, chunked_attn_map) for regular_attn_map, chunked_attn_map in zip(regular_attn_maps, chunked_attn_maps))
+
+    _, regular_intermediates = regular(x, return_attn_z_loss = True)
+    _, chunked_intermediates = chunked(x, return_attn_z_loss = True)
+
+    assert torch.allclose(regular_intermediates.attn_z_loss, chunked_intermediates.attn_z_loss)
+
+    regular_loss = AutoregressiveWrapper(regular, add_attn_z_loss = True)(x)
+    chunked_loss = AutoregressiveWrapper(chunked, add_attn_z_loss = True)(x)
+
+    assert torch.allclose(regular_loss, chunked_loss, atol = 1e-5)
@@ -0,0 +1,228 @@
+import pytest
+
+import torch
+
+from x_transformers import TransformerWrapper, Decoder, AutoregressiveWrapper
+from x_transformers.autoregressive_wrapper import prefill_chunks
+from x_transformers.attend import Attend
+
+def make_net(depth, max_seq_len = 32):
+    return TransformerWrapper(
+        num_tokens = 20,
+        max_seq_len = max_seq_len,
+        attn_layers = Decoder(dim = 16, depth = depth, heads = 2, rotary_pos_emb = True)
+    )
+
+@pytest.mark.parametrize('num_draft_tokens', (1, 3))
+def test_speculative_generate_greedy(num_draft_tokens):
+    torch.manual_seed(0)
+
+    model = AutoregressiveWrapper(make_net(2))
+    draft = make_net(1)
+
+    prompts = torch.randint(0, 20, (2, 4))
+
+    out = model.generate(prompts, 12, temperature = 0.)
+    speculative_out = model.generate(prompts, 12, temperature = 0., draft_model = draft, num_draft_tokens = num_draft_tokens)
+
+    assert torch.equal(out, speculative_out)
+
+@pytest.mark.parametrize('generate_kwargs', (
+    dict(static_kv_cache = True),
+    dict(paged_kv_cache = True),
+    dict(compact_every = 1),
+    dict(seq_len = 30),
+))
+def test_speculative_generate_unsupported(generate_kwargs):
+    # options speculative decoding does not handle are refused rather than ignored - the last decodes past the max sequence length, with restrict_to_max_seq_len left on
+
+    model = AutoregressiveWrapper(make_net(2))
+    draft = make_net(1)
+
+    generate_kwargs = {'seq_len': 8, **generate_kwargs}
+
+    with pytest.raises(AssertionError):
+        model.generate(torch.randint(0, 20, (1, 4)), temperature = 0., draft_model = draft, **generate_kwargs)
+
+@pytest.mark.parametrize('attn_kwargs', (
+    dict(rotary_pos_emb = True),
+    dict(rel_pos_bias = True),
+))
+@pytest.mark.parametrize('num_beams', (1, 2))
+def test_interspersed_memory_tokens_generate_past_max_seq_len(attn_kwargs, num_beams):
+    # interspersed memory tokens are laid out from the start of the window, so the cache is dropped once the window slides, and decoding goes on without it
+
+    torch.manual_seed(0)
+
+    model = AutoregressiveWrapper(TransformerWrapper(
+        num_tokens = 20,
+        max_seq_len = 12,
+        num_memory_tokens = 2,
+        memory_tokens_interspersed_every = 4,
+        attn_layers = Decoder(dim = 16, depth = 2, heads = 2, **attn_kwargs)
+    ))
+
+    prompts = torch.randint(0, 20, (2, 5))
+
+    cached = model.generate(prompts, 16, temperature = 0., num_beams = num_beams)
+    uncached = model.generate(prompts, 16, temperature = 0., num_beams = num_beams, cache_kv = False)
+
+    assert cached.shape == (2, 16)
+    assert torch.equal(cached, uncached)
+
+def test_shift_tokens_generate():
+    # token shifting mixes in the neighbouring positions - output positions are taken after a forward over all positions, and the cache is not used
+
+    torch.manual_seed(0)
+
+    net = TransformerWrapper(
+        num_tokens = 20,
+        max_seq_len = 32,
+        attn_layers = Decoder(dim = 16, depth = 2, heads = 2, shift_tokens = 1, rotary_pos_emb = True)
+    )
+
+    x = torch.randint(0, 20, (2, 9))
+    output_positions = torch.tensor([[2, 5], [3, 8]])
+
+    logits = net(x)
+    assert torch.allclose(net(x, output_positions = -1), logits[:, -1:], atol = 1e-6)
+    assert torch.allclose(net(x, output_positions = output_positions), logits.gather(1, output_positions[..., None].expand(-1, -1, 20)), atol = 1e-6)
+
+    # greedy decoding against greedy decoding from full forwards
+
+    model = AutoregressiveWrapper(net)
+
+    prompts = torch.randint(0, 20, (2, 4))
+    out = model.generate(prompts, 6, temperature = 0.)
+
+    seq = prompts
+
+    for _ in range(6):
+        seq = torch.cat((seq, net(seq)[:, -1:].argmax(dim = -1)), dim = -1)
+
+    assert torch.equal(out, seq[:, 4:])
+    assert model.generate(prompts, 6, num_beams = 2).shape == (2, 6)
+
+def test_beam_search_single_beam_is_greedy():
+    torch.manual_seed(0)
+
+    model = AutoregressiveWrapper(make_net(2))
+    prompts = torch.randint(0, 20, (2, 4))
+
+    greedy = model.generate(prompts, 10, temperature = 0.)
+    single_beam = model.beam_search(prompts, 10, num_beams = 1)
+
+    assert torch.equal(greedy, single_beam)
+
+@pytest.mark.parametrize('eos_token', (None, 3))
+def test_beam_search_cached(eos_token):
+    # the cache reordered to the picked beams after each step holds what recomputing the beams from scratch does
+
+    torch.manual_seed(0)
+
+    model = AutoregressiveWrapper(make_net(2))
+    prompts = torch.randint(0, 20, (2, 4))
+
+    cached, cached_scores = model.beam_search(prompts, 10, num_beams = 3, eos_token = eos_token, return_beams = True)
+    uncached, uncached_scores = model.beam_search(prompts, 10, num_beams = 3, eos_token = eos_token, return_beams = True, cache_kv = False)
+
+    assert cached.shape == (2, 3, 10)
+    assert torch.equal(cached, uncached)
+    assert torch.allclose(cached_scores, uncached_scores, atol = 1e-5)
+
+def test_beam_search_past_max_seq_len(monkeypatch):
+    # past the max sequence length the cache of the beams slides with the window
+    # with a single attention layer, the cached keys / values only depend on their own token, so cached and uncached beams agree past the window
+
+    torch.manual_seed(0)
+
+    model = AutoregressiveWrapper(make_net(1, max_seq_len = 8))
+    prompts = torch.randint(0, 20, (2, 4))
+
+    num_slides = 0
+    slide_cache = model.slide_cache
+
+    def counted_slide_cache(cache):
+        nonlocal num_slides
+        num_slides += 1
+        slide_cache(cache)
+
+    monkeypatch.setattr(model, 'slide_cache', counted_slide_cache)
+
+    cached = model.generate(prompts, 12, num_beams = 2)
+    assert num_slides == 4 + 12 - 1 - 8
+
+    uncached = model.generate(prompts, 12, num_beams = 2, cache_kv = False)
+
+    assert cached.shape == (2, 12)
+    assert torch.equal(cached, uncached)
+
+@pytest.mark.parametrize('add_attn_z_loss', (False, True))
+def test_loss_captures_only_what_it_needs(monkeypatch, add_attn_z_loss):
+    # the training loss does not keep the attention maps of every layer around, only the pre-softmax attention for the z-loss
+
+    captures = []
+    attend_forward = Attend.forward
+
+    def forward(self, *args, capture = 'full', **kwargs):
+        captures.append(capture)
+        return attend_forward(self, *args, capture = capture, **kwargs)
+
+    monkeypatch.setattr(Attend, 'forward', forward)
+
+    model = AutoregressiveWrapper(make_net(2), add_attn_z_loss = add_attn_z_loss)
+
+    loss = model(torch.randint(0, 20, (2, 8)))
+    assert loss.ndim == 0
+
+    assert captures == ['z_loss' if add_attn_z_loss else 'none'] * 2
+
+    captures.clear()
+    model(torch.randint(0, 20, (2, 8)), return_outputs = True)
+
+    assert captures == ['full'] * 2
+
+@pytest.mark.parametrize('attn_kwargs', (
+    dict(rotary_pos_emb = True),
+    dict(rel_pos_bias = True),
+    dict(alibi_pos_bias = True),
+    dict(rotary_pos_emb = True, attn_kv_heads = 1, attn_flash = True),
+))
+@pytest.mark.parametrize('generate_kwargs', (
+    dict(),
+    dict(static_kv_cache = True),
+    dict(paged_kv_cache = True, paged_block_size = 4),
+    dict(num_beams = 3),
+    dict(prompt_lens = torch.tensor([11, 7])),
+))
+@pytest.mark.parametrize('prefill_chunk_size', (1, 4))
+def test_prefill_chunks(monkeypatch, attn_kwargs, generate_kwargs, prefill_chunk_size):
+    # prompts prefilled into the cache by chunks decode the same as prefilled in one forward
+
+    torch.manual_seed(0)
+
+    model = AutoregressiveWrapper(TransformerWrapper(
+        num_tokens = 20,
+        max_seq_len = 32,
+        attn_layers = Decoder(dim = 16, depth = 2, heads = 2, **attn_kwargs)
+    ))
+
+    prompts = torch.randint(1, 20, (2, 11))
+
+    expected = model.generate(prompts, 10, temperature = 0., **generate_kwargs)
+
+    # all chunks but the last are prefilled, the first decoding step feeds in the last
+
+    num_prefilled = []
+
+    def record_prefill_chunks(*args, **kwargs):
+        cache, num_cached = prefill_chunks(*args, **kwargs)
+        num_prefilled.append(num_cached)
+        return cache, num_cached
+
+    monkeypatch.setattr('x_transformers.autoregressive_wrapper.prefill_chunks', record_prefill_chunks)
+
+    prefilled = model.generate(prompts, 10, temperature = 0., prefill_chunk_size = prefill_chunk_size, **generate_kwargs)
+
+    assert torch.equal(prefilled, expected)
+    assert num_prefilled == [(prompts.shape[-1] - 1) // prefill_chunk_size * prefill_chunk_size]
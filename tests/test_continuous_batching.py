@@ -0,0 +1,109 @@
+import pytest
+
+import torch
+
+from x_transformers import TransformerWrapper, Decoder, AutoregressiveWrapper
+from x_transformers.continuous_batching import ContinuousBatchingEngine
+from x_transformers.sampling import Sampler
+
+def make_model():
+    return AutoregressiveWrapper(TransformerWrapper(
+        num_tokens = 20,
+        max_seq_len = 64,
+        attn_layers = Decoder(dim = 16, depth = 2, heads = 2, rotary_pos_emb = True)
+    ))
+
+@pytest.mark.parametrize('max_batch_size', (2, 4))
+def test_continuous_batching_greedy(max_batch_size):
+    # requests of different lengths, prefilled by chunks in the same steps as the others decode, and queued for a free place in the batch, against each decoded alone
+    # the requests are greedy by temperature 0., through a sampler, or by top-k of 1 - the requests of each kind are sampled together
+
+    torch.manual_seed(0)
+
+    model = make_model()
+    engine = ContinuousBatchingEngine(model, num_blocks = 32, block_size = 4, max_batch_size = max_batch_size, prefill_chunk_size = 3)
+
+    prompts = [torch.randint(0, 20, (prompt_len,)) for prompt_len in (7, 2, 5, 9, 4, 6)]
+    seq_lens = (6, 10, 3, 8, 5, 7)
+
+    sampling_kwargs = (
+        dict(temperature = 0.),
+        dict(sampler = Sampler(temperature = 0.)),
+        dict(temperature = 1., filter_kwargs = dict(k = 1))
+    )
+
+    request_ids = [
+        engine.submit(prompt, seq_len, **sampling_kwargs[i % 3])
+        for i, (prompt, seq_len) in enumerate(zip(prompts, seq_lens))
+    ]
+
+    engine.run_until_complete()
+
+    for request_id, prompt, seq_len in zip(request_ids, prompts, seq_lens):
+        request = engine.poll(request_id)
+
+        assert request.done
+        assert torch.equal(request.output, model.generate(prompt[None], seq_len, temperature = 0.)[0])
+
+    assert engine.stats['num_finished'] == len(prompts)
+
+def test_continuous_batching_eos_frees_blocks():
+    torch.manual_seed(0)
+
+    model = make_model()
+    engine = ContinuousBatchingEngine(model, num_blocks = 16, block_size = 4)
+
+    prompt = torch.randint(0, 20, (5,))
+    greedy = model.generate(prompt[None], 10, temperature = 0.)[0]
+
+    # the eos token is the third token decoded, decoding stops at its first occurrence
+
+    eos_token = greedy[2].item()
+    num_tokens = greedy.tolist().index(eos_token) + 1
+
+    request_id = engine.submit(prompt, 10, eos_token = eos_token, temperature = 0.)
+
+    engine.step()
+
+    assert engine.reserved_blocks == 4
+    assert engine.block_table.num_free_blocks < 16
+
+    engine.run_until_complete()
+
+    request = engine.poll(request_id)
+
+    assert request.done
+    assert torch.equal(request.output, greedy[:num_tokens])
+
+    assert len(engine.running) == 0
+    assert engine.reserved_blocks == 0
+    assert engine.block_table.num_free_blocks == 16
+
+def test_continuous_batching_waits_for_blocks():
+    # a request is only admitted once the blocks for all of its tokens are free, however much room there is in the batch
+
+    torch.manual_seed(0)
+
+    model = make_model()
+    engine = ContinuousBatchingEngine(model, num_blocks = 5, block_size = 4, max_batch_size = 4)
+
+    prompts = [torch.randint(0, 20, (6,)) for _ in range(2)]
+    request_ids = [engine.submit(prompt, 10) for prompt in prompts]
+
+    engine.step()
+
+    assert [request.id for request in engine.running] == request_ids[:1]
+    assert engine.stats['num_queued'] == 1
+
+    while not engine.poll(request_ids[0]).done:
+        assert engine.stats['num_queued'] == 1
+        engine.step()
+
+    engine.step()
+
+    assert [request.id for request in engine.running] == request_ids[1:]
+
+    engine.run_until_complete()
+
+    assert engine.poll(request_ids[1]).done
+    assert engine.block_table.num_free_blocks == 5
@@ -0,0 +1,323 @@
+import pytest
+
+import torch
+import torch.nn.functional as F
+
+from x_transformers import TransformerWrapper, Decoder, AutoregressiveWrapper
+from x_transformers.kv_cache import StaticKVCache, PrefixKVCache, StreamingKVCache, AttentionSinks, HeavyHitters, to_static_kv_cache
+
+def make_model(max_seq_len = 64):
+    return AutoregressiveWrapper(TransformerWrapper(
+        num_tokens = 20,
+        max_seq_len = max_seq_len,
+        attn_layers = Decoder(dim = 16, depth = 2, heads = 2, rotary_pos_emb = True)
+    ))
+
+def test_static_cache_window():
+    # a window of the cache is a ring buffer of that many positions, read back in order however many positions were written, and however many at a time
+
+    k = torch.randn(2, 2, 3, 4)
+    cache = StaticKVCache(k, k.clone(), window = 5)
+
+    assert cache.buffers[0].shape[-2] == 5
+
+    written = [k]
+
+    for num_new in (1, 1, 4, 1, 7, 1):
+        new = torch.randn(2, 2, num_new, 4)
+        cache.append(new, new.clone())
+        written.append(new)
+
+        keys = torch.cat(written, dim = -2)
+
+        assert cache.length == keys.shape[-2]
+        assert torch.equal(cache.cached_kv[0], keys[..., -5:, :])
+
+    cache.reorder(torch.tensor([1, 0]))
+    assert torch.equal(cache.cached_kv[1], keys[[1, 0], :, -5:])
+
+@pytest.mark.parametrize('attn_kwargs', (
+    dict(rotary_pos_emb = True),
+    dict(rel_pos_bias = True),
+    dict(rotary_pos_emb = True, attn_kv_heads = 2),
+))
+def test_static_generate_past_max_seq_len(attn_kwargs):
+    # the window of the static cache slides with the max sequence length, as the regular cache does
+
+    torch.manual_seed(0)
+
+    model = AutoregressiveWrapper(TransformerWrapper(
+        num_tokens = 20,
+        max_seq_len = 16,
+        attn_layers = Decoder(dim = 16, depth = 2, heads = 4, **attn_kwargs)
+    ))
+
+    prompts = torch.randint(0, 20, (2, 5))
+
+    regular = model.generate(prompts, 30, temperature = 0.)
+    static = model.generate(prompts, 30, temperature = 0., static_kv_cache = True)
+
+    assert torch.equal(regular, static)
+
+@pytest.mark.parametrize('attn_kwargs', (
+    dict(rotary_pos_emb = True),
+    dict(rel_pos_bias = True),
+    dict(rotary_pos_emb = True, attn_kv_heads = 2),
+))
+@pytest.mark.parametrize('quantize', (True, False))
+def test_paged_generate(attn_kwargs, quantize):
+    # prompts of different lengths decoded together from a paged cache, with blocks smaller than the prompts, against each prompt decoded alone
+
+    torch.manual_seed(0)
+
+    model = AutoregressiveWrapper(TransformerWrapper(
+        num_tokens = 20,
+        max_seq_len = 64,
+        attn_layers = Decoder(dim = 16, depth = 2, heads = 4, **attn_kwargs)
+    ))
+
+    prompts = torch.randint(0, 20, (3, 7))
+    prompt_lens = torch.tensor([7, 3, 5])
+
+    paged = model.generate(prompts, 20, temperature = 0., prompt_lens = prompt_lens, paged_kv_cache = True, paged_block_size = 4, quantize_kv_cache = quantize)
+
+    for prompt, prompt_len, row in zip(prompts, prompt_lens.tolist(), paged):
+        alone = model.generate(prompt[None, :prompt_len], 20, temperature = 0., quantize_kv_cache = quantize)
+        assert torch.equal(row, alone[0])
+
+@pytest.mark.parametrize('prefill_chunk_size', (None, 3))
+def test_streaming_generate_within_budget(prefill_chunk_size):
+    # while nothing is evicted, the streaming cache holds what the regular cache does
+
+    torch.manual_seed(0)
+
+    model = make_model()
+
+    prompts = torch.randint(0, 20, (2, 7))
+
+    out = model.generate(prompts, 12, temperature = 0.)
+    streaming_out = model.generate(prompts, 12, temperature = 0., streaming_kv_cache = True, prefill_chunk_size = prefill_chunk_size)
+
+    assert torch.equal(out, streaming_out)
+
+def streaming_generate_with_cache(model, monkeypatch, prompts, seq_len, **kwargs):
+    # decodes with a streaming cache, returning the cache of the last call along with the output
+
+    caches = []
+    init_cache = model.net.attn_layers.init_cache
+
+    def recorded_init_cache(make_cached_kv):
+        caches.append(init_cache(make_cached_kv))
+        return caches[-1]
+
+    monkeypatch.setattr(model.net.attn_layers, 'init_cache', recorded_init_cache)
+
+    out = model.generate(prompts, seq_len, temperature = 0., streaming_kv_cache = True, **kwargs)
+    return out, caches[-1]
+
+def first_layer_keys(model, seq):
+    # the keys of the first layer before rotary embeddings, as a streaming cache holds them, for every position of the sequence - they only depend on the token
+
+    model.eval()
+
+    cache = model.net.attn_layers.init_cache(lambda: StreamingKVCache(seq.shape[-1] + 1))
+    model.net(seq, cache = cache, cache_age = seq.shape[-1])
+    return cache.attn_intermediates[0].cached_kv.k
+
+def test_streaming_generate_attention_sinks(monkeypatch):
+    # decoding past the budget, the cache keeps the sinks and the most recent positions, dropping the rest
+
+    torch.manual_seed(0)
+
+    model = make_model(max_seq_len = 16)
+    prompts = torch.randint(0, 20, (2, 6))
+
+    out, cache = streaming_generate_with_cache(model, monkeypatch, prompts, 20, streaming_cache_len = 8, eviction_policy = AttentionSinks(num_sinks = 2))
+
+    # the last sampled token is never fed in, so 25 positions went through the cache, which keeps 8 - 1 of them
+
+    seq = torch.cat((prompts, out), dim = -1)[:, :-1]
+    keys = first_layer_keys(model, seq)
+
+    kept = cache.attn_intermediates[0].cached_kv
+    assert kept.num_evicted == 25 - 7
+
+    expected = torch.tensor([0, 1, 20, 21, 22, 23, 24])
+    assert torch.allclose(kept.k, keys[..., expected, :], atol = 1e-5)
+
+    assert all(inter.cached_kv.seq_len == 7 for inter in cache.attn_intermediates)
+
+def test_streaming_generate_heavy_hitters(monkeypatch):
+    # decoding past the budget, the cache keeps the most recent positions, and of the older ones, a pick of its own per head
+
+    torch.manual_seed(0)
+
+    model = make_model(max_seq_len = 16)
+    prompts = torch.randint(0, 20, (2, 6))
+
+    out, cache = streaming_generate_with_cache(model, monkeypatch, prompts, 20, streaming_cache_len = 8, eviction_policy = HeavyHitters(num_recent = 3))
+
+    seq = torch.cat((prompts, out), dim = -1)[:, :-1]
+    keys = first_layer_keys(model, seq)
+
+    kept = cache.attn_intermediates[0].cached_kv
+    assert kept.k.shape[-2] == 7 and kept.scores.shape == kept.k.shape[:-1]
+
+    assert torch.allclose(kept.k[..., -3:, :], keys[..., -3:, :], atol = 1e-5)
+
+    # the others are among the positions before the most recent ones
+
+    heavy, older = kept.k[..., :-3, :], keys[..., :-3, :]
+    distances = (heavy[..., :, None, :] - older[..., None, :, :]).abs().amax(dim = -1)
+
+    assert (distances.amin(dim = -1) < 1e-5).all()
+
+@pytest.mark.parametrize('eviction_policy', (AttentionSinks(num_sinks = 2), HeavyHitters()))
+def test_streaming_generate_compact_past_budget(monkeypatch, eviction_policy):
+    # rows dropped from the batch once finished take their rows of the cache with them, the others decode as they would have
+
+    torch.manual_seed(0)
+
+    model = make_model(max_seq_len = 16)
+    prompts = torch.randint(0, 20, (3, 6))
+
+    generate_kwargs = dict(streaming_cache_len = 8, eviction_policy = eviction_policy)
+
+    out = model.generate(prompts, 20, temperature = 0., streaming_kv_cache = True, **generate_kwargs)
+
+    # the eos token is the token the first row decodes at the 10th step, past the budget
+
+    eos_token = out[0, 9].item()
+
+    expected = model.generate(prompts, 20, temperature = 0., streaming_kv_cache = True, eos_token = eos_token, **generate_kwargs)
+    compacted, cache = streaming_generate_with_cache(model, monkeypatch, prompts, 20, eos_token = eos_token, compact_every = 1, **generate_kwargs)
+
+    assert torch.equal(compacted, expected)
+    assert cache.attn_intermediates[0].cached_kv.k.shape[0] < 3
+
+def test_prefix_cache_hit():
+    # a miss prefills the whole prompt and stores its full blocks, a hit prefills only past them, both decoding as without a cache
+
+    torch.manual_seed(0)
+
+    model = make_model()
+    prefix_cache = PrefixKVCache(block_size = 4)
+
+    prompts = torch.randint(0, 20, (2, 10))
+    uncached = model.generate(prompts, 8, temperature = 0., cache_kv = False)
+
+    miss = model.generate(prompts, 8, temperature = 0., prefix_cache = prefix_cache)
+
+    assert torch.equal(miss, uncached)
+    assert prefix_cache.stats['hits'] == 0 and prefix_cache.stats['misses'] == 2 * 2
+    assert prefix_cache.stats['num_blocks'] == 2 * 2
+
+    hit = model.generate(prompts, 8, temperature = 0., prefix_cache = prefix_cache)
+
+    assert torch.equal(hit, uncached)
+    assert prefix_cache.stats['hits'] == 2 * 2 and prefix_cache.stats['misses'] == 2 * 2
+    assert prefix_cache.stats['num_blocks'] == 2 * 2
+
+def test_prefix_cache_partial_hit():
+    # prompts sharing only their first block with a cached prompt reuse that block, and prefill the rest
+
+    torch.manual_seed(0)
+
+    model = make_model()
+    prefix_cache = PrefixKVCache(block_size = 4)
+
+    prompts = torch.randint(0, 20, (2, 10))
+    model.generate(prompts, 4, temperature = 0., prefix_cache = prefix_cache)
+
+    diverging = prompts.clone()
+    diverging[:, 4:] = (diverging[:, 4:] + 1) % 20
+
+    _, prefix_len = prefix_cache.lookup(diverging)
+    assert prefix_len == 4
+
+    out = model.generate(diverging, 8, temperature = 0., prefix_cache = prefix_cache)
+
+    assert torch.equal(out, model.generate(diverging, 8, temperature = 0., cache_kv = False))
+    assert prefix_cache.stats['num_blocks'] == 2 * 2 + 2
+
+def test_prefix_cache_evicts_least_recently_used():
+    torch.manual_seed(0)
+
+    model = make_model()
+    prompt_a, prompt_b, prompt_c = (torch.randint(0, 20, (1, 9)) for _ in range(3))
+    prompt_b[:, :4] = prompt_a[:, :4]
+
+    # the bytes of a block, from a cache holding one prompt of two blocks
+
+    prefix_cache = PrefixKVCache(block_size = 4)
+    model.generate(prompt_a, 2, prefix_cache = prefix_cache)
+    block_bytes = prefix_cache.num_bytes // 2
+
+    # room for three blocks - the second block of b is the least recently used once a is decoded again, followed by the second block of a
+
+    prefix_cache = PrefixKVCache(block_size = 4, max_bytes = 3 * block_bytes)
+
+    for prompt in (prompt_a, prompt_b, prompt_a, prompt_c):
+        model.generate(prompt, 2, prefix_cache = prefix_cache)
+
+    assert prefix_cache.stats['evictions'] == 2
+    assert prefix_cache.stats['num_blocks'] == 3 and prefix_cache.num_bytes <= prefix_cache.max_bytes
+
+    # the first block of a and b, still more recent than both, and the two blocks of c are kept
+
+    assert prefix_cache.lookup(prompt_a)[1] == 4
+    assert prefix_cache.lookup(prompt_b)[1] == 4
+    assert prefix_cache.lookup(prompt_c)[1] == 8
+
+def test_quantize_int8_round_trip():
+    # the int8 keys / values read back are within half a quantization step of the ones written, at every position and head
+
+    k = torch.randn(2, 4, 10, 8) * torch.rand(2, 4, 10, 1) * 10
+    v = torch.randn(2, 4, 10, 8)
+
+    cache = StaticKVCache(k, v, max_len = 10, quantize = True)
+    assert cache.buffers[0].dtype == torch.int8
+
+    for t, cached in zip((k, v), cache.cached_kv):
+        step = t.abs().amax(dim = -1, keepdim = True) / 127.
+        assert ((cached - t).abs() <= step / 2 + 1e-6).all()
+
+@pytest.mark.parametrize('attn_kwargs', (
+    dict(),
+    dict(attn_kv_heads = 2),
+    dict(rel_pos_bias = True),
+))
+@pytest.mark.parametrize('window', (None, 12))
+def test_quantized_static_cache_within_tolerance(attn_kwargs, window):
+    # teacher forced over the same tokens, the logits decoded with the int8 cache stay close to the ones with the full precision cache
+
+    torch.manual_seed(0)
+
+    net = TransformerWrapper(
+        num_tokens = 20,
+        max_seq_len = 64,
+        attn_layers = Decoder(dim = 32, depth = 2, heads = 4, rotary_pos_emb = True, **attn_kwargs)
+    ).eval()
+
+    seq = torch.randint(0, 20, (2, 40))
+
+    @torch.no_grad()
+    def decode(quantize):
+        logits, cache = net(seq[:, :8], return_intermediates = True, capture = 'kv_only')
+        to_static_kv_cache(cache, max_len = seq.shape[-1], window = window, quantize = quantize)
+
+        all_logits = [logits[:, -1]]
+
+        for i in range(9, seq.shape[-1] + 1):
+            logits, cache = net(seq[:, :i], cache = cache, return_intermediates = True, capture = 'kv_only')
+            all_logits.append(logits[:, -1])
+
+        return torch.stack(all_logits, dim = 1)
+
+    full_logits = decode(quantize = False)
+    int8_logits = decode(quantize = True)
+
+    kl_div = F.kl_div(int8_logits.log_softmax(dim = -1), full_logits.log_softmax(dim = -1), log_target = True, reduction = 'none').sum(dim = -1)
+
+    assert (int8_logits - full_logits).abs().max() < 5e-2
+    assert kl_div.mean() < 1e-4
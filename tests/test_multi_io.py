@@ -0,0 +1,339 @@
+import pytest
+
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+from x_transformers import MultiIOTransformerWrapper, MultiOAutoregressiveWrapper, MultiOXLAutoregressiveWrapper
+from x_transformers.x_transformers import AttentionLayers
+from x_transformers.multi_IO.IO_wrapper import run_branches
+
+NUM_TOKENS = [5, 6, 7]
+
+def make_multi_io(
+    input_layers = True,
+    output_layers = True,
+    rotary = False,
+    max_seq_len = 8,
+    depth = 2,
+    **kwargs
+):
+    layers = lambda dim: nn.ModuleList([AttentionLayers(dim = dim, depth = 1, heads = 2, causal = True, rotary_pos_emb = rotary) for _ in NUM_TOKENS])
+
+    return MultiIOTransformerWrapper(
+        num_tokens = NUM_TOKENS,
+        autoregressive = True,
+        max_seq_len = max_seq_len,
+        use_abs_pos_emb = not rotary,
+        emb_dim = None if input_layers else [4, 4, 4],
+        input_attn_layers = layers(4) if input_layers else None,
+        output_attn_layers = layers(12) if output_layers else None,
+        attn_layers = AttentionLayers(dim = 12, depth = depth, heads = 4, causal = True, rotary_pos_emb = rotary),
+        **kwargs
+    )
+
+def make_prompts(batch, seq_len):
+    return torch.stack([torch.randint(1, num_tokens, (batch, seq_len)) for num_tokens in NUM_TOKENS], dim = -1)
+
+@pytest.mark.parametrize('input_layers', (True, False))
+@pytest.mark.parametrize('output_layers', (True, False))
+@pytest.mark.parametrize('rotary', (True, False))
+def test_multi_output_cached_generate(
+    input_layers,
+    output_layers,
+    rotary
+):
+    torch.manual_seed(0)
+
+    model = make_multi_io(input_layers, output_layers, rotary)
+    wrapper = MultiOAutoregressiveWrapper(model, pad_value = torch.tensor([0, 0, 0]), outputs = len(NUM_TOKENS))
+
+    prompts = make_prompts(2, 3)
+
+    cached = wrapper.generate(prompts, 5, temperature = 0., cache_kv = True)
+    uncached = wrapper.generate(prompts, 5, temperature = 0., cache_kv = False)
+
+    assert cached.shape == (2, 5, len(NUM_TOKENS))
+    assert torch.equal(cached, uncached)
+
+def test_multi_output_cached_generate_past_max_seq_len():
+    # the cache of every stream slides along with the window of the last max_seq_len tokens fed in without a cache
+    # with a single attention layer, the cached keys / values only depend on their own token, so both decode the same past the window
+
+    torch.manual_seed(0)
+
+    model = make_multi_io(input_layers = False, output_layers = False, rotary = True, depth = 1)
+    wrapper = MultiOAutoregressiveWrapper(model, pad_value = torch.tensor([0, 0, 0]), outputs = len(NUM_TOKENS))
+
+    prompts = make_prompts(2, 6)
+
+    cached = wrapper.generate(prompts, 12, temperature = 0., cache_kv = True)
+    uncached = wrapper.generate(prompts, 12, temperature = 0., cache_kv = False)
+
+    assert cached.shape == (2, 12, len(NUM_TOKENS))
+    assert torch.equal(cached, uncached)
+
+@pytest.mark.parametrize('input_layers', (True, False))
+@pytest.mark.parametrize('output_layers', (True, False))
+def test_multi_output_cached_generate_slides_nested_caches(
+    input_layers,
+    output_layers
+):
+    # deeper, the keys / values cached before the window slid have seen the tokens that slid out, so the two only agree up to the window
+
+    torch.manual_seed(0)
+
+    model = make_multi_io(input_layers, output_layers, rotary = True)
+    wrapper = MultiOAutoregressiveWrapper(model, pad_value = torch.tensor([0, 0, 0]), outputs = len(NUM_TOKENS))
+
+    prompts = make_prompts(2, 6)
+    num_within_window = model.max_seq_len - prompts.shape[1] + 1
+
+    cached = wrapper.generate(prompts, 12, temperature = 0., cache_kv = True)
+    uncached = wrapper.generate(prompts, 12, temperature = 0., cache_kv = False)
+
+    assert cached.shape == (2, 12, len(NUM_TOKENS))
+    assert torch.equal(cached[:, :num_within_window], uncached[:, :num_within_window])
+
+def test_fused_input_attn_layers_generate():
+    torch.manual_seed(0)
+
+    make = lambda fuse: MultiIOTransformerWrapper(
+        num_tokens = NUM_TOKENS,
+        autoregressive = True,
+        max_seq_len = 8,
+        use_abs_pos_emb = False,
+        fuse_input_attn_layers = fuse,
+        input_attn_layers = nn.ModuleList([AttentionLayers(dim = 4, depth = 2, heads = 2, causal = True, rotary_pos_emb = True) for _ in NUM_TOKENS]),
+        attn_layers = AttentionLayers(dim = 12, depth = 1, heads = 4, causal = True, rotary_pos_emb = True)
+    )
+
+    fused, unfused = make(True), make(False)
+    unfused.load_state_dict(fused.state_dict())
+
+    assert fused.fuse_pre_attn_layers
+
+    prompts = make_prompts(2, 4)
+
+    generate = lambda model: MultiOAutoregressiveWrapper(model, pad_value = torch.tensor([0, 0, 0]), outputs = len(NUM_TOKENS)).generate(prompts, 4, temperature = 0.)
+
+    assert torch.equal(generate(fused), generate(unfused))
+
+@pytest.mark.parametrize('mode', ('autocast', 'inference_mode'))
+def test_branch_threads_keep_thread_local_state(mode):
+    # autocast and inference mode are thread local, the branches run on the worker threads must see them as the calling thread does
+
+    make = lambda branch_threads: MultiIOTransformerWrapper(
+        num_tokens = NUM_TOKENS,
+        autoregressive = True,
+        max_seq_len = 8,
+        branch_threads = branch_threads,
+        input_attn_layers = nn.ModuleList([AttentionLayers(dim = 4, depth = 1, heads = 2, causal = True) for _ in NUM_TOKENS]),
+        output_attn_layers = nn.ModuleList([AttentionLayers(dim = 12, depth = 1, heads = 2, causal = True) for _ in NUM_TOKENS]),
+        attn_layers = AttentionLayers(dim = 12, depth = 1, heads = 4, causal = True)
+    )
+
+    sequential, concurrent = make(0), make(2)
+    concurrent.load_state_dict(sequential.state_dict())
+
+    x = make_prompts(2, 6)
+
+    context = (lambda: torch.autocast('cpu', dtype = torch.bfloat16)) if mode == 'autocast' else torch.inference_mode
+
+    with context():
+        sequential_logits, sequential_cache = sequential(x, return_intermediates = True)
+        concurrent_logits, concurrent_cache = concurrent(x, return_intermediates = True)
+
+    branch_caches = lambda cache: [inter.attn_intermediates[0].cached_kv[0] for inter in (*cache[0], *cache[2])]
+
+    for sequential_kv, concurrent_kv in zip(branch_caches(sequential_cache), branch_caches(concurrent_cache)):
+        assert concurrent_kv.dtype == sequential_kv.dtype
+        assert concurrent_kv.is_inference() == sequential_kv.is_inference()
+
+    assert all(torch.equal(s, c) for s, c in zip(sequential_logits, concurrent_logits))
+
+def test_branch_threads_leave_calling_thread_intra_op_threads():
+    # the intra-op threads of the workers are set once as they start, those of the calling thread are never touched
+
+    num_threads = torch.get_num_threads()
+
+    thread_counts = run_branches([torch.get_num_threads] * 3, num_threads = 2, intra_op_threads = 1)
+
+    assert thread_counts == [num_threads, 1, 1]
+    assert torch.get_num_threads() == num_threads
+
+@pytest.mark.parametrize('wrapper_klass', (MultiOAutoregressiveWrapper, MultiOXLAutoregressiveWrapper))
+@pytest.mark.parametrize('index_eos', (False, True))
+def test_multi_output_compact_generate(wrapper_klass, index_eos):
+    # rows dropped from the batch once finished are padded after their eos with the pad value, as when all rows decode to the end
+
+    torch.manual_seed(0)
+
+    model = make_multi_io(rotary = True, max_seq_len = 16)
+    pad_value = torch.tensor([4, 5, 6])
+    wrapper = wrapper_klass(model, pad_value = pad_value, outputs = len(NUM_TOKENS))
+
+    prompts = make_prompts(3, 3)
+    out = wrapper.generate(prompts, 8, temperature = 0.)
+
+    # the eos is the earliest decoded by the first row that some other row never decodes, so that the first row is dropped before the end
+
+    tokens = out[..., -1] if index_eos else out
+    is_eos = lambda t, eos: (t == eos) if index_eos else (t == eos).all(dim = -1)
+
+    step = next(step for step in range(out.shape[1]) if not is_eos(tokens[1:], tokens[0, step]).any(dim = -1).all())
+    eos = tokens[0, step]
+
+    eos_kwargs = dict(index_eos_token = {len(NUM_TOKENS) - 1: eos.item()}) if index_eos else dict(eos_token = eos)
+
+    expected = wrapper.generate(prompts, 8, temperature = 0., **eos_kwargs)
+    compacted = wrapper.generate(prompts, 8, temperature = 0., compact_every = 1, **eos_kwargs)
+
+    assert expected.shape[1] > step + 1
+    assert (expected[0, (step + 1):] == pad_value).all()
+    assert torch.equal(compacted, expected)
+
+@pytest.mark.parametrize('output_layers', (True, False))
+def test_fused_to_logits(output_layers):
+    # a checkpoint with the per-head to_logits.{i}.weight is stacked on load, and the fused model gives the same logits and samples
+
+    torch.manual_seed(0)
+
+    model = make_multi_io(output_layers = output_layers)
+    fused = make_multi_io(output_layers = output_layers, fused_logits = True)
+
+    state_dict = model.state_dict()
+    assert 'to_logits.0.weight' in state_dict
+
+    fused.load_state_dict(state_dict)
+
+    prompts = make_prompts(2, 4)
+
+    logits = model(prompts)
+    fused_logits = fused(prompts)
+
+    assert [t.shape for t in fused_logits] == [t.shape for t in logits]
+    assert all(torch.allclose(fused_head_logits, head_logits, atol = 1e-6) for fused_head_logits, head_logits in zip(fused_logits, logits))
+
+    pad_value = torch.tensor([0, 0, 0])
+    wrapper = MultiOAutoregressiveWrapper(model, pad_value = pad_value, outputs = len(NUM_TOKENS))
+    fused_wrapper = MultiOAutoregressiveWrapper(fused, pad_value = pad_value, outputs = len(NUM_TOKENS))
+
+    for temperature in (0., 1.):
+        torch.manual_seed(1)
+        sampled = wrapper.generate(prompts, 4, temperature = temperature)
+
+        torch.manual_seed(1)
+        fused_sampled = fused_wrapper.generate(prompts, 4, temperature = temperature)
+
+        assert torch.equal(fused_sampled, sampled)
+
+@pytest.mark.parametrize('input_layers', (True, False))
+def test_packed_token_emb_loads_per_stream_checkpoint(input_layers):
+    # a checkpoint with the per-stream token_emb.{i}.emb.weight is packed on load into the same embeddings and logits
+
+    torch.manual_seed(0)
+
+    model = make_multi_io(input_layers = input_layers)
+    packed = make_multi_io(input_layers = input_layers, packed_token_emb = True)
+
+    state_dict = model.state_dict()
+    assert 'token_emb.0.emb.weight' in state_dict
+
+    packed.load_state_dict(state_dict)
+
+    prompts = make_prompts(2, 4)
+
+    token_emb = torch.stack([stream_token_emb(prompts[..., i]) for i, stream_token_emb in enumerate(model.token_emb)], dim = -2)
+    packed_token_emb = packed.token_emb(prompts)
+
+    assert torch.equal(packed_token_emb, token_emb)
+
+    logits = model(prompts)
+    packed_logits = packed(prompts)
+
+    assert all(torch.allclose(packed_head_logits, head_logits, atol = 1e-6) for packed_head_logits, head_logits in zip(packed_logits, logits))
+
+def reference_segment_loss(wrapper, x):
+    # the loss of the segments computed one after another, as the wrapper did before streaming them
+
+    x, labels = x[:, :-1], x[:, 1:]
+    seq_len = x.shape[1]
+
+    total_loss, padding_adjustment, mems = 0., 0., None
+
+    for chunk, chunk_labels in zip(x.split(wrapper.max_seq_len, dim = 1), labels.split(wrapper.max_seq_len, dim = 1)):
+        loss_weight = chunk.shape[1] / seq_len
+        mask = (chunk == wrapper.pad_value).all(dim = -1)
+
+        if mask.all():
+            padding_adjustment += loss_weight
+            continue
+
+        logits, mems = wrapper.net(chunk, mems = mems, return_mems = True, mask = mask)
+
+        losses = [F.cross_entropy(logits[i].transpose(1, 2), chunk_labels[..., i], ignore_index = int(wrapper.pad_value[i])) for i in range(wrapper.outputs) if not (chunk_labels[..., i] == wrapper.pad_value[i]).all()]
+
+        if len(losses) == 0:
+            padding_adjustment += loss_weight
+            continue
+
+        total_loss = total_loss + sum(losses) * loss_weight
+
+    return total_loss / (1 - padding_adjustment)
+
+@pytest.mark.parametrize('backward_per_segment', (False, True))
+@pytest.mark.parametrize('padding', ('none', 'last_stream', 'last_segment'))
+def test_multi_output_xl_segment_loss(backward_per_segment, padding):
+    # the loss streamed segment by segment, and its gradients with a backward per segment, equal the loss of all the segments at once
+    # the padding takes the last stream out of the loss of the last segment, or leaves out the last segment entirely
+
+    torch.manual_seed(0)
+
+    model = make_multi_io(max_seq_len = 8, max_mem_len = 8)
+    pad_value = torch.tensor([0, 0, 0])
+    wrapper = MultiOXLAutoregressiveWrapper(model, pad_value = pad_value, outputs = len(NUM_TOKENS))
+
+    x = make_prompts(2, 25)
+
+    if padding == 'last_stream':
+        x[:, 17:, -1] = 0
+    elif padding == 'last_segment':
+        x[:, 16:] = 0
+
+    reference_loss = reference_segment_loss(wrapper, x)
+    reference_loss.backward()
+
+    reference_grads = [param.grad.clone() for param in model.parameters() if param.grad is not None]
+    model.zero_grad()
+
+    loss = wrapper(x, backward_per_segment = backward_per_segment)
+
+    assert torch.allclose(loss, reference_loss, atol = 1e-6)
+    assert loss.requires_grad != backward_per_segment
+
+    if not backward_per_segment:
+        loss.backward()
+
+    grads = [param.grad for param in model.parameters() if param.grad is not None]
+
+    assert len(grads) == len(reference_grads)
+    assert all(torch.allclose(grad, reference_grad, atol = 1e-6) for grad, reference_grad in zip(grads, reference_grads))
+
+@pytest.mark.parametrize('input_layers', (True, False))
+@pytest.mark.parametrize('output_layers', (True, False))
+@pytest.mark.parametrize('prefill_chunk_size', (1, 4))
+def test_multi_output_prefill_chunks(input_layers, output_layers, prefill_chunk_size):
+    # prompts prefilled into the caches of all streams by chunks decode the same as prefilled in one forward
+
+    torch.manual_seed(0)
+
+    model = make_multi_io(input_layers, output_layers, rotary = True, max_seq_len = 32)
+    wrapper = MultiOAutoregressiveWrapper(model, pad_value = torch.tensor([0, 0, 0]), outputs = len(NUM_TOKENS))
+
+    prompts = make_prompts(2, 11)
+
+    expected = wrapper.generate(prompts, 6, temperature = 0.)
+    prefilled = wrapper.generate(prompts, 6, temperature = 0., prefill_chunk_size = prefill_chunk_size)
+
+    assert torch.equal(prefilled, expected)
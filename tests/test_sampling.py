@@ -0,0 +1,84 @@
+import pytest
+
+import torch
+
+from x_transformers.sampling import Sampler
+from x_transformers.autoregressive_wrapper import top_k, top_p, top_a
+
+def assert_same_filter(filtered, expected):
+    kept = filtered > -float('inf')
+
+    assert torch.equal(kept, expected > -float('inf'))
+    assert torch.allclose(filtered[kept], expected[kept], atol = 1e-5)
+
+def test_sampler_per_row_params():
+    # each row of the batch filtered by its own parameters, against the filters of the wrapper applied to that row alone
+
+    torch.manual_seed(0)
+
+    logits = torch.randn(5, 100) * 3
+
+    sampler = Sampler(
+        temperature = torch.tensor([1., 0.5, 2., 1., 0.7]),
+        top_k = torch.tensor([5, 0, 0, 20, 0]),
+        top_p = torch.tensor([1., 0.9, 1., 0.8, 1.]),
+        top_a = torch.tensor([0., 0., 0., 0., 0.05])
+    )
+
+    expected = [
+        top_k(logits[0:1], k = 5),
+        top_p(logits[1:2] / 0.5, thres = 0.9),
+        logits[2:3] / 2.,
+        top_p(top_k(logits[3:4], k = 20), thres = 0.8),
+        top_a(logits[4:5] / 0.7, min_p_ratio = 0.05)
+    ]
+
+    assert_same_filter(sampler.filter(logits), torch.cat(expected))
+
+    # sampled tokens are among those the filter kept
+
+    filtered = sampler.filter(logits)
+
+    for _ in range(10):
+        sampled = sampler(logits)
+        assert (filtered.gather(-1, sampled[:, None]) > -float('inf')).all()
+
+def test_sampler_greedy_rows():
+    # rows at temperature 0. always take the argmax, whatever the other rows and filters
+
+    torch.manual_seed(0)
+
+    logits = torch.randn(4, 50)
+    sampler = Sampler(temperature = torch.tensor([0., 1., 0., 1.5]), top_p = torch.tensor([0.5, 0.9, 1., 1.]), min_p = 0.01)
+
+    for _ in range(10):
+        sampled = sampler(logits)
+        assert torch.equal(sampled[[0, 2]], logits[[0, 2]].argmax(dim = -1))
+
+    assert torch.equal(Sampler(temperature = 0.)(logits), logits.argmax(dim = -1))
+
+@pytest.mark.parametrize('nucleus_past_candidates', (True, False))
+def test_sampler_top_p_widening(monkeypatch, nucleus_past_candidates):
+    # the candidates only widen when the nucleus of a row with top-p on reaches past them, never for the rows with top-p off
+
+    torch.manual_seed(0)
+
+    logits = torch.randn(2, 1000) * 2.
+
+    if not nucleus_past_candidates:
+        logits[:, :4] += 15.
+
+    num_candidates = []
+    top_k_top_p = Sampler.top_k_top_p
+
+    def counted_top_k_top_p(self, logits, candidates):
+        num_candidates.append(candidates)
+        return top_k_top_p(self, logits, candidates)
+
+    monkeypatch.setattr(Sampler, 'top_k_top_p', counted_top_k_top_p)
+
+    sampler = Sampler(top_p = torch.tensor([0.9, 1.]), num_candidates = 8)
+    filtered = sampler.filter(logits)
+
+    assert num_candidates == ([8, 64, 512] if nucleus_past_candidates else [8])
+    assert_same_filter(filtered[:1], top_p(logits[:1], thres = 0.9))
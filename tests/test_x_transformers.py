@@ -0,0 +1,281 @@
+import pytest
+
+import torch
+
+from x_transformers import TransformerWrapper, Encoder, Decoder, XTransformer
+from x_transformers.x_transformers import RelativePositionBias, RotaryEmbedding, apply_rotary_pos_emb, apply_rotary_cos_sin, rotary_freqs_to_cos_sin
+from x_transformers.attend import capture_at_least
+
+@pytest.mark.parametrize('position_kwargs', (
+    dict(rel_pos_bias = True),
+    dict(alibi_pos_bias = True),
+    dict(dynamic_pos_bias = True),
+))
+def test_position_bias_output_positions(position_kwargs):
+    # with output_positions, the position bias is only computed for the rows of the queries kept, not over all the keys
+
+    torch.manual_seed(0)
+
+    net = TransformerWrapper(
+        num_tokens = 20,
+        max_seq_len = 64,
+        attn_layers = Decoder(dim = 16, depth = 2, heads = 4, **position_kwargs)
+    ).eval()
+
+    rel_pos = net.attn_layers.rel_pos
+
+    x = torch.randint(0, 20, (2, 40))
+    output_positions = torch.tensor([[3, 17], [25, 39]])
+
+    full_bias = rel_pos(40, 40)
+    query_bias = rel_pos(2, 40, query_positions = output_positions)
+
+    assert query_bias.shape == (4, 2, 2, 40)
+    assert torch.allclose(query_bias, full_bias[:, output_positions], atol = 1e-6)
+
+    bias_shapes = []
+    rel_pos.register_forward_hook(lambda module, inputs, output: bias_shapes.append(output.shape))
+
+    logits = net(x)
+    _, cache = net(x[:, :-1], return_intermediates = True)
+
+    bias_shapes.clear()
+    last_logits = net(x, cache = cache, output_positions = -1)
+
+    assert len(bias_shapes) > 0 and all(shape[-2:] == (1, 40) for shape in bias_shapes)
+    assert torch.allclose(last_logits, logits[:, -1:], atol = 1e-5)
+    assert torch.allclose(net(x, output_positions = output_positions), logits.gather(1, output_positions[..., None].expand(-1, -1, 20)), atol = 1e-5)
+
+def make_encoder_decoder():
+    return XTransformer(
+        dim = 16,
+        enc_num_tokens = 20,
+        enc_depth = 1,
+        enc_heads = 2,
+        enc_max_seq_len = 16,
+        dec_num_tokens = 20,
+        dec_depth = 2,
+        dec_heads = 2,
+        dec_max_seq_len = 16
+    )
+
+def make_padded_source(batch = 2):
+    src = torch.randint(1, 20, (batch, 10))
+    mask = torch.ones(batch, 10).bool()
+    mask[1:, 6:] = False
+    return src.masked_fill(~mask, 0), mask
+
+def test_encoder_decoder_cached_cross_attention():
+    # the keys / values of the context are projected once, at the first step, and read back from the cache after
+
+    torch.manual_seed(0)
+
+    model = make_encoder_decoder()
+    src, mask = make_padded_source()
+    start = torch.ones(2, 1).long()
+
+    cross_attn = next(block for layer_type, block in zip(model.decoder.net.attn_layers.layer_types, model.decoder.net.attn_layers.layers) if layer_type == 'c')[1]
+
+    num_projections = 0
+
+    def count_projections(*_):
+        nonlocal num_projections
+        num_projections += 1
+
+    cross_attn.to_k.register_forward_hook(count_projections)
+
+    cached = model.generate(src, start, 8, mask = mask, temperature = 0.)
+    assert num_projections == 1
+
+    uncached = model.generate(src, start, 8, mask = mask, temperature = 0., cache_kv = False)
+    assert num_projections == 1 + 8
+
+    assert cached.shape == (2, 8)
+    assert torch.equal(cached, uncached)
+
+def test_encoder_decoder_beam_search():
+    # the cached keys / values of the context are reordered along with the beams, and stay those of the prompt of each beam
+
+    torch.manual_seed(0)
+
+    model = make_encoder_decoder()
+    src, mask = make_padded_source()
+    start = torch.ones(2, 1).long()
+
+    cached, cached_scores = model.generate(src, start, 8, mask = mask, num_beams = 3, return_beams = True)
+    uncached, uncached_scores = model.generate(src, start, 8, mask = mask, num_beams = 3, return_beams = True, cache_kv = False)
+
+    assert cached.shape == (2, 3, 8)
+    assert torch.equal(cached, uncached)
+    assert torch.allclose(cached_scores, uncached_scores, atol = 1e-5)
+
+    # the padded source decodes the same beams as the source without its padding, alone
+
+    alone = model.generate(src[1:, :6], start[1:], 8, num_beams = 3, return_beams = True)[0]
+    assert torch.equal(cached[1:], alone)
+
+@pytest.mark.parametrize('capture', ('none', 'kv_only', 'mems', 'z_loss', 'full'))
+def test_capture_policy_fields(capture):
+    # each capture policy keeps exactly the intermediates documented for it, and everything the policies before it keep
+
+    torch.manual_seed(0)
+
+    net = TransformerWrapper(
+        num_tokens = 20,
+        max_seq_len = 16,
+        attn_layers = Decoder(dim = 16, depth = 2, heads = 2)
+    )
+
+    x = torch.randint(0, 20, (2, 6))
+
+    logits, intermediates = net(x, return_intermediates = True, capture = capture)
+
+    assert torch.allclose(logits, net(x), atol = 1e-6)
+
+    assert len(intermediates.attn_intermediates) == (2 if capture_at_least(capture, 'kv_only') else 0)
+    assert len(intermediates.hiddens) == (2 if capture_at_least(capture, 'mems') else 0)
+    assert len(intermediates.layer_hiddens) == (5 if capture_at_least(capture, 'full') else 0)
+
+    for inter in intermediates.attn_intermediates:
+        assert inter.cached_kv is not None
+        assert (inter.pre_softmax_attn is not None) == capture_at_least(capture, 'z_loss')
+        assert (inter.qk_similarities is not None) == capture_at_least(capture, 'full')
+        assert (inter.post_softmax_attn is not None) == capture_at_least(capture, 'full')
+
+@pytest.mark.parametrize('attn_kwargs', (
+    dict(),
+    dict(attn_flash = True),
+    dict(attn_max_attend_past = 3),
+    dict(attn_num_mem_kv = 2),
+    dict(attn_add_zero_kv = True),
+    dict(rel_pos_bias = True),
+))
+@pytest.mark.parametrize('with_mems', (False, True))
+def test_shared_masks(monkeypatch, attn_kwargs, with_mems):
+    # the masks built once per forward and shared by all layers give the same output as building them in every layer
+
+    torch.manual_seed(0)
+
+    depth = 4
+    decoder = Decoder(dim = 16, depth = depth, heads = 2, **attn_kwargs).eval()
+
+    x = torch.randn(2, 10, 16)
+    mask = torch.ones(2, 10).bool()
+    mask[1, :3] = False
+
+    mems = [torch.randn(2, 5, 16) for _ in range(depth)] if with_mems else None
+
+    num_causal_masks = 0
+    create_causal_mask = decoder.layers[0][1].attend.create_causal_mask
+
+    def count_causal_mask(*args, **kwargs):
+        nonlocal num_causal_masks
+        num_causal_masks += 1
+        return create_causal_mask(*args, **kwargs)
+
+    for layer in decoder.layers:
+        if hasattr(layer[1], 'attend'):
+            layer[1].attend.create_causal_mask = count_causal_mask
+
+    shared = decoder(x, mask = mask, mems = mems)
+    num_shared_causal_masks, num_causal_masks = num_causal_masks, 0
+
+    # without a cache, every layer builds its own masks
+
+    no_cache = lambda mask_cache, key, fn, anchor = None: fn()
+    monkeypatch.setattr('x_transformers.attend.cache_mask', no_cache)
+    monkeypatch.setattr('x_transformers.x_transformers.cache_mask', no_cache)
+
+    per_layer = decoder(x, mask = mask, mems = mems)
+
+    assert torch.equal(shared, per_layer)
+    assert (num_shared_causal_masks, num_causal_masks) == (1, depth)
+
+@pytest.mark.parametrize('position_kwargs', (
+    dict(rel_pos_bias = True),
+    dict(rel_pos_bias = True, attn_add_zero_kv = True),
+    dict(alibi_pos_bias = True),
+    dict(dynamic_pos_bias = True),
+))
+@pytest.mark.parametrize('causal', (False, True))
+def test_shared_rel_pos(monkeypatch, position_kwargs, causal):
+    # the position bias computed once per forward and shared by all layers gives the same output and gradients as computing it in every layer
+
+    torch.manual_seed(0)
+
+    depth = 4
+    klass = Decoder if causal else Encoder
+    attn_layers = klass(dim = 16, depth = depth, heads = 2, **position_kwargs)
+
+    x = torch.randn(2, 12, 16)
+
+    num_rel_pos = 0
+    rel_pos_forward = attn_layers.rel_pos.forward
+
+    def count_rel_pos(*args, **kwargs):
+        nonlocal num_rel_pos
+        num_rel_pos += 1
+        return rel_pos_forward(*args, **kwargs)
+
+    monkeypatch.setattr(attn_layers.rel_pos, 'forward', count_rel_pos)
+
+    def run():
+        attn_layers.zero_grad()
+        out = attn_layers(x)
+        out.sum().backward()
+        return out, [param.grad.clone() for param in attn_layers.rel_pos.parameters()]
+
+    shared, shared_grads = run()
+    num_shared_rel_pos, num_rel_pos = num_rel_pos, 0
+
+    no_cache = lambda mask_cache, key, fn, anchor = None: fn()
+    monkeypatch.setattr('x_transformers.attend.cache_mask', no_cache)
+    monkeypatch.setattr('x_transformers.x_transformers.cache_mask', no_cache)
+
+    per_layer, per_layer_grads = run()
+
+    assert (num_shared_rel_pos, num_rel_pos) == (1, depth)
+    assert torch.allclose(shared, per_layer, atol = 1e-6)
+    assert all(torch.allclose(shared_grad, per_layer_grad, atol = 1e-6) for shared_grad, per_layer_grad in zip(shared_grads, per_layer_grads))
+
+@pytest.mark.parametrize('causal', (False, True))
+def test_rel_pos_bucket_table(causal):
+    # the buckets looked up from the table, clamped to the max distance, are the ones of the log bucketing at every distance
+
+    rel_pos = RelativePositionBias(scale = 1., causal = causal, num_buckets = 16, max_distance = 32)
+
+    relative_position = torch.arange(-100, 101)
+    expected = RelativePositionBias._relative_position_bucket(relative_position, causal = causal, num_buckets = 16, max_distance = 32)
+
+    assert torch.equal(rel_pos.rp_bucket_table[relative_position.clamp(-32, 32) + 32], expected)
+
+@pytest.mark.parametrize('use_xpos', (False, True))
+@pytest.mark.parametrize('rotary_dim', (8, 16))
+@pytest.mark.parametrize('positions', ((0, 12), (-5, 7), (30, 31)))
+def test_apply_rotary_cos_sin(use_xpos, rotary_dim, positions):
+    # the rotation with the cos / sin tables equals the one of the frequencies, for xpos, partial rotary and positions offset by memories or a cache
+
+    torch.manual_seed(0)
+
+    start, end = positions
+
+    rotary = RotaryEmbedding(rotary_dim, use_xpos = use_xpos, scale_base = 8, interpolation_factor = 2.)
+
+    # grow the table from a smaller range first, it is then sliced rather than recomputed
+
+    rotary.forward_cos_sin(2, 4)
+
+    q, k = torch.randn(2, 2, 4, end - start, 16)
+
+    freqs, scale = rotary(torch.arange(start, end))
+    q_cos, q_sin, k_cos, k_sin = rotary.forward_cos_sin(start, end)
+
+    assert torch.allclose(apply_rotary_cos_sin(q, q_cos, q_sin), apply_rotary_pos_emb(q, freqs, scale), atol = 1e-6)
+    assert torch.allclose(apply_rotary_cos_sin(k, k_cos, k_sin), apply_rotary_pos_emb(k, freqs, scale ** -1), atol = 1e-6)
+
+    assert all(torch.allclose(t, table_t, atol = 1e-6) for t, table_t in zip(rotary_freqs_to_cos_sin(freqs, scale), (q_cos, q_sin, k_cos, k_sin)))
+
+    # only the last queries, as when decoding with a cache - apply_rotary_pos_emb leaves the slicing of the xpos scale to the caller
+
+    last_scale = scale[-1:] if use_xpos else scale
+    assert torch.allclose(apply_rotary_cos_sin(q[..., -1:, :], q_cos, q_sin), apply_rotary_pos_emb(q[..., -1:, :], freqs, last_scale), atol = 1e-6)
@@ -24,6 +24,8 @@ from x_transformers.xval import (
 
 from x_transformers.xl_autoregressive_wrapper import XLAutoregressiveWrapper
 
+from x_transformers.continuous_batching import ContinuousBatchingEngine
+
 
 from x_transformers.multi_IO.IO_wrapper import MultiIOTransformerWrapper
 from x_transformers.multi_IO.autoregressive_multiO import MultiOAutoregressiveWrapper
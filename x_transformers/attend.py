@@ -24,6 +24,20 @@ class Intermediates:
     def to_tuple(self):
         return (self.qk_similarities, self.pre_softmax_attn, self.post_softmax_attn)
 
+# what intermediates to capture during the forward, from nothing to everything
+# each policy captures everything the policies before it do
+
+CAPTURE_POLICIES = (
+    'none',     # only the output
+    'kv_only',  # cached key / values, for kv cached decoding
+    'mems',     # + hiddens going into each self attention layer, for transformer-xl memories
+    'z_loss',   # + pre-softmax attention, for the attention z-loss (and residual attention)
+    'full'      # + qk similarities, post-softmax attention and the hiddens of every layer
+)
+
+def capture_at_least(capture, policy):
+    return CAPTURE_POLICIES.index(capture) >= CAPTURE_POLICIES.index(policy)
+
 # helpers
 
 def exists(val):
@@ -48,6 +62,22 @@ def once(fn):
 
 print_once = once(print)
 
+def cache_mask(mask_cache, key, fn, anchor = None):
+    # build a mask once per forward and share it across layers
+    # masks derived from another mask are keyed on its identity, which is kept alive in the cache so it cannot be reused
+
+    if not exists(mask_cache):
+        return fn()
+
+    key = (*key, id(anchor))
+
+    if key in mask_cache and mask_cache[key][0] is anchor:
+        return mask_cache[key][1]
+
+    out = fn()
+    mask_cache[key] = (anchor, out)
+    return out
+
 # functions for creating causal mask
 # need a special one for onnx cpu (no support for .triu)
 
@@ -60,6 +90,167 @@ def onnx_create_causal_mask(i, j, device):
     causal_mask = F.pad(causal_mask, (j - i, 0), value = False)
     return causal_mask
 
+# chunked attention - online softmax over blocks of keys, never materializing the full attention matrix
+# the backward recomputes the attention of each block from the saved softmax statistics, so memory is O(n * bucket size)
+
+def slice_block(t, i_slice, j_slice):
+    # masks and biases may be broadcast along the query dimension (b 1 1 j)
+    i_slice = i_slice if t.shape[-2] != 1 else slice(None)
+    return t[..., i_slice, j_slice]
+
+def block_keep_mask(mask, causal, i_slice, j_slice, offset, device):
+    keep = slice_block(mask, i_slice, j_slice) if exists(mask) else None
+
+    if causal:
+        r = torch.arange(i_slice.start, i_slice.stop, device = device)
+        c = torch.arange(j_slice.start, j_slice.stop, device = device)
+        causal_keep = rearrange(c, 'j -> 1 j') <= (rearrange(r, 'i -> i 1') + offset)
+        keep = causal_keep if not exists(keep) else (keep & causal_keep)
+
+    return keep
+
+class ChunkedAttentionFunction(torch.autograd.Function):
+    @staticmethod
+    @torch.no_grad()
+    def forward(ctx, q, k, v, mask, attn_bias, causal, scale, q_bucket_size, k_bucket_size):
+        i, j, device = q.shape[-2], k.shape[-2], q.device
+        offset = j - i
+
+        # only skip causally masked out blocks when there is no other mask
+        # so that rows entirely masked out still attend uniformly to all keys, same as the regular math path
+
+        skip_causal_blocks = causal and not exists(mask)
+
+        # softmax is always carried out in at least float32
+
+        dtype = torch.promote_types(q.dtype, torch.float32)
+        mask_value = -torch.finfo(dtype).max
+
+        out = torch.empty((*q.shape[:-1], v.shape[-1]), device = device, dtype = q.dtype)
+        # keep the row max and sum apart rather than the logsumexp, as the sum is lost to precision next to the mask value for rows entirely masked out
+
+        stats_max = torch.empty(out.shape[:-1], device = device, dtype = dtype)
+        stats_sum = torch.empty(out.shape[:-1], device = device, dtype = dtype)
+
+        for i_start in range(0, i, q_bucket_size):
+            i_slice = slice(i_start, min(i_start + q_bucket_size, i))
+            qc = q[..., i_slice, :].type(dtype)
+
+            row_max = row_sum = acc = None
+
+            for j_start in range(0, j, k_bucket_size):
+                if skip_causal_blocks and j_start > (i_slice.stop - 1 + offset):
+                    break
+
+                j_slice = slice(j_start, min(j_start + k_bucket_size, j))
+                kc, vc = k[..., j_slice, :].type(dtype), v[..., j_slice, :].type(dtype)
+
+                sim = (qc @ kc.transpose(-1, -2)) * scale
+
+                if exists(attn_bias):
+                    sim = sim + slice_block(attn_bias, i_slice, j_slice)
+
+                keep = block_keep_mask(mask, causal, i_slice, j_slice, offset, device)
+
+                if exists(keep):
+                    sim = sim.masked_fill(~keep, mask_value)
+
+                block_max = sim.amax(dim = -1)
+                new_row_max = block_max if not exists(row_max) else torch.maximum(row_max, block_max)
+
+                exp_sim = torch.exp(sim - new_row_max[..., None])
+                block_sum = exp_sim.sum(dim = -1)
+                block_out = exp_sim @ vc
+
+                if not exists(row_max):
+                    row_sum, acc = block_sum, block_out
+                else:
+                    correction = torch.exp(row_max - new_row_max)
+                    row_sum = row_sum * correction + block_sum
+                    acc = acc * correction[..., None] + block_out
+
+                row_max = new_row_max
+
+            out[..., i_slice, :] = (acc / row_sum[..., None]).type(out.dtype)
+            stats_max[..., i_slice] = row_max
+            stats_sum[..., i_slice] = row_sum
+
+        ctx.save_for_backward(q, k, v, mask, attn_bias, out, stats_max, stats_sum)
+        ctx.args = (causal, scale, q_bucket_size, k_bucket_size, skip_causal_blocks)
+
+        return out
+
+    @staticmethod
+    @torch.no_grad()
+    def backward(ctx, do):
+        q, k, v, mask, attn_bias, out, stats_max, stats_sum = ctx.saved_tensors
+        causal, scale, q_bucket_size, k_bucket_size, skip_causal_blocks = ctx.args
+
+        i, j, device = q.shape[-2], k.shape[-2], q.device
+        offset = j - i
+
+        dtype = stats_max.dtype
+        mask_value = -torch.finfo(dtype).max
+        bias_needs_grad = exists(attn_bias) and ctx.needs_input_grad[4]
+
+        dq = torch.zeros(q.shape, device = device, dtype = dtype)
+        dk = torch.zeros(k.shape, device = device, dtype = dtype)
+        dv = torch.zeros(v.shape, device = device, dtype = dtype)
+        dbias = torch.zeros(attn_bias.shape, device = device, dtype = dtype) if bias_needs_grad else None
+
+        do = do.type(dtype)
+        delta = (do * out.type(dtype)).sum(dim = -1)
+
+        for i_start in range(0, i, q_bucket_size):
+            i_slice = slice(i_start, min(i_start + q_bucket_size, i))
+            qc, doc = q[..., i_slice, :].type(dtype), do[..., i_slice, :]
+            maxc, sumc, deltac = stats_max[..., i_slice, None], stats_sum[..., i_slice, None], delta[..., i_slice, None]
+
+            for j_start in range(0, j, k_bucket_size):
+                if skip_causal_blocks and j_start > (i_slice.stop - 1 + offset):
+                    break
+
+                j_slice = slice(j_start, min(j_start + k_bucket_size, j))
+                kc, vc = k[..., j_slice, :].type(dtype), v[..., j_slice, :].type(dtype)
+
+                sim = (qc @ kc.transpose(-1, -2)) * scale
+
+                if exists(attn_bias):
+                    sim = sim + slice_block(attn_bias, i_slice, j_slice)
+
+                keep = block_keep_mask(mask, causal, i_slice, j_slice, offset, device)
+
+                if exists(keep):
+                    sim = sim.masked_fill(~keep, mask_value)
+
+                attn = torch.exp(sim - maxc) / sumc
+
+                dv[..., j_slice, :] += (attn.transpose(-1, -2) @ doc).sum_to_size(dv[..., j_slice, :].shape)
+
+                dattn = doc @ vc.transpose(-1, -2)
+                dsim = attn * (dattn - deltac)
+
+                # masked out similarities are filled with a constant, and receive no gradient
+
+                if exists(keep):
+                    dsim = dsim.masked_fill(~keep, 0.)
+
+                if bias_needs_grad:
+                    bias_block = slice_block(dbias, i_slice, j_slice)
+                    bias_block += dsim.sum_to_size(bias_block.shape)
+
+                dsim = dsim * scale
+
+                dq[..., i_slice, :] += (dsim @ kc).sum_to_size(dq[..., i_slice, :].shape)
+                dk[..., j_slice, :] += (dsim.transpose(-1, -2) @ qc).sum_to_size(dk[..., j_slice, :].shape)
+
+        dq, dk, dv = dq.type(q.dtype), dk.type(k.dtype), dv.type(v.dtype)
+        dbias = dbias.type(attn_bias.dtype) if exists(dbias) else None
+
+        return dq, dk, dv, None, dbias, None, None, None, None
+
+chunked_attention = ChunkedAttentionFunction.apply
+
 # main class
 
 class Attend(nn.Module):
@@ -76,6 +267,9 @@ class Attend(nn.Module):
         flash = False,
         add_zero_kv = False,
         onnxable = False,
+        chunked = False,
+        q_bucket_size = 512,
+        k_bucket_size = 1024,
         sdp_kwargs: dict = dict(
             enable_flash = True,
             enable_math = True,
@@ -120,40 +314,45 @@ class Attend(nn.Module):
 
         self.sdp_kwargs = sdp_kwargs
 
-    def flash_attn(
+        # chunked attention - memory efficient math path, for when flash attention cannot be used
+
+        assert not (chunked and flash), 'chunked attention is an alternative to flash attention, only one can be turned on'
+        assert not (chunked and talking_heads), 'talking heads not compatible with chunked attention'
+        assert not (chunked and sparse_topk), 'sparse topk not compatible with chunked attention'
+
+        if chunked and dropout > 0.:
+            print_once('chunked attention does not support attention dropout, the regular attention will be used while training')
+
+        self.chunked = chunked
+        self.q_bucket_size = q_bucket_size
+        self.k_bucket_size = k_bucket_size
+
+    def chunked_attn(
         self,
         q, k, v,
         mask = None,
         attn_bias = None
     ):
-        batch, heads, q_len, _, k_len, is_cuda, device = *q.shape, k.shape[-2], q.is_cuda, q.device
-
-        # Recommended for multi-query single-key-value attention by Tri Dao
-        # kv shape torch.Size([1, 512, 64]) -> torch.Size([1, 8, 512, 64])
-
-        if k.ndim == 3:
-            k = rearrange(k, 'b ... -> b 1 ...').expand_as(q)
+        n, causal = q.shape[-2], self.causal
 
-        if v.ndim == 3:
-            v = rearrange(v, 'b ... -> b 1 ...').expand_as(q)
+        if n == 1 and causal:
+            causal = False
 
-        # handle scale - by default they scale by dim_head ** -0.5, but need to take care if using cosine sim attention
+        # single key / value head
 
-        if self.qk_norm:
-            default_scale = q.shape[-1] ** -0.5
-            q = q * (self.scale / default_scale)
+        if k.ndim == 3:
+            k, v = map(lambda t: rearrange(t, 'b n d -> b 1 n d'), (k, v))
 
-        # Check if mask exists and expand to compatible shape
-        # The mask is B L, so it would have to be expanded to B H N L
+        scale = default(self.scale, q.shape[-1] ** -0.5)
 
-        causal = self.causal
+        out = chunked_attention(q, k, v, mask, attn_bias, causal, scale, self.q_bucket_size, self.k_bucket_size)
 
-        # in the case of kv caching with one token (q_len == 1), just turn off causal masking
-        # in speculative decoding, this may go up to 5-6, so right aligned causal mask will be needed there
+        return out, Intermediates()
 
-        if q_len == 1 and causal:
-            causal = False
+    def get_causal_mask(self, i, j, device, mask_cache = None):
+        return cache_mask(mask_cache, ('causal', i, j, device), lambda: self.create_causal_mask(i, j, device = device))
 
+    def combine_flash_masks(self, mask, causal, batch, heads, q_len, k_len, device):
         # expand key padding mask
 
         if exists(mask):
@@ -185,11 +384,69 @@ class Attend(nn.Module):
 
             causal = False
 
+        return mask, causal, row_is_entirely_masked
+
+    def combine_math_masks(self, mask, causal, i, j, device):
+        masked_out = ~mask if exists(mask) else None
+
+        if causal:
+            causal_mask = self.create_causal_mask(i, j, device = device)
+            masked_out = (masked_out | causal_mask) if exists(masked_out) else causal_mask
+
+        return masked_out
+
+    def flash_attn(
+        self,
+        q, k, v,
+        mask = None,
+        attn_bias = None,
+        mask_cache = None
+    ):
+        batch, heads, q_len, _, k_len, is_cuda, device = *q.shape, k.shape[-2], q.is_cuda, q.device
+
+        # Recommended for multi-query single-key-value attention by Tri Dao
+        # kv shape torch.Size([1, 512, 64]) -> torch.Size([1, 8, 512, 64])
+
+        if k.ndim == 3:
+            k = repeat(k, 'b j d -> b h j d', h = heads)
+
+        if v.ndim == 3:
+            v = repeat(v, 'b j d -> b h j d', h = heads)
+
+        # handle scale - by default they scale by dim_head ** -0.5, but need to take care if using cosine sim attention
+
+        if self.qk_norm:
+            default_scale = q.shape[-1] ** -0.5
+            q = q * (self.scale / default_scale)
+
+        # Check if mask exists and expand to compatible shape
+        # The mask is B L, so it would have to be expanded to B H N L
+
+        causal = self.causal
+
+        # in the case of kv caching with one token (q_len == 1), just turn off causal masking
+        # in speculative decoding, this may go up to 5-6, so right aligned causal mask will be needed there
+
+        if q_len == 1 and causal:
+            causal = False
+
+        # combining the mask with the causal mask is the same for every layer, so is done once per forward when a mask cache is given
+
+        mask, causal, row_is_entirely_masked = cache_mask(
+            mask_cache,
+            ('flash', batch, heads, q_len, k_len, causal, device),
+            partial(self.combine_flash_masks, mask, causal, batch, heads, q_len, k_len, device),
+            anchor = mask
+        )
+
         # handle alibi positional bias
         # convert from bool to float
 
         if exists(attn_bias):
-            attn_bias = rearrange(attn_bias, 'h i j -> 1 h i j').expand(batch, heads, -1, -1)
+            if attn_bias.ndim == 3:
+                attn_bias = rearrange(attn_bias, 'h i j -> 1 h i j')
+
+            attn_bias = attn_bias.expand(batch, heads, -1, -1)
 
             # if mask given, the mask would already contain the causal mask from above logic
             # otherwise, if no mask given but still causal, mask out alibi positional bias to a large negative number
@@ -199,7 +456,7 @@ class Attend(nn.Module):
             if exists(mask):
                 attn_bias = attn_bias.masked_fill(~mask, mask_value // 2)
             elif causal:
-                causal_mask = self.create_causal_mask(q_len, k_len, device = device)
+                causal_mask = self.get_causal_mask(q_len, k_len, device, mask_cache)
                 attn_bias = attn_bias.masked_fill(causal_mask, mask_value // 2)
                 causal = False
 
@@ -230,7 +487,9 @@ class Attend(nn.Module):
         q, k, v,
         mask = None,
         attn_bias = None,
-        prev_attn = None
+        prev_attn = None,
+        capture = 'full',
+        mask_cache = None
     ):
         """
         einstein notation
@@ -264,14 +523,23 @@ class Attend(nn.Module):
             k, v = map(lambda t: F.pad(t, (0, 0, 1, 0), value = 0.), (k, v))
 
             if exists(mask):
-                mask = F.pad(mask, (1, 0), value = True)
+                mask = cache_mask(mask_cache, ('zero_kv',), partial(F.pad, mask, (1, 0), value = True), anchor = mask)
 
             if exists(attn_bias):
-                attn_bias = F.pad(attn_bias, (1, 0), value = 0.)
+                attn_bias = cache_mask(mask_cache, ('zero_kv_bias',), partial(F.pad, attn_bias, (1, 0), value = 0.), anchor = attn_bias)
 
         if self.flash:
             assert not exists(prev_attn), 'residual attention not compatible with flash attention'
-            return self.flash_attn(q, k, v, mask = mask, attn_bias = attn_bias)
+            return self.flash_attn(q, k, v, mask = mask, attn_bias = attn_bias, mask_cache = mask_cache)
+
+        # chunked attention never materializes the attention matrix, so the regular attention is used whenever it is captured
+
+        if self.chunked and not (self.training and self.dropout > 0.):
+            if not capture_at_least(capture, 'z_loss'):
+                assert not exists(prev_attn), 'residual attention not compatible with chunked attention'
+                return self.chunked_attn(q, k, v, mask = mask, attn_bias = attn_bias)
+
+            print_once('chunked attention does not produce the attention maps, the regular attention will be used while they are captured (z_loss or full capture policy)')
 
         kv_einsum_eq = 'b j d' if k.ndim == 3 else 'b h j d'
 
@@ -280,7 +548,7 @@ class Attend(nn.Module):
         if exists(prev_attn):
             dots = dots + prev_attn
 
-        qk_similarities = dots.clone()
+        qk_similarities = dots.clone() if capture_at_least(capture, 'full') else None
 
         if self.talking_heads:
             dots = self.pre_softmax_talking_heads(dots)
@@ -297,19 +565,27 @@ class Attend(nn.Module):
             sparse_topk_mask = dots < top_values[..., -1:]
             mask = (mask & sparse_topk_mask) if exists(mask) else sparse_topk_mask
 
-        if exists(mask):
-            dots = dots.masked_fill(~mask, mask_value)
+            # the mask now depends on the attention scores of this layer, and cannot be shared
+            mask_cache = None
 
-        if causal:
-            causal_mask = self.create_causal_mask(i, j, device = device)
-            dots = dots.masked_fill(causal_mask, mask_value)
+        # mask out in one go, with the causal mask folded into the given mask
+
+        masked_out = cache_mask(
+            mask_cache,
+            ('math', i, j, causal, device),
+            partial(self.combine_math_masks, mask, causal, i, j, device),
+            anchor = mask
+        )
+
+        if exists(masked_out):
+            dots = dots.masked_fill(masked_out, mask_value)
 
-        pre_softmax_attn = dots.clone()
+        pre_softmax_attn = dots.clone() if capture_at_least(capture, 'z_loss') else None
 
         attn = self.attn_fn(dots, dim = -1)
         attn = attn.type(dtype)
 
-        post_softmax_attn = attn.clone()
+        post_softmax_attn = attn.clone() if capture_at_least(capture, 'full') else None
 
         attn = self.attn_dropout(attn)
 
@@ -8,6 +8,9 @@ import torch.nn.functional as F
 
 from einops import rearrange, pack, unpack
 
+from x_transformers.kv_cache import StaticKVCache, PrefixKVCache, StreamingKVCache, EvictionPolicy, to_static_kv_cache, to_paged_kv_cache, reorder_cached_kv
+from x_transformers.sampling import Sampler
+
 def exists(val):
     return val is not None
 
@@ -56,6 +59,72 @@ def align_right(t, lens, pad_id=0):
     return aligned
 
 
+# for selecting or repeating rows of the batch while decoding
+
+def select_rows(t, indices):
+    # the given rows of a tensor, or of every tensor nested in tuples / lists, such as the memories of the xl wrappers, or of the parameters of a sampler
+
+    if not exists(t):
+        return None
+
+    if isinstance(t, Sampler):
+        return t.select_rows(indices)
+
+    if isinstance(t, (tuple, list)):
+        return type(t)(select_rows(el, indices) for el in t)
+
+    return t.index_select(0, indices)
+
+
+def map_batch_kwargs(kwargs, batch, fn):
+    # applies fn to the tensors in kwargs with a leading batch dimension, such as the context and its mask
+
+    return {key: (fn(value) if torch.is_tensor(value) and value.ndim > 0 and value.shape[0] == batch else value) for key, value in kwargs.items()}
+
+
+def prefill_chunks(net, x, chunk_size, cache=None, num_cached=0, **kwargs):
+    # feeds x into the cache chunk_size tokens at a time, past the num_cached tokens already in it, so the activations and attention scores
+    # are only ever held for one chunk against the cache, rather than for the whole of x. the causal mask is right aligned to the cached keys
+    # the last chunk is left out, for the first decoding step to feed in and sample from. returns the cache and the number of tokens in it
+
+    for end in range(num_cached + chunk_size, x.shape[-1], chunk_size):
+        _, cache = net(
+            x[:, :end],
+            return_intermediates=True,
+            capture='kv_only',
+            cache=cache,
+            cache_age=end - num_cached,
+            output_positions=-1,
+            **kwargs
+        )
+
+        num_cached = end
+
+    return cache, num_cached
+
+
+def slide_cached_kv(t, max_len, num_fixed=0):
+    # the last max_len cached positions, after the first num_fixed, the leading memory tokens, which stay as they do when decoding without a cache
+
+    if t.shape[-2] <= (num_fixed + max_len):
+        return t
+
+    if num_fixed == 0:
+        return t[..., -max_len:, :]
+
+    return torch.cat((t[..., :num_fixed, :], t[..., -max_len:, :]), dim=-2)
+
+
+def compact_finished_rows(out, is_done, batch_indices, results):
+    # moves the finished rows of out into results, at their index in the original batch
+    # returns the indices of the unfinished rows within out, which all other per row state is selected with, and their index in the original batch
+
+    results[batch_indices[is_done], :out.shape[1]] = out[is_done]
+
+    keep = (~is_done).nonzero(as_tuple=True)[0]
+    return keep, batch_indices[keep]
+
+
 # nucleus
 
 def top_p(logits, thres=0.9):
@@ -111,6 +180,29 @@ def contrastive_decode_fn(
     return contrastive_decode_logits
 
 
+# sampling a token per row from the logits of the last position, with the sampler, greedily at temperature 0., or from the filtered logits
+
+def sample_logits(logits, temperature=1., filter_logits_fn: Callable = top_k, filter_kwargs: dict = dict(), sampler: Optional[Sampler] = None):
+    if exists(sampler):
+        return rearrange(sampler(logits), 'b -> b 1')
+
+    if temperature == 0.:
+        return logits.argmax(dim=-1, keepdim=True)
+
+    filtered_logits = filter_logits_fn(logits, **filter_kwargs)
+    probs = F.softmax(filtered_logits / temperature, dim=-1)
+    return torch.multinomial(probs, 1)
+
+
+def mask_after_eos(out, eos_token, pad_value=0):
+    # mask out everything after the eos tokens
+
+    is_eos_tokens = (out == eos_token)
+    shifted_is_eos_tokens = F.pad(is_eos_tokens, (1, -1))
+    mask = shifted_is_eos_tokens.float().cumsum(dim=-1) >= 1
+    return out.masked_fill(mask, pad_value)
+
+
 # autoregressive wrapper class
 
 class AutoregressiveWrapper(Module):
@@ -140,6 +232,16 @@ class AutoregressiveWrapper(Module):
         # whether to add router z-loss
         self.add_attn_z_loss = add_attn_z_loss
 
+    def slide_cache(self, cache):
+        # slides the self attention caches to the last max_seq_len - 1 positions, after the memory tokens, so the next token completes the window
+        # static caches are ring buffers over the window, and keep to it themselves. cross attention caches hold the whole context
+
+        for is_self_attn, inter in zip(self.net.attn_layers.get_cache_self_attn(), cache.attn_intermediates):
+            if not is_self_attn or isinstance(inter.cached_kv, StaticKVCache):
+                continue
+
+            inter.cached_kv = [slide_cached_kv(t, self.max_seq_len - 1, num_fixed=self.net.num_memory_tokens) for t in inter.cached_kv]
+
     @torch.no_grad()
     @eval_decorator
     def generate(
@@ -158,9 +260,114 @@ class AutoregressiveWrapper(Module):
                 alpha=0.1
             ),
             cache_kv=True,
+            static_kv_cache=False,
+            paged_kv_cache=False,
+            paged_block_size=16,
+            paged_num_blocks: Optional[int] = None,
+            quantize_kv_cache=False,
+            prefix_cache: Optional[PrefixKVCache] = None,
+            streaming_kv_cache=False,
+            streaming_cache_len: Optional[int] = None,
+            eviction_policy: Optional[EvictionPolicy] = None,
+            draft_model: Optional[Module] = None,
+            num_draft_tokens=4,
+            num_beams=1,
+            length_penalty=1.,
+            compact_every: Optional[int] = None,
+            prefill_chunk_size: Optional[int] = None,
+            sampler: Optional[Sampler] = None,
             **kwargs
     ):
-        max_seq_len, greedy, device = self.max_seq_len, temperature == 0., prompts.device
+        max_seq_len, device = self.max_seq_len, prompts.device
+
+        # with compact_every, every that many steps the rows that reached eos are moved into the results and dropped from the batch decoded
+
+        compact = exists(compact_every) and exists(eos_token)
+
+        # beam search
+
+        if num_beams > 1:
+            assert not paged_kv_cache and not exists(amateur_model) and not exists(draft_model) and not exists(prefix_cache), 'beam search cannot be combined with a paged or prefix cache, contrastive or speculative decoding'
+
+            return self.beam_search(
+                prompts,
+                seq_len,
+                num_beams=num_beams,
+                eos_token=eos_token,
+                length_penalty=length_penalty,
+                prompt_lens=prompt_lens,
+                restrict_to_max_seq_len=restrict_to_max_seq_len,
+                cache_kv=cache_kv,
+                static_kv_cache=static_kv_cache,
+                quantize_kv_cache=quantize_kv_cache,
+                prefill_chunk_size=prefill_chunk_size,
+                **kwargs
+            )
+
+        # speculative decoding with a draft model
+
+        if exists(draft_model):
+            assert cache_kv and not static_kv_cache and not paged_kv_cache and not quantize_kv_cache and not streaming_kv_cache and not exists(prefix_cache) and not exists(amateur_model) and not exists(compact_every), 'speculative decoding cannot be combined with a static, paged, quantized, streaming or prefix cache, contrastive decoding or compacting finished rows, and needs the key / value cache'
+
+            return self.speculative_generate(
+                prompts,
+                seq_len,
+                draft_model,
+                num_draft_tokens=num_draft_tokens,
+                eos_token=eos_token,
+                temperature=temperature,
+                prompt_lens=prompt_lens,
+                restrict_to_max_seq_len=restrict_to_max_seq_len,
+                filter_logits_fn=filter_logits_fn,
+                filter_kwargs=filter_kwargs,
+                prefill_chunk_size=prefill_chunk_size,
+                sampler=sampler,
+                **kwargs
+            )
+
+        # paged cache
+
+        if paged_kv_cache and cache_kv and self.net.can_cache_kv:
+            assert not static_kv_cache and not streaming_kv_cache and not exists(prefix_cache) and not exists(amateur_model) and not compact, 'paged cache cannot be combined with a static, streaming or prefix cache, contrastive decoding or compacting finished rows'
+
+            return self.paged_generate(
+                prompts,
+                seq_len,
+                eos_token=eos_token,
+                temperature=temperature,
+                prompt_lens=prompt_lens,
+                filter_logits_fn=filter_logits_fn,
+                filter_kwargs=filter_kwargs,
+                restrict_to_max_seq_len=restrict_to_max_seq_len,
+                block_size=paged_block_size,
+                num_blocks=paged_num_blocks,
+                quantize_kv_cache=quantize_kv_cache,
+                prefill_chunk_size=prefill_chunk_size,
+                sampler=sampler,
+                **kwargs
+            )
+
+        # streaming cache
+
+        if streaming_kv_cache and cache_kv and self.net.can_cache_kv:
+            assert not static_kv_cache and not quantize_kv_cache and not exists(prefix_cache) and not exists(amateur_model), 'streaming cache cannot be combined with a static, quantized or prefix cache, or contrastive decoding'
+            assert not exists(prompt_lens), 'streaming cache does not keep track of the padding of variable lengthed prompts'
+
+            return self.streaming_generate(
+                prompts,
+                seq_len,
+                cache_len=streaming_cache_len,
+                eviction_policy=eviction_policy,
+                eos_token=eos_token,
+                temperature=temperature,
+                filter_logits_fn=filter_logits_fn,
+                filter_kwargs=filter_kwargs,
+                restrict_to_max_seq_len=restrict_to_max_seq_len,
+                compact_every=compact_every,
+                prefill_chunk_size=prefill_chunk_size,
+                sampler=sampler,
+                **kwargs
+            )
 
         prompts, ps = pack([prompts], '* n')
 
@@ -177,10 +384,37 @@ class AutoregressiveWrapper(Module):
 
         out = prompts
 
+        # batch_indices holds the index in the original batch of each row still decoded
+
+        if compact:
+            batch_indices = torch.arange(b, device=device)
+            results = torch.full((b, t + seq_len), self.pad_value, device=device, dtype=out.dtype)
+
         # kv caches
 
         cache = None
 
+        # seed the cache with the longest prefix of the prompts cached by previous calls, so only the rest is prefilled
+
+        prefix_len = 0
+
+        if exists(prefix_cache) and cache_kv and self.net.can_cache_kv:
+            assert not exists(prompt_lens), 'prefix cache cannot be combined with variable lengthed prompts'
+            assert self.net.num_memory_tokens == 0, 'prefix cache is keyed on the tokens only, and does not support memory tokens'
+            assert 'context' not in kwargs, 'prefix cache is keyed on the tokens only, and cannot be used when conditioning on a context'
+            assert not restrict_to_max_seq_len or t <= max_seq_len, 'prompts must fit within the max sequence length to be prefix cached'
+
+            cache, prefix_len = prefix_cache.lookup(prompts)
+
+        # with prefill_chunk_size, the prompts are prefilled into the cache by chunks of that many tokens, the last of which is fed in on the first step
+        # peak memory of the prefill then grows with the chunk size instead of the length of the prompts
+
+        num_prefilled = prefix_len
+
+        if exists(prefill_chunk_size) and cache_kv and self.net.can_cache_kv:
+            prompt_x = out[:, -max_seq_len:] if restrict_to_max_seq_len else out
+            cache, num_prefilled = prefill_chunks(self.net, prompt_x, prefill_chunk_size, cache=cache, num_cached=prefix_len, seq_start_pos=seq_start_pos, **kwargs)
+
         # if doing contrastive decoding, turn off filter automatically
 
         if exists(amateur_model):
@@ -200,7 +434,10 @@ class AutoregressiveWrapper(Module):
 
         # sampling up to seq_len
 
-        for _ in range(seq_len):
+        for step in range(seq_len):
+            x = out
+            is_prefill = step == 0
+            net_kwargs = dict()
 
             if restrict_to_max_seq_len:
                 max_len_exceeded = out.shape[-1] > max_seq_len
@@ -210,19 +447,46 @@ class AutoregressiveWrapper(Module):
 
                 x = out[:, -max_seq_len:]
 
-                if exists(cache):
-                    for inter in cache.attn_intermediates:
-                        inter.cached_kv = [t[..., -(max_seq_len - 1):, :] for t in inter.cached_kv]
+                # the cache only slides once the tokens exceed the max sequence length, as it also holds the memory tokens
+                # with interspersed memory tokens it cannot slide, so it is dropped and the rest is decoded without a cache
+
+                if exists(cache) and max_len_exceeded and not self.net.can_slide_cache_kv:
+                    cache, cache_kv = None, False
+
+                if exists(cache) and max_len_exceeded:
+                    self.slide_cache(cache)
+
+            # the first step only feeds in the tokens of the prompts not in the cache yet, past a cached prefix or the prefilled chunks
+
+            if is_prefill and num_prefilled > 0:
+                net_kwargs = dict(cache_age=x.shape[-1] - num_prefilled)
 
             logits, new_cache = self.net(
                 x,
                 return_intermediates=True,
+                capture='kv_only',
                 cache=cache,
                 seq_start_pos=seq_start_pos,
+                output_positions=-1,
+                **net_kwargs,
                 **kwargs
             )
 
+            if is_prefill and exists(prefix_cache) and cache_kv and self.net.can_cache_kv:
+                prefix_cache.insert(prompts, new_cache)
+
             if cache_kv and self.net.can_cache_kv:
+
+                # after the prompt, move the key / values into preallocated buffers that are written in place from then on
+                # an int8 quantized cache is always stored in such buffers
+
+                if (static_kv_cache or quantize_kv_cache) and is_prefill:
+                    has_memory_tokens = self.net.num_memory_tokens > 0
+                    assert not (has_memory_tokens and restrict_to_max_seq_len and (t + seq_len) > max_seq_len), 'static cache cannot slide over the max sequence length with memory tokens'
+
+                    window = max_seq_len if restrict_to_max_seq_len and not has_memory_tokens else None
+                    to_static_kv_cache(new_cache, max_len=self.net.num_positions(t + seq_len), window=window, quantize=quantize_kv_cache, self_attn=self.net.attn_layers.get_cache_self_attn())
+
                 cache = new_cache
 
             logits = logits[:, -1]
@@ -236,8 +500,10 @@ class AutoregressiveWrapper(Module):
                     amateur_logits, next_amateur_cache = amateur(
                         x,
                         return_intermediates=True,
+                        capture='kv_only',
                         cache=amateur_cache,
                         seq_start_pos=seq_start_pos,
+                        output_positions=-1,
                         **kwargs
                     )
 
@@ -249,17 +515,9 @@ class AutoregressiveWrapper(Module):
                     if cache_kv and amateur.can_cache_kv:
                         amateur_caches[i] = next_amateur_cache
 
-            # filter by top_k, top_p (nucleus), top_a, or custom
-
-            if greedy:
-                sample = logits.argmax(dim=-1, keepdim=True)
-            else:
-                filtered_logits = filter_logits_fn(logits, **filter_kwargs)
-                probs = F.softmax(filtered_logits / temperature, dim=-1)
-                sample = torch.multinomial(probs, 1)
-
             # concat sample
 
+            sample = sample_logits(logits, temperature=temperature, filter_logits_fn=filter_logits_fn, filter_kwargs=filter_kwargs, sampler=sampler)
             out = torch.cat((out, sample), dim=-1)
 
             if not exists(eos_token):
@@ -270,11 +528,32 @@ class AutoregressiveWrapper(Module):
             if is_eos_tokens.any(dim=-1).all():
                 break
 
+            # drop the finished rows from the output and every per row state - the cache, the context, the start positions
+
+            is_done = is_eos_tokens.any(dim=-1)
+
+            if compact and ((step + 1) % compact_every) == 0 and is_done.any():
+                keep, batch_indices = compact_finished_rows(out, is_done, batch_indices, results)
+
+                out = out[keep]
+                seq_start_pos = select_rows(seq_start_pos, keep)
+                sampler = select_rows(sampler, keep)
+                kwargs = map_batch_kwargs(kwargs, len(is_done), lambda t: t[keep])
+
+                if exists(cache):
+                    reorder_cached_kv(cache, keep)
+
+                if exists(amateur_model):
+                    for amateur_cache in amateur_caches:
+                        if exists(amateur_cache):
+                            reorder_cached_kv(amateur_cache, keep)
+
+        if compact:
+            results[batch_indices, :out.shape[1]] = out
+            out = results[:, :out.shape[1]]
+
         if exists(eos_token):
-            # mask out everything after the eos tokens
-            shifted_is_eos_tokens = F.pad(is_eos_tokens, (1, -1))
-            mask = shifted_is_eos_tokens.float().cumsum(dim=-1) >= 1
-            out = out.masked_fill(mask, self.pad_value)
+            out = mask_after_eos(out, eos_token, self.pad_value)
 
         out = out[:, t:]
 
@@ -282,6 +561,565 @@ class AutoregressiveWrapper(Module):
 
         return out
 
+    @torch.no_grad()
+    @eval_decorator
+    def paged_generate(
+            self,
+            prompts,
+            seq_len,
+            eos_token=None,
+            temperature=1.,
+            prompt_lens: Optional[Tensor] = None,
+            filter_logits_fn: Callable = top_k,
+            filter_kwargs: dict = dict(),
+            restrict_to_max_seq_len=True,
+            block_size=16,
+            num_blocks: Optional[int] = None,
+            quantize_kv_cache=False,
+            prefill_chunk_size: Optional[int] = None,
+            sampler: Optional[Sampler] = None,
+            **kwargs
+    ):
+        """
+        decoding with a paged cache - the prompts stay right padded and each row is decoded from its own length
+        after the prompt, the key / values of each row are moved into blocks of block_size positions, by default with room for every row to decode seq_len tokens
+        """
+
+        max_seq_len = self.max_seq_len
+
+        assert self.net.can_cache_kv, 'the network cannot use cached key values'
+        assert self.net.num_memory_tokens == 0, 'paged cache does not support memory tokens'
+
+        prompts, ps = pack([prompts], '* n')
+
+        b, t = prompts.shape
+
+        assert not restrict_to_max_seq_len or (t + seq_len) <= max_seq_len, 'paged cache does not slide over the max sequence length, set restrict_to_max_seq_len to False to decode past it'
+
+        paged_lens = default(prompt_lens, torch.full((b,), t, device=prompts.device, dtype=torch.long))
+
+        out = prompts
+
+        # right padded prompts are only prefilled up to the shortest, so the last token of every row is fed in on the first step
+
+        cache, block_table, num_prefilled = None, None, 0
+
+        if exists(prefill_chunk_size):
+            cache, num_prefilled = prefill_chunks(self.net, out[:, :int(paged_lens.amin())], prefill_chunk_size, **kwargs)
+
+        for step in range(seq_len):
+            is_prefill = step == 0
+
+            if is_prefill:
+                # the prompts past the prefilled chunks are fed in, and only the logits of the last token of each row, at its length, are computed
+
+                x = out
+                net_kwargs = dict(cache_age=x.shape[-1] - num_prefilled) if num_prefilled > 0 else dict()
+                output_positions = rearrange(paged_lens - 1 - num_prefilled, 'b -> b 1')
+            else:
+                # only the last sample is fed in, at the position of each row
+
+                x = out[:, -1:]
+                net_kwargs = dict(pos=rearrange(paged_lens, 'b -> b 1'))
+                output_positions = -1
+                block_table.begin_step(1)
+
+            logits, new_cache = self.net(
+                x,
+                return_intermediates=True,
+                capture='kv_only',
+                cache=cache,
+                output_positions=output_positions,
+                **net_kwargs,
+                **kwargs
+            )
+
+            if is_prefill:
+                num_blocks = default(num_blocks, int(((paged_lens + seq_len + block_size - 1) // block_size).sum()))
+                cache, block_table = to_paged_kv_cache(new_cache, paged_lens, num_blocks=num_blocks, block_size=block_size, self_attn=self.net.attn_layers.get_cache_self_attn(), quantize=quantize_kv_cache)
+            else:
+                block_table.end_step()
+                paged_lens = paged_lens + 1
+
+            sample = sample_logits(logits[:, -1], temperature=temperature, filter_logits_fn=filter_logits_fn, filter_kwargs=filter_kwargs, sampler=sampler)
+            out = torch.cat((out, sample), dim=-1)
+
+            if exists(eos_token) and (out == eos_token).any(dim=-1).all():
+                break
+
+        if exists(eos_token):
+            out = mask_after_eos(out, eos_token, self.pad_value)
+
+        out = out[:, t:]
+
+        out, = unpack(out, ps, '* n')
+
+        return out
+
+    @torch.no_grad()
+    @eval_decorator
+    def streaming_generate(
+            self,
+            prompts,
+            seq_len,
+            cache_len: Optional[int] = None,
+            eviction_policy: Optional[EvictionPolicy] = None,
+            eos_token=None,
+            temperature=1.,
+            filter_logits_fn: Callable = top_k,
+            filter_kwargs: dict = dict(),
+            restrict_to_max_seq_len=True,
+            compact_every: Optional[int] = None,
+            prefill_chunk_size: Optional[int] = None,
+            sampler: Optional[Sampler] = None,
+            **kwargs
+    ):
+        """
+        decoding with a streaming cache - every self attention layer keeps at most cache_len positions (by default the max sequence length), picked by the eviction policy
+        decoding can then go on for as long as needed, with constant memory and per token latency. the prompt is prefilled into the empty cache
+        """
+
+        max_seq_len, device = self.max_seq_len, prompts.device
+
+        assert self.net.can_cache_kv, 'the network cannot use cached key values'
+        assert self.net.num_memory_tokens == 0, 'streaming cache feeds in one token at a time, and may evict the memory tokens, so it does not support memory tokens'
+        assert self.net.can_cache_kv_outside_max_seq_len, 'streaming cache re-bases the positions of the kept keys, which needs rotary embeddings or relative position biases instead of absolute positional embeddings'
+
+        prompts, ps = pack([prompts], '* n')
+
+        b, t = prompts.shape
+
+        out = prompts
+
+        compact = exists(compact_every) and exists(eos_token)
+
+        if compact:
+            batch_indices = torch.arange(b, device=device)
+            results = torch.full((b, t + seq_len), self.pad_value, device=device, dtype=out.dtype)
+
+        cache = self.net.attn_layers.init_cache(lambda: StreamingKVCache(default(cache_len, max_seq_len), policy=eviction_policy))
+
+        prompt_x = out[:, -max_seq_len:] if restrict_to_max_seq_len else out
+        num_prefilled = 0
+
+        if exists(prefill_chunk_size):
+            cache, num_prefilled = prefill_chunks(self.net, prompt_x, prefill_chunk_size, cache=cache, **kwargs)
+
+        for step in range(seq_len):
+
+            # the first step feeds in the tokens of the prompts past the prefilled chunks, after which only the last sample is fed in, the cache holds all the network attends to
+
+            x = prompt_x if step == 0 else out[:, -1:]
+            cache_age = (x.shape[-1] - num_prefilled) if step == 0 else 1
+
+            logits, cache = self.net(
+                x,
+                return_intermediates=True,
+                capture='kv_only',
+                cache=cache,
+                cache_age=cache_age,
+                output_positions=-1,
+                **kwargs
+            )
+
+            sample = sample_logits(logits[:, -1], temperature=temperature, filter_logits_fn=filter_logits_fn, filter_kwargs=filter_kwargs, sampler=sampler)
+            out = torch.cat((out, sample), dim=-1)
+
+            if not exists(eos_token):
+                continue
+
+            is_done = (out == eos_token).any(dim=-1)
+
+            if is_done.all():
+                break
+
+            if compact and ((step + 1) % compact_every) == 0 and is_done.any():
+                keep, batch_indices = compact_finished_rows(out, is_done, batch_indices, results)
+
+                out = out[keep]
+                sampler = select_rows(sampler, keep)
+                kwargs = map_batch_kwargs(kwargs, len(is_done), lambda t: t[keep])
+                reorder_cached_kv(cache, keep)
+
+        if compact:
+            results[batch_indices, :out.shape[1]] = out
+            out = results[:, :out.shape[1]]
+
+        if exists(eos_token):
+            out = mask_after_eos(out, eos_token, self.pad_value)
+
+        out = out[:, t:]
+
+        out, = unpack(out, ps, '* n')
+
+        return out
+
+    @torch.no_grad()
+    @eval_decorator
+    def speculative_generate(
+            self,
+            prompts,
+            seq_len,
+            draft_model: Module,
+            num_draft_tokens=4,
+            eos_token=None,
+            temperature=1.,
+            prompt_lens: Optional[Tensor] = None,
+            restrict_to_max_seq_len=True,
+            filter_logits_fn: Callable = top_k,
+            filter_kwargs: dict = dict(),
+            prefill_chunk_size: Optional[int] = None,
+            sampler: Optional[Sampler] = None,
+            **kwargs
+    ):
+        """
+        speculative decoding, Leviathan et al. https://arxiv.org/abs/2211.17192
+        the draft model proposes num_draft_tokens tokens one at a time, then the network scores all of them in one forward over its cache
+        (cache_age > 1, with the causal mask right aligned to the cached keys). drafts are accepted with the rejection sampling rule,
+        so the output distribution is the same as sampling from the network alone
+
+        rows of the batch accept the same number of drafts - the fewest of any row, with the rows that accepted more taking the draft at that
+        position, which the rule already accepted. both caches are rolled back to the accepted tokens
+
+        each round costs num_draft_tokens forwards of the draft model and one of the network over num_draft_tokens + 1 tokens, and yields 1 to num_draft_tokens + 1 tokens
+        with every draft accepted, the speedup is bounded by (k + 1) / (k * draft cost + scoring cost), k the number of draft tokens, and the costs relative to a network forward over one token
+        the 2 - 3x of the paper needs a draft that agrees with the network most of the time, a draft cost around 0.1, and a scoring cost near 1, which holds when
+        decoding is bound by memory bandwidth (GPU, small batch). more draft tokens only pay off with a high acceptance rate, and for a batch,
+        every row is held to the fewest drafts accepted by any row. examples/benchmarks/speculative_decoding.py prints the costs along with the speedup
+
+        the networks are not slid over the max sequence length - with restrict_to_max_seq_len, the prompt, the tokens to decode and the drafts must fit
+        in it, and without, the networks must be able to decode past it
+        """
+
+        max_seq_len, greedy, device = self.max_seq_len, temperature == 0., prompts.device
+
+        if isinstance(draft_model, AutoregressiveWrapper):
+            draft_model = draft_model.net
+
+        draft_model.eval()
+
+        assert self.net.can_cache_kv and draft_model.can_cache_kv, 'both the network and the draft model must be able to cache key / values'
+
+        prompts, ps = pack([prompts], '* n')
+
+        b, t = prompts.shape
+
+        fits_max_seq_len = (t + seq_len + num_draft_tokens) <= max_seq_len
+
+        assert fits_max_seq_len or not restrict_to_max_seq_len, 'speculative decoding does not slide over the max sequence length, set restrict_to_max_seq_len to False to decode past it'
+        assert fits_max_seq_len or (self.net.can_cache_kv_outside_max_seq_len and draft_model.can_cache_kv_outside_max_seq_len), 'speculative decoding past the max sequence length needs networks that can decode past it, which they cannot, most likely because of absolute positional embeddings'
+
+        seq_start_pos = None
+        if exists(prompt_lens):
+            prompts = align_right(prompts, prompt_lens, pad_id=self.pad_value)
+            seq_start_pos = t - prompt_lens
+
+        def get_probs(logits):
+            if exists(sampler):
+                return F.softmax(sampler.filter(logits), dim=-1)
+
+            if greedy:
+                return F.one_hot(logits.argmax(dim=-1), logits.shape[-1]).float()
+
+            logits, packed_shape = pack([logits], '* d')
+            probs = F.softmax(filter_logits_fn(logits, **filter_kwargs) / temperature, dim=-1)
+            probs, = unpack(probs, packed_shape, '* d')
+            return probs
+
+        def forward(net, x, cache, cache_len, num_logits=1):
+            # feeds in the positions of x that are not cached yet, returning the logits of the last num_logits of them and the cache over all of x
+
+            return net(
+                x,
+                return_intermediates=True,
+                capture='kv_only',
+                cache=cache,
+                cache_age=x.shape[-1] - cache_len,
+                seq_start_pos=seq_start_pos,
+                output_positions=torch.arange(-num_logits, 0, device=device),
+                **kwargs
+            )
+
+        def trim_cache(net, cache, length):
+            num_positions = net.num_positions(length)
+
+            for is_self_attn, inter in zip(net.attn_layers.get_cache_self_attn(), cache.attn_intermediates):
+                if is_self_attn:
+                    inter.cached_kv = [t[..., :num_positions, :] for t in inter.cached_kv]
+
+        out = prompts
+
+        cache, cache_len = None, 0
+        draft_cache, draft_cache_len = None, 0
+
+        if exists(prefill_chunk_size):
+            cache, cache_len = prefill_chunks(self.net, out, prefill_chunk_size, seq_start_pos=seq_start_pos, **kwargs)
+            draft_cache, draft_cache_len = prefill_chunks(draft_model, out, prefill_chunk_size, seq_start_pos=seq_start_pos, **kwargs)
+
+        while out.shape[-1] < (t + seq_len):
+            curr_len = out.shape[-1]
+
+            # draft model proposes tokens one at a time
+
+            drafts, draft_probs = [], []
+
+            for _ in range(num_draft_tokens):
+                x = torch.cat((out, *drafts), dim=-1)
+                draft_logits, draft_cache = forward(draft_model, x, draft_cache, draft_cache_len)
+                draft_cache_len = x.shape[-1]
+
+                probs = get_probs(draft_logits[:, -1])
+                drafts.append(torch.multinomial(probs, 1))
+                draft_probs.append(probs)
+
+            drafts = torch.cat(drafts, dim=-1)
+            draft_probs = torch.stack(draft_probs, dim=1)
+
+            # network scores all drafts in one forward, plus the token after them
+
+            x = torch.cat((out, drafts), dim=-1)
+            logits, cache = forward(self.net, x, cache, cache_len, num_logits=num_draft_tokens + 1)
+            probs = get_probs(logits)
+
+            # accept each draft with probability min(1, p / q), up to the first rejection
+
+            draft_p = probs[:, :-1].gather(-1, drafts[..., None])[..., 0]
+            draft_q = draft_probs.gather(-1, drafts[..., None])[..., 0]
+
+            accepted = torch.rand_like(draft_p) < (draft_p / draft_q)
+            num_accepted = accepted.long().cumprod(dim=-1).sum(dim=-1)
+            num_accepted_all = int(num_accepted.amin())
+
+            # the token after the accepted drafts - sampled from the normalized (p - q)+ where rejected, from p if all drafts are accepted
+
+            next_probs = probs[:, num_accepted_all]
+
+            if num_accepted_all < num_draft_tokens:
+                residual = (next_probs - draft_probs[:, num_accepted_all]).clamp(min=0.)
+                residual = torch.where(residual.sum(dim=-1, keepdim=True) > 0., residual, next_probs)
+                next_probs = residual / residual.sum(dim=-1, keepdim=True)
+
+            sample = torch.multinomial(next_probs, 1)
+
+            if num_accepted_all < num_draft_tokens:
+                sample = torch.where(num_accepted[:, None] > num_accepted_all, drafts[:, num_accepted_all:(num_accepted_all + 1)], sample)
+
+            out = torch.cat((out, drafts[:, :num_accepted_all], sample), dim=-1)
+
+            # roll back both caches to the accepted tokens, leaving out the sampled one which is fed in next
+
+            cache_len = curr_len + num_accepted_all
+            draft_cache_len = min(draft_cache_len, cache_len)
+
+            trim_cache(self.net, cache, cache_len)
+            trim_cache(draft_model, draft_cache, draft_cache_len)
+
+            if exists(eos_token) and (out == eos_token).any(dim=-1).all():
+                break
+
+        out = out[:, :(t + seq_len)]
+
+        if exists(eos_token):
+            out = mask_after_eos(out, eos_token, self.pad_value)
+
+        out = out[:, t:]
+
+        out, = unpack(out, ps, '* n')
+
+        return out
+
+    @torch.no_grad()
+    @eval_decorator
+    def beam_search(
+            self,
+            prompts,
+            seq_len,
+            num_beams=4,
+            eos_token=None,
+            length_penalty=1.,
+            prompt_lens: Optional[Tensor] = None,
+            restrict_to_max_seq_len=True,
+            cache_kv=True,
+            static_kv_cache=False,
+            quantize_kv_cache=False,
+            return_beams=False,
+            prefill_chunk_size: Optional[int] = None,
+            **kwargs
+    ):
+        """
+        beam search, with the beams of all prompts decoded as one batch of batch x num_beams rows
+        after each step, the rows of the output and of the key / value cache are reordered to the beams picked to continue, instead of recomputing them
+        tensors in kwargs with a leading batch dimension (the context and its mask) are repeated for each beam once, up front
+
+        a beam ending in eos is set aside as a finished hypothesis, scored by its log probability over its length ** length_penalty
+        a prompt is done once it has num_beams finished hypotheses that no continuing beam can outscore, and decoding stops when all prompts are done
+
+        returns the best hypothesis of each prompt, or with return_beams, all num_beams hypotheses sorted best first along with their scores
+        """
+
+        max_seq_len, device = self.max_seq_len, prompts.device
+
+        prompts, ps = pack([prompts], '* n')
+
+        b, t = prompts.shape
+
+        def repeat_beams(t):
+            return t.repeat_interleave(num_beams, dim=0)
+
+        seq_start_pos = None
+        if exists(prompt_lens):
+            prompts = align_right(prompts, prompt_lens, pad_id=self.pad_value)
+            seq_start_pos = repeat_beams(t - prompt_lens)
+
+        kwargs = map_batch_kwargs(kwargs, b, repeat_beams)
+
+        out = repeat_beams(prompts)
+
+        # only the first beam of each prompt is live at the start, so the first step does not pick the same tokens num_beams times
+
+        beam_scores = torch.full((b, num_beams), -float('inf'), device=device)
+        beam_scores[:, 0] = 0.
+
+        finished = torch.full((b, num_beams, seq_len), self.pad_value, device=device, dtype=torch.long)
+        finished_scores = torch.full((b, num_beams), -float('inf'), device=device)
+
+        batch_offsets = torch.arange(b, device=device)[:, None] * num_beams
+        candidate_ranks = torch.arange(2 * num_beams, device=device)
+
+        def add_finished(seqs, scores):
+            # keeps the best num_beams of the finished hypotheses and the given ones, sorted best first
+
+            nonlocal finished, finished_scores
+
+            seqs = F.pad(seqs, (0, seq_len - seqs.shape[-1]), value=self.pad_value)
+
+            all_seqs = torch.cat((finished, seqs), dim=1)
+            all_scores = torch.cat((finished_scores, scores), dim=1)
+
+            finished_scores, indices = all_scores.topk(num_beams, dim=-1)
+            finished = all_seqs.gather(1, indices[..., None].expand(-1, -1, seq_len))
+
+        cache, num_prefilled = None, 0
+
+        if exists(prefill_chunk_size) and cache_kv and self.net.can_cache_kv:
+            prompt_x = out[:, -max_seq_len:] if restrict_to_max_seq_len else out
+            cache, num_prefilled = prefill_chunks(self.net, prompt_x, prefill_chunk_size, seq_start_pos=seq_start_pos, **kwargs)
+
+        for step in range(seq_len):
+            x = out
+
+            if restrict_to_max_seq_len:
+                max_len_exceeded = out.shape[-1] > max_seq_len
+
+                assert not (cache_kv and max_len_exceeded and not self.net.can_cache_kv_outside_max_seq_len), 'the network cannot use cached key values when decoding outside the max sequence length. most likely because you are using absolute positional embeeding. you can switch to rotary embeddings to resolve this issue'
+
+                x = out[:, -max_seq_len:]
+
+                # the cache only slides once the tokens exceed the max sequence length, as it also holds the memory tokens
+                # with interspersed memory tokens it cannot slide, so it is dropped and the rest is decoded without a cache
+
+                if exists(cache) and max_len_exceeded and not self.net.can_slide_cache_kv:
+                    cache, cache_kv = None, False
+
+                if exists(cache) and max_len_exceeded:
+                    self.slide_cache(cache)
+
+            net_kwargs = dict(cache_age=x.shape[-1] - num_prefilled) if step == 0 and num_prefilled > 0 else dict()
+
+            logits, new_cache = self.net(
+                x,
+                return_intermediates=True,
+                capture='kv_only',
+                cache=cache,
+                seq_start_pos=seq_start_pos,
+                output_positions=-1,
+                **net_kwargs,
+                **kwargs
+            )
+
+            if cache_kv and self.net.can_cache_kv:
+                if (static_kv_cache or quantize_kv_cache) and step == 0:
+                    has_memory_tokens = self.net.num_memory_tokens > 0
+                    assert not (has_memory_tokens and restrict_to_max_seq_len and (t + seq_len) > max_seq_len), 'static cache cannot slide over the max sequence length with memory tokens'
+
+                    window = max_seq_len if restrict_to_max_seq_len and not has_memory_tokens else None
+                    to_static_kv_cache(new_cache, max_len=self.net.num_positions(t + seq_len), window=window, quantize=quantize_kv_cache, self_attn=self.net.attn_layers.get_cache_self_attn())
+
+                cache = new_cache
+
+            # the 2 x num_beams best continuations of each prompt, across all of its beams
+
+            log_probs = logits[:, -1].float().log_softmax(dim=-1)
+            num_tokens = log_probs.shape[-1]
+
+            scores = rearrange(beam_scores, 'b k -> (b k) 1') + log_probs
+            scores = rearrange(scores, '(b k) v -> b (k v)', b=b)
+
+            top_scores, top_indices = scores.topk(2 * num_beams, dim=-1)
+            top_beams, top_tokens = top_indices // num_tokens, top_indices % num_tokens
+
+            num_generated = step + 1
+
+            if exists(eos_token):
+                # eos among the num_beams best continuations finish their hypothesis, and continuing beams are picked from the rest
+
+                is_eos = top_tokens == eos_token
+                is_finished = is_eos & (candidate_ranks < num_beams) & (top_scores > -float('inf'))
+
+                if is_finished.any():
+                    generated = rearrange(out[:, t:], '(b k) n -> b k n', b=b)
+                    seqs = generated.gather(1, top_beams[..., None].expand(-1, -1, step))
+                    seqs = torch.cat((seqs, top_tokens[..., None]), dim=-1)
+
+                    eos_scores = top_scores / (num_generated ** length_penalty)
+                    add_finished(seqs, eos_scores.masked_fill(~is_finished, -float('inf')))
+
+                keep = (candidate_ranks + is_eos.long() * 2 * num_beams).topk(num_beams, dim=-1, largest=False).indices
+                top_scores, top_beams, top_tokens = (t.gather(1, keep) for t in (top_scores, top_beams, top_tokens))
+
+            else:
+                top_scores, top_beams, top_tokens = (t[:, :num_beams] for t in (top_scores, top_beams, top_tokens))
+
+            # reorder the output and the cache to the picked beams
+
+            beam_indices = rearrange(top_beams + batch_offsets, 'b k -> (b k)')
+
+            out = torch.cat((out[beam_indices], rearrange(top_tokens, 'b k -> (b k) 1')), dim=-1)
+            beam_scores = top_scores
+
+            if exists(cache):
+                reorder_cached_kv(cache, beam_indices)
+
+            if not exists(eos_token):
+                continue
+
+            # a prompt is done when its worst finished hypothesis beats the best score any of its beams could still reach
+            # which is its current log probability, over the longest length when length_penalty > 0, as the log probability only decreases
+
+            norm_len = seq_len if length_penalty > 0 else num_generated
+            best_reachable = beam_scores.amax(dim=-1) / (norm_len ** length_penalty)
+
+            is_done = finished_scores[:, -1] >= best_reachable
+            beam_scores = beam_scores.masked_fill(is_done[:, None], -float('inf'))
+
+            if is_done.all():
+                break
+
+        else:
+            # beams still going at the end of seq_len are finished as they are
+
+            generated = rearrange(out[:, t:], '(b k) n -> b k n', b=b)
+            add_finished(generated, beam_scores / (seq_len ** length_penalty))
+
+        if return_beams:
+            finished, = unpack(finished, ps, '* k n')
+            finished_scores, = unpack(finished_scores, ps, '* k')
+            return finished, finished_scores
+
+        out, = unpack(finished[:, 0], ps, '* n')
+
+        return out
+
     def forward(self, x, return_outputs=False, **kwargs):
         seq, ignore_index, add_attn_z_loss = x.shape[1], self.ignore_index, self.add_attn_z_loss
 
@@ -296,10 +1134,13 @@ class AutoregressiveWrapper(Module):
             mask = ~torch.zeros_like(inp).scatter(1, indices, 1.).bool()
             kwargs.update(self_attn_kv_mask=mask)
 
+        # only keep all the intermediates around if they are returned, otherwise just what the attention z-loss needs
+
         logits, cache = self.net(
             inp,
             return_intermediates=True,
             return_attn_z_loss=add_attn_z_loss,
+            capture='full' if return_outputs else ('z_loss' if add_attn_z_loss else 'none'),
             mask=mask,
             **kwargs
         )
@@ -87,10 +87,16 @@ class ContinuousTransformerWrapper(nn.Module):
         pos = None,
         prepend_embeds = None,
         prepend_mask = None,
+        output_positions = None,
         **kwargs
     ):
         batch, seq, device = *x.shape[:2], x.device
 
+        # output positions restrict the output to those positions, with only their queries computed in the last self attention layer, same as for TransformerWrapper
+
+        if isinstance(output_positions, int):
+            output_positions = torch.tensor([output_positions], device = device)
+
         x = self.project_in(x)
         x = x + self.pos_emb(x, pos = pos)
 
@@ -123,13 +129,19 @@ class ContinuousTransformerWrapper(nn.Module):
 
         x = self.emb_dropout(x)
 
+        # the output positions are given past the memory tokens
+
+        if exists(output_positions) and self.has_memory_tokens:
+            num_mems = self.memory_tokens.shape[0]
+            output_positions = output_positions % (x.shape[-2] - num_mems) + num_mems
+
         # attention layers
 
-        x, intermediates = self.attn_layers(x, mask = mask, mems = mems, return_hiddens = True, **kwargs)
+        x, intermediates = self.attn_layers(x, mask = mask, mems = mems, return_hiddens = True, output_positions = output_positions, **kwargs)
 
         # splice out memory tokens
 
-        if self.has_memory_tokens:
+        if self.has_memory_tokens and not exists(output_positions):
             m, x = unpack(x, mem_ps, 'b * d')
             intermediates.memory_tokens = m
 
@@ -181,7 +193,7 @@ class ContinuousAutoregressiveWrapper(nn.Module):
         for _ in range(seq_len):
             x = out[:, -self.max_seq_len:]
 
-            last = self.net(x, **kwargs)[:, -1:]
+            last = self.net(x, output_positions = -1, **kwargs)
             out = torch.cat((out, last), dim = -2)
 
         out = out[:, t:]
@@ -0,0 +1,370 @@
+"""
+continuous batching - a running batch of sequences decoded together, where finished sequences leave and queued ones join after every step
+the keys / values of all sequences live in a paged cache, so sequences come and go without the cache being reallocated or copied
+"""
+
+import asyncio
+from time import perf_counter
+from math import ceil
+from collections import deque, defaultdict
+from dataclasses import dataclass, field
+from typing import Optional, Callable, List
+
+import torch
+from torch import Tensor
+import torch.nn.functional as F
+
+from x_transformers.attend import Intermediates
+from x_transformers.x_transformers import LayerIntermediates
+from x_transformers.autoregressive_wrapper import AutoregressiveWrapper, top_k, sample_logits
+from x_transformers.kv_cache import BlockTable, PagedKVCache
+from x_transformers.sampling import Sampler, stack_samplers
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    return val if exists(val) else d
+
+# request
+
+@dataclass
+class Request:
+    id: int
+    prompt: Tensor
+    seq_len: int
+    eos_token: Optional[int] = None
+    temperature: float = 1.
+    filter_logits_fn: Callable = top_k
+    filter_kwargs: dict = field(default_factory = dict)
+    sampler: Optional[Sampler] = None
+
+    tokens: List[int] = field(default_factory = list)
+    seq_id: Optional[int] = None
+    num_prefilled: int = 0
+    num_blocks: int = 0
+    done: bool = False
+
+    submitted_at: float = 0.
+    admitted_at: Optional[float] = None
+    first_token_at: Optional[float] = None
+    finished_at: Optional[float] = None
+
+    @property
+    def is_prefilling(self):
+        return self.num_prefilled < len(self.prompt)
+
+    @property
+    def queue_latency(self):
+        return self.admitted_at - self.submitted_at if exists(self.admitted_at) else None
+
+    @property
+    def time_to_first_token(self):
+        return self.first_token_at - self.submitted_at if exists(self.first_token_at) else None
+
+    @property
+    def output(self):
+        return torch.tensor(self.tokens, dtype = torch.long)
+
+# engine
+
+class ContinuousBatchingEngine:
+    def __init__(
+        self,
+        net,
+        num_blocks: int,
+        block_size: int = 16,
+        max_batch_size: int = 16,
+        prefill_chunk_size: int = 256,
+        quantize_kv_cache = False
+    ):
+        """
+        decodes the submitted requests in one running batch. after every step, the finished requests leave the batch and free their blocks,
+        and queued requests are admitted in their place, as long as the blocks for their prompt and all of their tokens are free
+        prompts are prefilled by chunks of at most `prefill_chunk_size` tokens, in the same forward as the decoding of the other requests
+        """
+
+        if isinstance(net, AutoregressiveWrapper):
+            net = net.net
+
+        assert net.can_cache_kv, 'the network cannot use cached key values'
+        assert net.num_memory_tokens == 0, 'continuous batching does not support memory tokens'
+        assert not net.attn_layers.cross_attend, 'continuous batching is only for decoders without cross attention'
+
+        self.net = net
+        self.max_batch_size = max_batch_size
+        self.prefill_chunk_size = prefill_chunk_size
+
+        device, dtype = next(net.parameters()).device, next(net.parameters()).dtype
+
+        # one block table shared by the paged caches of every self attention layer
+
+        self.block_table = BlockTable(num_blocks, block_size = block_size, device = device)
+
+        attn_layers = net.attn_layers
+        attn_intermediates = []
+
+        for layer_index in attn_layers.layers_execute_order:
+            if attn_layers.layer_types[layer_index] != 'a':
+                continue
+
+            attn = attn_layers.layers[layer_index][1]
+            kv_heads = attn.kv_heads
+            to_v = default(attn.to_v, attn.to_k)
+
+            paged = PagedKVCache(
+                self.block_table,
+                kv_heads,
+                attn.to_k.out_features // kv_heads,
+                kv_heads,
+                to_v.out_features // kv_heads,
+                dtype = dtype,
+                quantize = quantize_kv_cache
+            )
+
+            attn_intermediates.append(Intermediates(cached_kv = paged))
+
+        self.cache = LayerIntermediates(attn_intermediates = attn_intermediates)
+
+        self.queue = deque()
+        self.running: List[Request] = []
+        self.requests = dict()
+        self.next_request_id = 0
+        self.reserved_blocks = 0
+
+        self.num_generated_tokens = 0
+        self.num_finished = 0
+        self.num_steps = 0
+        self.step_time = 0.
+
+        self.queue_latencies = []
+        self.times_to_first_token = []
+
+    # requests
+
+    def submit(
+        self,
+        prompt: Tensor,
+        seq_len: int,
+        eos_token: Optional[int] = None,
+        temperature = 1.,
+        filter_logits_fn: Callable = top_k,
+        filter_kwargs: dict = dict(),
+        sampler: Optional[Sampler] = None
+    ):
+        # queues a request for a 1d prompt, returning its id
+        # a sampler, with scalar parameters, takes over from the temperature and filter. the requests with one are sampled together, in one pass
+
+        assert prompt.ndim == 1 and len(prompt) > 0
+        assert self.net.can_cache_kv_outside_max_seq_len or (len(prompt) + seq_len) <= self.net.max_seq_len, 'the network cannot decode past its max sequence length, most likely because of absolute positional embeddings'
+
+        request = Request(
+            id = self.next_request_id,
+            prompt = prompt.long(),
+            seq_len = seq_len,
+            eos_token = eos_token,
+            temperature = temperature,
+            filter_logits_fn = filter_logits_fn,
+            filter_kwargs = filter_kwargs,
+            sampler = sampler,
+            submitted_at = perf_counter()
+        )
+
+        request.num_blocks = ceil((len(prompt) + seq_len) / self.block_table.block_size)
+        assert request.num_blocks <= self.block_table.num_blocks, f'request needs {request.num_blocks} blocks, more than the {self.block_table.num_blocks} in the pool'
+
+        self.next_request_id += 1
+        self.requests[request.id] = request
+        self.queue.append(request)
+        return request.id
+
+    def poll(self, request_id):
+        # the request, with the tokens generated so far. it is removed from the engine once returned done
+
+        request = self.requests[request_id]
+
+        if request.done:
+            self.requests.pop(request_id)
+
+        return request
+
+    @property
+    def has_work(self):
+        return len(self.queue) > 0 or len(self.running) > 0
+
+    # batch management
+
+    def admit(self):
+        # the blocks for the whole of a request are reserved up front, so running requests never run out of blocks
+
+        while len(self.queue) > 0 and len(self.running) < self.max_batch_size:
+            request = self.queue[0]
+
+            if (self.reserved_blocks + request.num_blocks) > self.block_table.num_blocks:
+                break
+
+            self.queue.popleft()
+            self.reserved_blocks += request.num_blocks
+
+            request.seq_id = self.block_table.add_sequence()
+            request.admitted_at = perf_counter()
+            self.running.append(request)
+
+            self.queue_latencies.append(request.queue_latency)
+
+    def evict(self, request):
+        self.block_table.remove_sequence(request.seq_id)
+        self.reserved_blocks -= request.num_blocks
+        self.running.remove(request)
+
+        request.done = True
+        request.finished_at = perf_counter()
+        self.num_finished += 1
+
+    # decoding
+
+    def sample(self, sampled):
+        # samples a token for each of the (request, logits), in one pass for each group of requests sampled alike, returning the tokens by request id
+        # the requests with a sampler are all sampled together, with the parameters of each stacked per row. the others are grouped by temperature and filter
+
+        groups = defaultdict(list)
+
+        for request, request_logits in sampled:
+            if exists(request.sampler):
+                key = 'sampler'
+            elif request.temperature == 0.:
+                key = 'greedy'
+            else:
+                key = (request.temperature, request.filter_logits_fn, tuple(sorted(request.filter_kwargs.items())))
+
+            groups[key].append((request, request_logits))
+
+        tokens = dict()
+
+        for key, group in groups.items():
+            requests, logits = zip(*group)
+            logits = torch.stack(logits)
+
+            if key == 'sampler':
+                group_tokens = stack_samplers([request.sampler for request in requests])(logits)
+            else:
+                request = requests[0]
+                group_tokens = sample_logits(logits, temperature = request.temperature, filter_logits_fn = request.filter_logits_fn, filter_kwargs = request.filter_kwargs)[:, 0]
+
+            tokens.update(zip([request.id for request in requests], group_tokens.tolist()))
+
+        return tokens
+
+    def forward(self, requests: List[Request], inputs: List[Tensor]):
+        # one forward over some of the running requests, each with its own number of new tokens, returning the logits of their last new token
+
+        device = self.block_table.device
+        num_new = [len(tokens) for tokens in inputs]
+        max_new = max(num_new)
+
+        x = torch.stack([F.pad(tokens, (0, max_new - len(tokens))) for tokens in inputs]).to(device)
+
+        step = self.block_table.begin_step(num_new, seq_ids = [request.seq_id for request in requests])
+
+        # the logits are only projected for the last new token of each request
+
+        logits = self.net(
+            x,
+            pos = step.query_positions,
+            cache = self.cache,
+            cache_age = max_new,
+            output_positions = (step.num_new - 1)[:, None]
+        )
+
+        self.block_table.end_step()
+
+        return logits[:, 0]
+
+    @torch.no_grad()
+    def step(self):
+        # admits queued requests, then runs one forward for the requests decoding (their last token), and one for the requests prefilling (the next chunk of their prompt)
+        # the two are kept apart so that decoding a single token is not padded out to the prefill chunk
+
+        self.admit()
+
+        if len(self.running) == 0:
+            return
+
+        start = perf_counter()
+
+        was_training = self.net.training
+        self.net.eval()
+
+        decoding = [request for request in self.running if not request.is_prefilling]
+        prefilling = [request for request in self.running if request.is_prefilling]
+
+        sampled = []
+
+        if len(decoding) > 0:
+            logits = self.forward(decoding, [torch.tensor(request.tokens[-1:]) for request in decoding])
+            sampled.extend(zip(decoding, logits))
+
+        if len(prefilling) > 0:
+            chunks = [request.prompt[request.num_prefilled:(request.num_prefilled + self.prefill_chunk_size)] for request in prefilling]
+            logits = self.forward(prefilling, chunks)
+
+            for request, chunk, request_logits in zip(prefilling, chunks, logits):
+                request.num_prefilled += len(chunk)
+
+                if not request.is_prefilling:
+                    sampled.append((request, request_logits))
+
+        self.net.train(was_training)
+
+        # sample for the requests past their prompt, and evict the finished ones
+
+        tokens = self.sample(sampled)
+
+        for request, _ in sampled:
+            token = tokens[request.id]
+            request.tokens.append(token)
+            self.num_generated_tokens += 1
+
+            if not exists(request.first_token_at):
+                request.first_token_at = perf_counter()
+                self.times_to_first_token.append(request.time_to_first_token)
+
+            if len(request.tokens) >= request.seq_len or (exists(request.eos_token) and token == request.eos_token):
+                self.evict(request)
+
+        self.num_steps += 1
+        self.step_time += perf_counter() - start
+
+    def run_until_complete(self):
+        while self.has_work:
+            self.step()
+
+    async def generate(self, prompt: Tensor, seq_len: int, **kwargs):
+        # async interface - submits the request, and steps the engine until it is done, sharing the steps with all other pending calls
+
+        request_id = self.submit(prompt, seq_len, **kwargs)
+
+        while not self.requests[request_id].done:
+            self.step()
+            await asyncio.sleep(0)
+
+        return self.poll(request_id).output
+
+    # stats
+
+    @property
+    def stats(self):
+        mean = lambda values: sum(values) / len(values) if len(values) > 0 else float('nan')
+
+        return dict(
+            num_steps = self.num_steps,
+            num_generated_tokens = self.num_generated_tokens,
+            tokens_per_sec = self.num_generated_tokens / self.step_time if self.step_time > 0 else 0.,
+            mean_queue_latency = mean(self.queue_latencies),
+            mean_time_to_first_token = mean(self.times_to_first_token),
+            num_finished = self.num_finished,
+            num_running = len(self.running),
+            num_queued = len(self.queue)
+        )
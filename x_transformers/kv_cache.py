@@ -0,0 +1,771 @@
+from math import ceil
+from typing import Optional
+from dataclasses import dataclass
+from collections import OrderedDict
+
+import torch
+from torch import Tensor
+import torch.nn.functional as F
+
+from einops import rearrange
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    return val if exists(val) else d
+
+# int8 quantization of keys / values, symmetric, with one scale per position and head
+
+def quantize_int8(t: Tensor):
+    scale = t.float().abs().amax(dim = -1, keepdim = True).clamp(min = 1e-8) / 127.
+    quantized = (t.float() / scale).round().clamp(-127, 127).to(torch.int8)
+    return quantized, scale.to(t.dtype)
+
+def dequantize_int8(t: Tensor, scale: Tensor):
+    return t.to(scale.dtype) * scale
+
+def encode_kv(k: Tensor, v: Tensor, quantize = False):
+    # what is written to the buffers of a cache - the keys / values themselves, or their int8 quantization followed by their scales
+
+    if not quantize:
+        return k, v
+
+    return (*quantize_int8(k), *quantize_int8(v))
+
+def decode_kv(buffers, quantize = False):
+    if not quantize:
+        return tuple(buffers)
+
+    k, k_scale, v, v_scale = buffers
+    return dequantize_int8(k, k_scale), dequantize_int8(v, v_scale)
+
+def kv_buffers(k_shape, v_shape, quantize = False, **kwargs):
+    if not quantize:
+        return torch.empty(k_shape, **kwargs), torch.empty(v_shape, **kwargs)
+
+    int8_kwargs = {**kwargs, 'dtype': torch.int8}
+    return (
+        torch.empty(k_shape, **int8_kwargs),
+        torch.empty((*k_shape[:-1], 1), **kwargs),
+        torch.empty(v_shape, **int8_kwargs),
+        torch.empty((*v_shape[:-1], 1), **kwargs)
+    )
+
+# static key / value cache
+
+class StaticKVCache:
+    """
+    preallocated key / value buffers for one attention layer, that new keys / values are written into in place while decoding
+    it plugs into the existing cache interface, in place of the (keys, values) tuple at LayerIntermediates.attn_intermediates[i].cached_kv
+
+    given a window, it becomes a ring buffer holding the keys / values of the last `window` positions
+    once the ring wraps around, the positions in the window are read in order by gathering its slots, otherwise they are a view
+
+    with quantize, keys / values are stored in int8 with a scale per position and head, and dequantized when read
+    """
+
+    def __init__(
+        self,
+        k: Tensor,
+        v: Tensor,
+        max_len: Optional[int] = None,
+        window: Optional[int] = None,
+        quantize = False
+    ):
+        assert exists(max_len) or exists(window), 'either the max length or the window of the cache must be given'
+
+        batch, heads, seq_len = k.shape[:3]
+        capacity = default(window, max_len)
+
+        assert exists(window) or seq_len <= max_len, f'cache of max length {max_len} cannot hold {seq_len} keys / values'
+
+        self.window = window
+        self.capacity = capacity
+        self.quantize = quantize
+        self.length = 0
+
+        self.buffers = kv_buffers(
+            (batch, heads, capacity, k.shape[-1]),
+            (batch, v.shape[1], capacity, v.shape[-1]),
+            quantize = quantize,
+            device = k.device,
+            dtype = k.dtype
+        )
+
+        self.append(k, v)
+
+    @property
+    def seq_len(self):
+        # number of cached positions the next decoding step attends to, in addition to its own
+        # with a window, the oldest position makes way for the new one, same as trimming the cache to window - 1 before each step
+
+        if not exists(self.window):
+            return self.length
+
+        return min(self.length, self.window - 1)
+
+    @property
+    def cached_kv(self):
+        # the keys / values in the cache, in order - views, unless the ring of a window wrapped around
+
+        if not exists(self.window) or self.length <= self.window:
+            return decode_kv([t[..., :self.length, :] for t in self.buffers], quantize = self.quantize)
+
+        slots = torch.arange(self.length - self.window, self.length, device = self.buffers[0].device) % self.window
+        return decode_kv([t.index_select(-2, slots) for t in self.buffers], quantize = self.quantize)
+
+    def __iter__(self):
+        return iter(self.cached_kv)
+
+    def __getitem__(self, index):
+        return self.cached_kv[index]
+
+    def append(self, k: Tensor, v: Tensor):
+        # writes the keys / values of the new positions in place, and returns the views of all cached keys / values
+
+        num_new = k.shape[-2]
+
+        if not exists(self.window):
+            assert (self.length + num_new) <= self.capacity, f'cache of max length {self.capacity} is full'
+
+            for buffer, t in zip(self.buffers, encode_kv(k, v, quantize = self.quantize)):
+                buffer[..., self.length:(self.length + num_new), :] = t
+
+            self.length += num_new
+            return self.cached_kv
+
+        # only the last `window` new positions survive
+
+        if num_new > self.window:
+            k, v = k[..., -self.window:, :], v[..., -self.window:, :]
+            self.length += num_new - self.window
+            num_new = self.window
+
+        slots = torch.arange(self.length, self.length + num_new, device = k.device) % self.window
+
+        for buffer, t in zip(self.buffers, encode_kv(k, v, quantize = self.quantize)):
+            buffer.index_copy_(-2, slots, t)
+
+        self.length += num_new
+        return self.cached_kv
+
+    def reorder(self, indices: Tensor):
+        # selects the given rows of the batch - in place when the batch keeps its size, as with beam search picking the beams to continue
+        # otherwise into new buffers, as when finished rows are dropped from the batch
+
+        if len(indices) != self.buffers[0].shape[0]:
+            self.buffers = tuple(buffer.index_select(0, indices) for buffer in self.buffers)
+            return
+
+        num_written = min(self.length, self.capacity)
+
+        for buffer in self.buffers:
+            buffer[..., :num_written, :] = buffer[..., :num_written, :].index_select(0, indices)
+
+def to_static_kv_cache(cache, max_len = None, window = None, quantize = False, self_attn = None):
+    # turns the key / value tuples of a cache returned from the network into static caches, in place
+    # cross attention layers (self_attn[i] = False) are left as is, as the keys / values of the context never grow
+
+    self_attn = default(self_attn, [True] * len(cache.attn_intermediates))
+
+    for inter, is_self_attn in zip(cache.attn_intermediates, self_attn):
+        if not is_self_attn or isinstance(inter.cached_kv, StaticKVCache) or not exists(inter.cached_kv):
+            continue
+
+        inter.cached_kv = StaticKVCache(*inter.cached_kv, max_len = max_len, window = window, quantize = quantize)
+
+    return cache
+
+# paged key / value cache
+
+@dataclass
+class PagedStep:
+    seq_ids: list               # sequences in the batch of this step
+    seq_len: int                # longest of them before the step
+    num_new: Tensor             # (batch,) number of new positions of each sequence in this step
+    write_slots: Tensor         # (num written,) slots in the pool the new positions of all sequences are written to
+    write_mask: Tensor          # (batch, n) which of the (right padded) new positions are real
+    kv_blocks: Tensor           # (batch, blocks) blocks holding all positions of each sequence, padded sequences read a block that is masked out
+    width: int                  # number of positions read for each sequence, seq_len plus the most new positions
+    query_positions: Tensor     # (batch, n) position of each new token within its own sequence
+    attn_mask: Tensor           # (batch, 1, n, width) keys each new token may attend to
+
+class BlockTable:
+    """
+    bookkeeping shared by the paged caches of all layers - a fixed pool of `num_blocks` blocks of `block_size` positions,
+    a free list over it, and for each sequence the list of blocks its positions are written to (its block table)
+
+    the batch is made of the active sequences, in the order they were added. sequences can be added and removed between steps,
+    their blocks go back to the free list, and nothing is reallocated. a step can also run on only some of the sequences
+    """
+
+    def __init__(
+        self,
+        num_blocks: int,
+        block_size: int = 16,
+        device = None
+    ):
+        self.num_blocks = num_blocks
+        self.block_size = block_size
+        self.device = device
+
+        self.free_blocks = list(reversed(range(num_blocks)))
+        self.blocks = dict()
+        self.lengths = dict()
+        self.batch = []
+
+        self.next_seq_id = 0
+        self.step: Optional[PagedStep] = None
+
+    @property
+    def num_free_blocks(self):
+        return len(self.free_blocks)
+
+    @property
+    def seq_len(self):
+        # longest sequence in the batch of the step (or of all sequences between steps), the width of the keys / values gathered, less the new positions
+
+        if exists(self.step):
+            return self.step.seq_len
+
+        return max([self.lengths[seq_id] for seq_id in self.batch], default = 0)
+
+    def add_sequence(self):
+        seq_id = self.next_seq_id
+        self.next_seq_id += 1
+
+        self.blocks[seq_id] = []
+        self.lengths[seq_id] = 0
+        self.batch.append(seq_id)
+        return seq_id
+
+    def remove_sequence(self, seq_id):
+        assert not exists(self.step), 'sequences cannot be removed in the middle of a step'
+
+        self.free_blocks.extend(reversed(self.blocks.pop(seq_id)))
+        self.lengths.pop(seq_id)
+        self.batch.remove(seq_id)
+
+    def begin_step(self, num_new, seq_ids = None):
+        # allocates the blocks for the new positions of each sequence in the batch (or in seq_ids), and works out the slots to write to and read from
+        # every layer of the step then reuses them
+
+        assert not exists(self.step), 'previous step was not ended'
+
+        seq_ids = list(default(seq_ids, self.batch))
+        batch_size, block_size, device = len(seq_ids), self.block_size, self.device
+
+        if isinstance(num_new, int):
+            num_new = [num_new] * batch_size
+
+        num_new = [int(n) for n in num_new]
+        assert len(num_new) == batch_size
+
+        for seq_id, n in zip(seq_ids, num_new):
+            blocks = self.blocks[seq_id]
+            num_needed = ceil((self.lengths[seq_id] + n) / block_size) - len(blocks)
+
+            assert num_needed <= len(self.free_blocks), f'paged cache is out of blocks, {num_needed} more needed but only {len(self.free_blocks)} free'
+
+            for _ in range(num_needed):
+                blocks.append(self.free_blocks.pop())
+
+        seq_len = max([self.lengths[seq_id] for seq_id in seq_ids], default = 0)
+
+        lengths = torch.tensor([self.lengths[seq_id] for seq_id in seq_ids], device = device, dtype = torch.long)
+        num_new = torch.tensor(num_new, device = device, dtype = torch.long)
+
+        max_new = int(num_new.amax()) if batch_size > 0 else 0
+        width = seq_len + max_new
+
+        # blocks read for each sequence, the keys / values are gathered by the block rather than by the position
+        # blocks past the end of a sequence are block 0, which is read and masked out
+
+        num_read_blocks = ceil(width / block_size)
+        table = torch.tensor([self.blocks[seq_id][:num_read_blocks] + [0] * (num_read_blocks - len(self.blocks[seq_id])) for seq_id in seq_ids], device = device, dtype = torch.long)
+        table = table.reshape(batch_size, num_read_blocks)
+
+        pos = torch.arange(width, device = device)
+
+        seq_ends = lengths + num_new
+        kv_mask = pos < seq_ends[:, None]
+
+        # new positions, right padded to the most new positions in the batch
+
+        new_arange = torch.arange(max_new, device = device)
+        query_positions = (lengths[:, None] + new_arange).clamp(max = max(width - 1, 0))
+        write_mask = new_arange < num_new[:, None]
+
+        write_slots = table.gather(1, query_positions // block_size) * block_size + query_positions % block_size
+        write_slots = write_slots[write_mask]
+
+        causal_mask = pos <= query_positions[..., None]
+        attn_mask = rearrange(kv_mask, 'b j -> b 1 1 j') & rearrange(causal_mask, 'b i j -> b 1 i j')
+
+        self.step = PagedStep(
+            seq_ids = seq_ids,
+            seq_len = seq_len,
+            num_new = num_new,
+            write_slots = write_slots,
+            write_mask = write_mask,
+            kv_blocks = table,
+            width = width,
+            query_positions = query_positions,
+            attn_mask = attn_mask
+        )
+
+        return self.step
+
+    def end_step(self):
+        assert exists(self.step), 'no step to end'
+
+        for seq_id, n in zip(self.step.seq_ids, self.step.num_new.tolist()):
+            self.lengths[seq_id] += n
+
+        self.step = None
+
+class PagedKVCache:
+    """
+    paged keys / values of one attention layer - a pool of blocks shared by all sequences of the batch, addressed through the block table
+    memory is allocated by the block, so it grows with the tokens of each sequence rather than with the longest one
+
+    it plugs into the existing cache interface, in place of the (keys, values) tuple at LayerIntermediates.attn_intermediates[i].cached_kv
+    each step, the new keys / values are written to the slots of their sequence, and the keys / values of all positions are gathered back, a block at a time,
+    into a dense right padded tensor, with a mask over the padding, so any attention backend (math or flash / sdpa) can consume them
+
+    with quantize, the pools are int8 with a scale per slot and head, same as the static cache
+    """
+
+    def __init__(
+        self,
+        block_table: BlockTable,
+        heads: int,
+        dim_head: int,
+        value_heads: Optional[int] = None,
+        value_dim_head: Optional[int] = None,
+        dtype = None,
+        quantize = False
+    ):
+        self.block_table = block_table
+        self.quantize = quantize
+
+        num_slots = block_table.num_blocks * block_table.block_size
+        value_heads, value_dim_head = default(value_heads, heads), default(value_dim_head, dim_head)
+
+        # slots past the end of a sequence are read and masked out, so are zeroed to keep them finite
+
+        self.buffers = kv_buffers(
+            (num_slots, heads, dim_head),
+            (num_slots, value_heads, value_dim_head),
+            quantize = quantize,
+            device = block_table.device,
+            dtype = dtype
+        )
+
+        for buffer in self.buffers:
+            buffer.zero_()
+
+    @property
+    def seq_len(self):
+        return self.block_table.seq_len
+
+    @property
+    def step(self):
+        step = self.block_table.step
+        assert exists(step), 'begin_step must be called on the block table before each forward with a paged cache'
+        return step
+
+    @property
+    def query_positions(self):
+        return self.step.query_positions
+
+    @property
+    def attn_mask(self):
+        return self.step.attn_mask
+
+    def write(self, k: Tensor, v: Tensor):
+        # k, v of the (right padded) new positions, of shape (batch, heads, n, dim head)
+
+        step = self.step
+        k, v = map(lambda t: rearrange(t, 'b h n d -> b n h d')[step.write_mask], (k, v))
+
+        for buffer, t in zip(self.buffers, encode_kv(k, v, quantize = self.quantize)):
+            buffer.index_copy_(0, step.write_slots, t.to(buffer.dtype))
+
+    def gather(self):
+        # copies whole blocks of the pool at once, only those of the sequences in the step, up to the longest of them
+
+        step = self.step
+        block_size = self.block_table.block_size
+
+        gathered = [rearrange(t, '(blocks n) ... -> blocks n ...', n = block_size)[step.kv_blocks] for t in self.buffers]
+        gathered = [rearrange(t, 'b blocks n ... -> b (blocks n) ...')[:, :step.width] for t in gathered]
+
+        k, v = decode_kv(gathered, quantize = self.quantize)
+        return rearrange(k, 'b n h d -> b h n d'), rearrange(v, 'b n h d -> b h n d')
+
+    def append(self, k: Tensor, v: Tensor):
+        # writes the keys / values of the new positions, and returns the keys / values of all positions, right padded
+
+        self.write(k, v)
+        return self.gather()
+
+def to_paged_kv_cache(cache, lengths, num_blocks = None, block_size = 16, self_attn = None, quantize = False):
+    # turns the key / value tuples of a cache returned from the network on right padded prompts into paged caches sharing one block table
+    # only the first `lengths[i]` positions of each row are kept. cross attention layers (self_attn[i] = False) are left as is
+
+    attn_intermediates = cache.attn_intermediates
+    self_attn = default(self_attn, [True] * len(attn_intermediates))
+
+    lengths = lengths.tolist()
+    num_blocks = default(num_blocks, sum([ceil(length / block_size) for length in lengths]))
+
+    k = next(inter.cached_kv[0] for inter, is_self_attn in zip(attn_intermediates, self_attn) if is_self_attn)
+    block_table = BlockTable(num_blocks, block_size = block_size, device = k.device)
+
+    for _ in lengths:
+        block_table.add_sequence()
+
+    block_table.begin_step(lengths)
+
+    for inter, is_self_attn in zip(attn_intermediates, self_attn):
+        if not is_self_attn or not exists(inter.cached_kv):
+            continue
+
+        ck, cv = inter.cached_kv
+        paged = PagedKVCache(block_table, ck.shape[1], ck.shape[-1], cv.shape[1], cv.shape[-1], dtype = ck.dtype, quantize = quantize)
+        paged.write(ck[..., :block_table.step.write_mask.shape[-1], :], cv[..., :block_table.step.write_mask.shape[-1], :])
+        inter.cached_kv = paged
+
+    block_table.end_step()
+    return cache, block_table
+
+# streaming key / value cache, keeping a fixed budget of positions picked by an eviction policy
+
+class EvictionPolicy:
+    # picks the cached positions to keep, as indices in order - shared by all rows and heads of shape (num_keep,), or of shape (b, h, num_keep)
+
+    uses_attn = False   # whether the policy ranks positions by the attention they received, which the cache then accumulates
+
+    def keep(self, length: int, num_keep: int, scores: Optional[Tensor] = None, device = None) -> Tensor:
+        raise NotImplementedError
+
+class RecentWindow(EvictionPolicy):
+    # keeps the most recent positions
+
+    def keep(self, length, num_keep, scores = None, device = None):
+        return torch.arange(length - num_keep, length, device = device)
+
+class AttentionSinks(EvictionPolicy):
+    # keeps the first positions, which attention piles onto, and the most recent ones - StreamingLLM https://arxiv.org/abs/2309.17453
+
+    def __init__(self, num_sinks = 4):
+        self.num_sinks = num_sinks
+
+    def keep(self, length, num_keep, scores = None, device = None):
+        num_sinks = min(self.num_sinks, num_keep)
+        return torch.cat((torch.arange(num_sinks, device = device), torch.arange(length - num_keep + num_sinks, length, device = device)))
+
+class HeavyHitters(EvictionPolicy):
+    # keeps the most recent positions, and of the others, the ones that received the most attention so far, per head - H2O https://arxiv.org/abs/2306.14048
+
+    uses_attn = True
+
+    def __init__(self, num_recent: Optional[int] = None):
+        self.num_recent = num_recent    # defaults to half the budget
+
+    def keep(self, length, num_keep, scores = None, device = None):
+        num_recent = min(default(self.num_recent, num_keep // 2), num_keep)
+        num_heavy = num_keep - num_recent
+
+        heavy = scores[..., :(length - num_recent)].topk(num_heavy, dim = -1).indices.sort(dim = -1).values
+        recent = torch.arange(length - num_recent, length, device = device).expand(*heavy.shape[:-1], num_recent)
+
+        return torch.cat((heavy, recent), dim = -1)
+
+def attention_received(q: Tensor, k: Tensor, scale: float):
+    # attention each key received from the queries, the last of the keys, summed over the queries and the query heads sharing each key head
+
+    n, j, kv_heads = q.shape[-2], k.shape[-2], k.shape[1]
+
+    q = rearrange(q, 'b (r h) i d -> b h (r i) d', h = kv_heads)
+    sim = torch.einsum('b h i d, b h j d -> b h i j', q, k) * scale
+
+    query_positions = (torch.arange(n, device = q.device) + j - n).repeat(q.shape[-2] // n)
+    causal_mask = torch.arange(j, device = q.device) > rearrange(query_positions, 'i -> i 1')
+
+    sim = sim.masked_fill(causal_mask, -torch.finfo(sim.dtype).max)
+    return sim.softmax(dim = -1).sum(dim = -2)
+
+def select_positions(t: Tensor, indices: Tensor):
+    if indices.ndim == 1:
+        return t.index_select(-2, indices)
+
+    return t.gather(-2, indices[..., None].expand(*indices.shape, t.shape[-1]))
+
+class StreamingKVCache:
+    """
+    key / value cache for one attention layer, holding at most max_len positions, the current ones included, for decoding with constant memory and
+    latency however long the generation. it plugs into the existing cache interface, in place of the (keys, values) tuple
+
+    after the attention of every step, the positions the eviction policy does not keep are dropped, down to max_len - 1 to leave room for the next one
+    keys are cached before rotary embeddings, so the kept keys are embedded at consecutive positions every step, the same as the alibi / relative position
+    biases which only depend on the number of keys
+    """
+
+    def __init__(
+        self,
+        max_len: int,
+        policy: Optional[EvictionPolicy] = None
+    ):
+        assert max_len > 1
+
+        self.max_len = max_len
+        self.policy = default(policy, AttentionSinks())
+
+        self.k = None
+        self.v = None
+        self.scores = None      # accumulated attention received by each cached position, per key head, for policies ranking by it
+        self.num_evicted = 0
+
+    @property
+    def seq_len(self):
+        return self.k.shape[-2] if exists(self.k) else 0
+
+    @property
+    def cached_kv(self):
+        return self.k, self.v
+
+    def __iter__(self):
+        return iter(self.cached_kv)
+
+    def __getitem__(self, index):
+        return self.cached_kv[index]
+
+    def append(self, k: Tensor, v: Tensor):
+        # returns the cached keys / values followed by the new ones, which the new positions attend to
+
+        if exists(self.k):
+            k, v = torch.cat((self.k, k), dim = -2), torch.cat((self.v, v), dim = -2)
+
+        if self.policy.uses_attn:
+            num_new = k.shape[-2] - self.seq_len
+            self.scores = F.pad(self.scores, (0, num_new), value = 0.) if exists(self.scores) else k.new_zeros(k.shape[:-1], dtype = torch.float)
+
+        self.k, self.v = k, v
+        return k, v
+
+    def evict(self, q: Optional[Tensor] = None, k: Optional[Tensor] = None, scale: Optional[float] = None):
+        # called after the keys are embedded with the queries of the step - accumulates the attention they received if the policy needs it, then evicts
+
+        if self.policy.uses_attn:
+            scale = default(scale, q.shape[-1] ** -0.5)
+            self.scores = self.scores + attention_received(q, k[..., -self.seq_len:, :], scale).float()
+
+        length, num_keep = self.seq_len, self.max_len - 1
+
+        if length <= num_keep:
+            return
+
+        indices = self.policy.keep(length, num_keep, scores = self.scores, device = self.k.device)
+
+        self.k, self.v = select_positions(self.k, indices), select_positions(self.v, indices)
+
+        if exists(self.scores):
+            self.scores = self.scores.gather(-1, indices) if indices.ndim > 1 else self.scores.index_select(-1, indices)
+
+        self.num_evicted += length - num_keep
+
+    def reorder(self, indices: Tensor):
+        # selects the given rows of the batch
+
+        self.k, self.v = self.k.index_select(0, indices), self.v.index_select(0, indices)
+        self.scores = self.scores.index_select(0, indices) if exists(self.scores) else None
+
+# reordering the batch of a cache
+
+def reorder_cached_kv(cache, indices: Tensor):
+    # selects the given rows of the batch of every cached key / values - for beam search, or dropping finished rows from the batch
+
+    if isinstance(cache, (tuple, list)):
+        for inner in cache:
+            reorder_cached_kv(inner, indices)
+        return
+
+    for inter in cache.attn_intermediates:
+        assert not isinstance(inter.cached_kv, PagedKVCache), 'paged caches share blocks by sequence, and cannot be reordered'
+
+        if isinstance(inter.cached_kv, (StaticKVCache, StreamingKVCache)):
+            inter.cached_kv.reorder(indices)
+            continue
+
+        inter.cached_kv = [t.index_select(0, indices) for t in inter.cached_kv]
+
+# prefix key / value cache, shared across generate calls
+
+def iter_cached_kv(cache):
+    # the cached key / values of a cache in order - a LayerIntermediates, or the tuples / lists of them nested by the multi-IO wrapper
+
+    if isinstance(cache, (tuple, list)):
+        for inner in cache:
+            yield from iter_cached_kv(inner)
+        return
+
+    for inter in cache.attn_intermediates:
+        yield inter.cached_kv
+
+def map_cached_kv(cache, fn):
+    # a new cache of the same structure, with fn applied to each cached key / values, in order
+
+    if isinstance(cache, (tuple, list)):
+        return type(cache)(map_cached_kv(inner, fn) for inner in cache)
+
+    return type(cache)(attn_intermediates = [type(inter)(cached_kv = fn(inter.cached_kv)) for inter in cache.attn_intermediates])
+
+@dataclass
+class PrefixBlock:
+    parent_key: Optional[int]
+    tokens: tuple
+    kv: list                    # (keys, values) of the block for every attention layer, of shape (heads, block size, dim head)
+    num_bytes: int
+
+class PrefixKVCache:
+    """
+    cached keys / values of token prefixes, shared across generate calls of one network, so that requests starting with the same tokens
+    (system prompts, conditioning streams) only prefill what comes after them
+
+    prefixes are stored by the block of `block_size` tokens, each block keyed by the hash of its tokens and of the key of the block before it,
+    so prefixes that diverge share their common blocks. blocks are evicted least recently used first once over `max_bytes`,
+    and are refreshed children first, so a block is never evicted before the blocks that extend it
+
+    tokens can be (batch, seq) or the (batch, seq, streams) of the multi-IO wrapper - only the tokens are keyed on, so the network
+    must be the same across calls, and not conditioned on anything else (cross attention context, memories)
+    """
+
+    def __init__(
+        self,
+        block_size: int = 16,
+        max_bytes: int = 2 ** 30
+    ):
+        self.block_size = block_size
+        self.max_bytes = max_bytes
+
+        self.blocks = OrderedDict()
+        self.num_bytes = 0
+        self.template = None
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def stats(self):
+        return dict(hits = self.hits, misses = self.misses, evictions = self.evictions, num_blocks = len(self.blocks), num_bytes = self.num_bytes)
+
+    def block_keys(self, tokens: Tensor, max_len: int):
+        # keys and tokens of the full blocks of one row, up to max_len tokens
+
+        keys, parent_key = [], None
+
+        for start in range(0, max_len - self.block_size + 1, self.block_size):
+            block_tokens = tuple(tokens[start:(start + self.block_size)].flatten().tolist())
+            key = hash((parent_key, block_tokens))
+            keys.append((key, parent_key, block_tokens))
+            parent_key = key
+
+        return keys
+
+    def touch(self, keys):
+        for key, *_ in reversed(keys):
+            self.blocks.move_to_end(key)
+
+    def lookup(self, prompts: Tensor):
+        """
+        finds the longest prefix of whole blocks cached for every row of the prompts, leaving at least one token to prefill
+        returns a cache seeded with its keys / values and its length, or (None, 0) if there is none
+        """
+
+        batch, seq_len = prompts.shape[:2]
+        max_len = seq_len - 1
+
+        rows = []
+        for row in prompts:
+            found = []
+
+            for key, parent_key, block_tokens in self.block_keys(row, max_len):
+                block = self.blocks.get(key)
+
+                if not exists(block) or block.parent_key != parent_key or block.tokens != block_tokens:
+                    break
+
+                found.append((key, block))
+
+            rows.append(found)
+
+        num_blocks = min(map(len, rows))
+        num_full_blocks = max_len // self.block_size
+
+        self.hits += num_blocks * batch
+        self.misses += (num_full_blocks - num_blocks) * batch
+
+        if num_blocks == 0:
+            return None, 0
+
+        for found in rows:
+            self.touch(found[:num_blocks])
+
+        # concatenate the blocks of each row, then stack the rows, for every attention layer
+
+        layers_kv = []
+        for layer_index in range(len(rows[0][0][1].kv)):
+            layer_kv = []
+
+            for kv_index in range(2):
+                rows_t = [torch.cat([block.kv[layer_index][kv_index] for _, block in found[:num_blocks]], dim = -2) for found in rows]
+                layer_kv.append(torch.stack(rows_t))
+
+            layers_kv.append(tuple(layer_kv))
+
+        layers_kv = iter(layers_kv)
+        cache = map_cached_kv(self.template, lambda _: next(layers_kv))
+
+        return cache, num_blocks * self.block_size
+
+    def insert(self, prompts: Tensor, cache):
+        # stores the keys / values of every full block of the prompts, from the cache returned by the network on them
+
+        batch, seq_len = prompts.shape[:2]
+        layers_kv = list(iter_cached_kv(cache))
+
+        self.template = map_cached_kv(cache, lambda _: None)
+
+        for row_index, row in enumerate(prompts):
+            keys = self.block_keys(row, seq_len)
+
+            for block_index, (key, parent_key, block_tokens) in enumerate(keys):
+                if key in self.blocks:
+                    continue
+
+                start = block_index * self.block_size
+                kv = [tuple(t[row_index, :, start:(start + self.block_size)].clone() for t in layer_kv) for layer_kv in layers_kv]
+                num_bytes = sum(t.numel() * t.element_size() for layer_kv in kv for t in layer_kv)
+
+                self.blocks[key] = PrefixBlock(parent_key = parent_key, tokens = block_tokens, kv = kv, num_bytes = num_bytes)
+                self.num_bytes += num_bytes
+
+            self.touch(keys)
+
+        self.evict()
+
+    def evict(self):
+        while self.num_bytes > self.max_bytes and len(self.blocks) > 0:
+            _, block = self.blocks.popitem(last = False)
+            self.num_bytes -= block.num_bytes
+            self.evictions += 1
+
+    def clear(self):
+        self.blocks.clear()
+        self.num_bytes = 0
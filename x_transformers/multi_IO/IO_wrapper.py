@@ -1,7 +1,348 @@
 from x_transformers.x_transformers import *
+from dataclasses import is_dataclass, fields
+
+import atexit
+from contextlib import ExitStack
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+
+from torch.nn.utils.rnn import pad_sequence
+
 from x_transformers.x_transformers import AttentionLayers
 
 
+def iter_layer_intermediates(cache):
+    # the cache of the multi-IO wrapper nests the LayerIntermediates of the input, main and output attention layers
+    # as (cache_pre, cache_model, cache_post), where the input and output entries are lists with one per stream
+
+    if isinstance(cache, LayerIntermediates):
+        yield cache
+        return
+
+    for inter in cache:
+        yield from iter_layer_intermediates(inter)
+
+
+# packed token embedding - one table for all streams
+
+class PackedTokenEmbedding(nn.Module):
+    def __init__(self, dim, num_tokens: List[int], l2norm_embed=False):
+        """
+        the token embeddings of all streams in a single table, with the vocabulary of each stream offset by the ones before it
+        a [b, n, streams] input is embedded with one gather into [b, n, streams, dim], which is already the concatenated layout
+        checkpoints with the per-stream TokenEmbedding keys (token_emb.{i}.emb.weight) are packed on load
+        """
+        super().__init__()
+        self.l2norm_embed = l2norm_embed
+        self.num_tokens = num_tokens
+        self.emb = nn.Embedding(sum(num_tokens), dim)
+
+        offsets = torch.tensor([0, *num_tokens[:-1]]).cumsum(dim=-1)
+        self.register_buffer('offsets', offsets, persistent=False)
+        self.register_buffer('padding_idx', None, persistent=False)
+
+        self._register_load_state_dict_pre_hook(self.pack_per_stream_state_dict)
+
+    def pack_per_stream_state_dict(self, state_dict, prefix, *args):
+        per_stream_keys = [f'{prefix}{i}.emb.weight' for i in range(len(self.num_tokens))]
+
+        if all(key in state_dict for key in per_stream_keys):
+            state_dict[f'{prefix}emb.weight'] = torch.cat([state_dict.pop(key) for key in per_stream_keys], dim=0)
+
+    def set_padding_idx(self, padding_idx: List[int]):
+        # same as the padding_idx of nn.Embedding, the padding tokens of each stream do not receive gradients
+        self.padding_idx = torch.tensor(padding_idx, device=self.offsets.device) + self.offsets
+
+    def forward(self, x):
+        ids = x.long() + self.offsets
+        token_emb = self.emb(ids)
+
+        if exists(self.padding_idx) and token_emb.requires_grad:
+            is_padding = (ids == self.padding_idx).unsqueeze(-1)
+            token_emb = torch.where(is_padding, token_emb.detach(), token_emb)
+
+        return l2norm(token_emb) if self.l2norm_embed else token_emb
+
+
+# fused output projection - the logits of all heads in one matmul
+
+class FusedToLogits(nn.Module):
+    def __init__(self, dim, logits_dim: List[int]):
+        """
+        the output projections of all heads stacked into one [heads, max logits dim, dim] weight, zero padded
+        the logits of all heads are computed with a single matmul and returned as per-head views
+        checkpoints with the per-head nn.Linear keys (to_logits.{i}.weight) are stacked on load
+        """
+        super().__init__()
+        self.logits_dim = logits_dim
+
+        weight = torch.zeros(len(logits_dim), max(logits_dim), dim)
+        for i, head_logits_dim in enumerate(logits_dim):
+            weight[i, :head_logits_dim] = nn.Linear(dim, head_logits_dim, bias=False).weight.data
+
+        self.weight = nn.Parameter(weight)
+
+        self._register_load_state_dict_pre_hook(self.stack_per_head_state_dict)
+
+    def stack_per_head_state_dict(self, state_dict, prefix, *args):
+        per_head_keys = [f'{prefix}{i}.weight' for i in range(len(self.logits_dim))]
+
+        if all(key in state_dict for key in per_head_keys):
+            state_dict[f'{prefix}weight'] = pad_sequence([state_dict.pop(key) for key in per_head_keys], batch_first=True)
+
+    def forward(self, x: Union[Tensor, List[Tensor]]):
+        # a single input is shared by all heads, a list holds one input per head
+
+        if isinstance(x, Tensor):
+            logits = einsum('b n d, h l d -> h b n l', x, self.weight)
+        else:
+            logits = einsum('h b n d, h l d -> h b n l', torch.stack(x), self.weight)
+
+        return [head_logits[..., :head_logits_dim] for head_logits, head_logits_dim in zip(logits, self.logits_dim)]
+
+
+def set_token_emb_padding_idx(token_emb, pad_value: Tensor):
+    if isinstance(token_emb, PackedTokenEmbedding):
+        token_emb.set_padding_idx([int(pad) for pad in pad_value])
+        return
+
+    for i, stream_token_emb in enumerate(token_emb):
+        stream_token_emb.padding_idx = int(pad_value[i])
+        stream_token_emb.emb.padding_idx = int(pad_value[i])
+
+
+# concurrent execution of independent branches
+
+_branch_executors = dict()
+
+
+def get_branch_executor(num_threads, intra_op_threads: Optional[int] = None):
+    # one bounded thread pool per thread count and intra-op thread count of its workers, shared across modules and kept out of their state
+    # the intra-op thread count of a worker is set once, as it starts, and never changes after
+
+    key = (num_threads, intra_op_threads)
+
+    if key not in _branch_executors:
+        initializer = partial(torch.set_num_threads, intra_op_threads) if exists(intra_op_threads) else None
+        _branch_executors[key] = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix='multi_io_branch', initializer=initializer)
+    return _branch_executors[key]
+
+
+@atexit.register
+def shutdown_branch_executors():
+    for executor in _branch_executors.values():
+        executor.shutdown(wait=False)
+
+    _branch_executors.clear()
+
+
+def autocast_states():
+    # the device types autocast is enabled for on the calling thread, with their dtype
+
+    if version.parse(torch.__version__) >= version.parse('2.4.0'):
+        states = [(device_type, torch.is_autocast_enabled(device_type), torch.get_autocast_dtype(device_type)) for device_type in ('cuda', 'cpu')]
+    else:
+        states = [('cuda', torch.is_autocast_enabled(), torch.get_autocast_gpu_dtype()),
+                  ('cpu', torch.is_autocast_cpu_enabled(), torch.get_autocast_cpu_dtype())]
+
+    return [(device_type, dtype) for device_type, enabled, dtype in states if enabled]
+
+
+def run_branches(fns: List[Callable], num_threads=0, intra_op_threads: Optional[int] = None):
+    """
+    calls each of the independent branch functions and returns their results in order
+    with num_threads > 0, the branches run concurrently on a bounded thread pool, with one of them on the calling thread
+    pytorch releases the GIL inside its ops, and autograd records the branches as usual
+
+    with intra_op_threads, the ops of the branches on the worker threads run on that many threads, set once for each worker as it starts
+    the intra-op threads of the calling thread are left to the caller (torch.set_num_threads), as any change to them would be process wide
+    """
+    if num_threads <= 0 or len(fns) < 2:
+        return [fn() for fn in fns]
+
+    # grad mode, inference mode and autocast are thread local, so carry them over to the worker threads
+
+    grad_enabled = torch.is_grad_enabled()
+    inference_mode = torch.is_inference_mode_enabled()
+    autocasts = autocast_states()
+    autocast_cache_enabled = torch.is_autocast_cache_enabled()
+
+    def run(fn):
+        with ExitStack() as stack:
+            stack.enter_context(torch.inference_mode(inference_mode))
+            stack.enter_context(torch.set_grad_enabled(grad_enabled))
+
+            for device_type, dtype in autocasts:
+                stack.enter_context(torch.autocast(device_type, dtype=dtype, cache_enabled=autocast_cache_enabled))
+
+            return fn()
+
+    executor = get_branch_executor(num_threads, intra_op_threads)
+    futures = [executor.submit(run, fn) for fn in fns[1:]]
+
+    try:
+        first = fns[0]()
+        return [first, *(future.result() for future in futures)]
+    finally:
+        wait_futures(futures)
+
+
+# horizontally fused input attention layers
+
+CONFIG_TYPES = (bool, int, float, str, tuple, type(None))
+
+
+def attn_layers_signature(attn_layers: AttentionLayers):
+    # the structure of a module tree - its hyperparameters and the shapes of its parameters and buffers
+
+    signature = []
+    for name, module in attn_layers.named_modules():
+        config = {key: value for key, value in vars(module).items() if isinstance(value, CONFIG_TYPES)}
+        params = [(key, t.shape, t.dtype) for key, t in module.named_parameters(recurse=False)]
+        buffers = [(key, t.shape, t.dtype) for key, t in module.named_buffers(recurse=False)]
+        signature.append((name, type(module), config, params, buffers))
+    return signature
+
+
+def can_fuse_attn_layers(attn_layers: torch.nn.ModuleList):
+    if len(attn_layers) < 2:
+        return False
+
+    # alibi registers its bias as a buffer during the forward, which cannot be done under vmap
+
+    if any(isinstance(module, AlibiPositionalBias) for module in attn_layers[0].modules()):
+        return False
+
+    signature = attn_layers_signature(attn_layers[0])
+    return all(attn_layers_signature(layers) == signature for layers in attn_layers[1:])
+
+
+def intermediates_to_tree(obj):
+    # vmap can only return tensors, so the intermediates are turned into nested dicts of the fields that are set
+
+    if is_dataclass(obj):
+        return {field.name: intermediates_to_tree(getattr(obj, field.name)) for field in fields(obj)
+                if exists(getattr(obj, field.name))}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(map(intermediates_to_tree, obj))
+    return obj
+
+
+def tree_to_intermediates(tree):
+    attn_intermediates = [Intermediates(**inter) for inter in tree.get('attn_intermediates', [])]
+    return LayerIntermediates(**{**tree, 'attn_intermediates': attn_intermediates})
+
+
+def tree_map(fn, tree):
+    if isinstance(tree, dict):
+        return {key: tree_map(fn, value) for key, value in tree.items()}
+    if isinstance(tree, (list, tuple)):
+        return type(tree)(tree_map(fn, value) for value in tree)
+    return fn(tree)
+
+
+def stack_views(tensors: List[Tensor]):
+    # stacks the tensors along a new leading dimension - as a view, without a copy, when they are evenly spaced views of one storage,
+    # as the per stream cached key / values returned by the previous fused forward are, however they were sliced since
+
+    first = tensors[0]
+    step = tensors[1].storage_offset() - first.storage_offset()
+
+    is_view = all(
+        t.untyped_storage().data_ptr() == first.untyped_storage().data_ptr() and
+        t.dtype == first.dtype and
+        t.shape == first.shape and
+        t.stride() == first.stride() and
+        t.storage_offset() == (first.storage_offset() + i * step)
+        for i, t in enumerate(tensors)
+    )
+
+    if not is_view:
+        return torch.stack(tensors)
+
+    return first.as_strided((len(tensors), *first.shape), (step, *first.stride()), first.storage_offset())
+
+
+class StackedWeights:
+    """
+    the parameters and buffers of structurally identical modules, stacked along a new leading dimension to be vmapped over
+    without grad, as when decoding, the stacked weights are kept, and only stacked again once any of the weights is changed in place or replaced
+    with grad, they are stacked on every call, for the gradients to flow back to the weights of each module
+    """
+
+    def __init__(self):
+        self.versions = None
+        self.stacked = None
+
+    def stack(self, modules):
+        named_params = [dict(module.named_parameters()) for module in modules]
+        named_buffers = [dict(module.named_buffers()) for module in modules]
+
+        params = {name: torch.stack([p[name] for p in named_params]) for name in named_params[0]}
+        buffers = {name: torch.stack([b[name] for b in named_buffers]) for name in named_buffers[0]}
+        return params, buffers
+
+    def __call__(self, modules):
+        tensors = [t for module in modules for t in (*module.parameters(), *module.buffers())]
+
+        if torch.is_grad_enabled() and any(t.requires_grad for t in tensors):
+            return self.stack(modules)
+
+        versions = [(t.data_ptr(), t._version) for t in tensors]
+
+        if versions != self.versions:
+            self.stacked = self.stack(modules)
+            self.versions = versions
+
+        return self.stacked
+
+
+def fused_attn_layers_forward(attn_layers: torch.nn.ModuleList, xs: List[Tensor], caches=None,
+                              stacked_weights: Optional[StackedWeights] = None, **kwargs):
+    """
+    runs structurally identical attention layers, one per stream, as a single computation
+    the weights are stacked and the stream becomes an extra batch axis through vmap
+    returns the per stream outputs and LayerIntermediates, same as calling the layers one after another
+    the per stream cached key / values returned are views of the stacked ones, which the next step takes back without a copy
+    """
+    from torch.func import functional_call, vmap
+
+    params, buffers = default(stacked_weights, StackedWeights())(attn_layers)
+
+    # only the cached key / values are needed from the caches of the previous step
+
+    cache = None
+    if exists(caches):
+        cache = dict(attn_intermediates=[
+            dict(cached_kv=tuple(map(stack_views, zip(*stream_kvs))))
+            for stream_kvs in zip(*[[inter.cached_kv for inter in c.attn_intermediates] for c in caches])
+        ])
+
+    template = attn_layers[0]
+
+    # the rotary cos / sin are the same for every stream, and are computed outside of vmap, where their table can be cached
+    # positions span the cached keys when decoding, same as in AttentionLayers.forward (memories are not fused)
+
+    if exists(template.rotary_pos_emb) and not exists(kwargs.get('rotary_pos_emb')):
+        seq_len, cache_age = xs[0].shape[-2], kwargs.get('cache_age', 1)
+
+        if exists(caches) and cache_age > 0:
+            seq_len = template.get_cached_seq_len(caches[0]) + min(cache_age, seq_len)
+
+        kwargs = dict(kwargs, rotary_pos_emb=template.rotary_pos_emb.forward_cos_sin(0, seq_len))
+
+    def run(params, buffers, x, cache):
+        cache = tree_to_intermediates(cache) if exists(cache) else None
+        out, intermediates = functional_call(template, (params, buffers), (x,),
+                                             dict(cache=cache, return_hiddens=True, **kwargs))
+        return out, intermediates_to_tree(intermediates)
+
+    in_dims = (0, 0, 0, 0 if exists(cache) else None)
+    out, intermediates = vmap(run, in_dims=in_dims, randomness='different')(params, buffers, torch.stack(xs), cache)
+
+    intermediates = [tree_to_intermediates(tree_map(lambda t: t[i], intermediates)) for i in range(len(xs))]
+    return list(out.unbind(dim=0)), intermediates
+
+
 class MultiIOTransformerWrapper(nn.Module):
     def __init__(
             self,
@@ -19,6 +360,11 @@ class MultiIOTransformerWrapper(nn.Module):
             emb_dropout=0.,
             post_emb_norm=False,
             output_attn_layers: torch.nn.ModuleList = None,
+            fuse_input_attn_layers=False,
+            packed_token_emb=False,
+            fused_logits=False,
+            branch_threads=0,
+            branch_intra_op_threads=None,
             # num_memory_tokens=None,
             # memory_tokens_interspersed_every=None,
             tie_embedding=False,
@@ -42,6 +388,12 @@ class MultiIOTransformerWrapper(nn.Module):
                 autoregressive and type(num_tokens) == list)
         self.autoregressive = autoregressive
         self.max_seq_len = max_seq_len
+
+        # number of threads to run the independent input / output attention layers of the streams concurrently, 0 runs them in order
+        # and the intra-op threads of the worker threads, by default left as they are. the calling thread keeps its own
+
+        self.branch_threads = branch_threads
+        self.branch_intra_op_threads = branch_intra_op_threads
         if not self.multi_input:
             self.model = TransformerWrapper(
                 num_tokens=num_tokens,
@@ -66,6 +418,10 @@ class MultiIOTransformerWrapper(nn.Module):
             self.pre_attn_layers = None
             self.post_attn_layers = None
 
+            self.can_cache_kv = self.model.can_cache_kv
+            self.can_cache_kv_outside_max_seq_len = self.model.can_cache_kv_outside_max_seq_len
+            self.can_slide_cache_kv = self.model.can_slide_cache_kv
+
         else:
             self.emb_dim = emb_dim if (input_attn_layers is None) else [layer.dim for layer in input_attn_layers]
             self.num_tokens = num_tokens
@@ -97,11 +453,30 @@ class MultiIOTransformerWrapper(nn.Module):
                 self.pre_attn_layers_map = nn.Identity()
             self.concat_emb_dim = concat_emb_dim
 
+            # structurally identical input attention layers can be run as one batched computation over the streams
+
+            self.fuse_pre_attn_layers = False
+            if fuse_input_attn_layers and input_attn_layers is not None:
+                assert version.parse(torch.__version__) >= version.parse('2.0.0'), \
+                    'in order to fuse the input attention layers, you must be using pytorch 2.0 or above'
+                self.fuse_pre_attn_layers = can_fuse_attn_layers(input_attn_layers)
+                self.stacked_pre_attn_weights = StackedWeights()
+                if not self.fuse_pre_attn_layers:
+                    print('Note: The input_attn_layers are not structurally identical (or use ALiBi), so they cannot be '
+                          'fused and will be run one after another.')
+
             self.l2norm_embed = l2norm_embed
 
-            self.token_emb = torch.nn.ModuleList(
-                [TokenEmbedding(self.emb_dim[i], num_tokens[i], l2norm_embed=l2norm_embed) for i in
-                 range(len(num_tokens))])
+            self.packed_token_emb = packed_token_emb
+            if packed_token_emb:
+                assert type(num_tokens) == list, 'num_tokens must be a list of number of tokens for each input'
+                assert len(set(self.emb_dim)) == 1, 'all streams must have the same embedding dimension to pack their embeddings'
+                assert not tie_embedding, 'packed token embeddings cannot be tied to the output logits'
+                self.token_emb = PackedTokenEmbedding(self.emb_dim[0], num_tokens, l2norm_embed=l2norm_embed)
+            else:
+                self.token_emb = torch.nn.ModuleList(
+                    [TokenEmbedding(self.emb_dim[i], num_tokens[i], l2norm_embed=l2norm_embed) for i in
+                     range(len(num_tokens))])
 
             no_abs_pos_emb = max_seq_len == 0 or not (use_abs_pos_emb and not attn_layers.disable_abs_pos_emb)
 
@@ -153,12 +528,21 @@ class MultiIOTransformerWrapper(nn.Module):
 
             self.attn_layers = attn_layers
 
+            # whether the packed embeddings can skip the per-stream embedding steps and be used as the concatenated layout
+
+            self.packed_emb_is_concat = packed_token_emb and not exists(self.embeds) and all(
+                isinstance(module, nn.Identity) for module in (*self.post_emb_norm, *self.project_emb))
+
             self.init_()
 
-            # memory tokens (like [cls]) from Memory Transformers paper
+            # memory tokens (like [cls]) from Memory Transformers paper are not supported yet
+            # token shifting mixes in the previous positions, which a cached forward over the new tokens alone does not have
 
-            # self.can_cache_kv = self.num_memory_tokens == 0
-            # self.can_cache_kv_outside_max_seq_len = no_abs_pos_emb
+            stream_attn_layers = [*(input_attn_layers if input_attn_layers is not None else []), *(output_attn_layers if output_attn_layers is not None else [])]
+
+            self.can_cache_kv = not any(layers.has_shift_tokens for layers in (attn_layers, *stream_attn_layers))
+            self.can_cache_kv_outside_max_seq_len = no_abs_pos_emb
+            self.can_slide_cache_kv = True
         if self.autoregressive:
             if logits_dim is not None:
                 assert logits_dim == num_tokens, 'if autoregressive, logits_dim must be equal to num_tokens'
@@ -181,9 +565,14 @@ class MultiIOTransformerWrapper(nn.Module):
                     if tie_embedding:
                         assert all(self.post_attn_layers[i].dim == self.post_attn_layers[i].dim for i in range(
                             len(self.post_attn_layers))), 'if tie_embedding is True, the dimensions of the input and output attn layers must be equal'
-                    self.to_logits = torch.nn.ModuleList(
-                        [nn.Linear(dim, d, bias=False) for d in logits_dim]) if not tie_embedding else \
-                        lambda t: ([t @ self.token_emb[i].emb.weight.t() for i in range(len(logits_dim))])
+                    if fused_logits and not tie_embedding:
+                        assert all(dim == layer.dim for layer in self.post_attn_layers), \
+                            'all output_attn_layers must have the model dimension to fuse their logits'
+                        self.to_logits = FusedToLogits(dim, logits_dim)
+                    else:
+                        self.to_logits = torch.nn.ModuleList(
+                            [nn.Linear(dim, d, bias=False) for d in logits_dim]) if not tie_embedding else \
+                            lambda t: ([t @ self.token_emb[i].emb.weight.t() for i in range(len(logits_dim))])
                 else:
                     self.to_logits = torch.nn.ModuleList(
                         [nn.Linear(self.post_attn_layers[i].dim, self.post_attn_layers[i].dim, bias=False)
@@ -194,6 +583,8 @@ class MultiIOTransformerWrapper(nn.Module):
                     if tie_embedding:
                         self.logits = [lambda t: t @ self.token_emb[i].emb.weight.t() if self.multi_input else lambda
                             t: t @ self.model.token_emb.emb.weight.t() for i in range(len(logits_dim))]
+                    elif fused_logits:
+                        self.to_logits = FusedToLogits(dim, logits_dim)
                     else:
                         self.to_logits = torch.nn.ModuleList([nn.Linear(dim, d, bias=False) for d in logits_dim])
                 else:
@@ -201,7 +592,15 @@ class MultiIOTransformerWrapper(nn.Module):
         self.logits_dim = logits_dim
 
     def init_(self):
-        if self.multi_input:
+        if self.multi_input and self.packed_token_emb:
+            if self.l2norm_embed:
+                nn.init.normal_(self.token_emb.emb.weight, std=1e-5)
+                for pos_emb in self.pos_emb:
+                    if isinstance(pos_emb, AbsolutePositionalEmbedding) or isinstance(pos_emb, ScaledSinusoidalEmbedding):
+                        nn.init.normal_(pos_emb.emb.weight, std=1e-5)
+
+            nn.init.kaiming_normal_(self.token_emb.emb.weight)
+        elif self.multi_input:
             if self.l2norm_embed:
                 for i in range(len(self.token_emb)):
                     nn.init.normal_(self.token_emb[i].emb.weight, std=1e-5)
@@ -232,15 +631,30 @@ class MultiIOTransformerWrapper(nn.Module):
             attn_z_loss_weight=1e-4,
             seq_start_pos=None,
             cache=None,
+            capture=None,
+            output_positions=None,
             **kwargs
     ):
 
         return_hiddens = return_mems | return_attn | return_intermediates | return_attn_z_loss
 
+        # only capture the intermediates needed for what is returned, unless a capture policy is given
+
+        capture = get_capture_policy(capture, return_intermediates, return_attn, return_attn_z_loss, return_mems)
+
+        # output positions restrict the outputs of every stream to those positions, as for TransformerWrapper
+        # the queries are restricted in the last self attention layer - of the output attention layers if there are any, otherwise of the main ones
+
+        if isinstance(output_positions, int):
+            output_positions = torch.tensor([output_positions], device=x.device)
+
+        model_output_positions = output_positions if self.post_attn_layers is None else None
+
         if not self.multi_input and not self.multi_output:
             return self.model(x, return_embeddings, return_logits_and_embeddings, return_intermediates, mask,
                               return_mems, return_attn, mems, mem_masks, pos, prepend_embeds, prepend_mask, embed_ids,
-                              sum_embeds, return_attn_z_loss, attn_z_loss_weight, seq_start_pos, cache)
+                              sum_embeds, return_attn_z_loss, attn_z_loss_weight, seq_start_pos, cache,
+                              capture=capture, output_positions=output_positions)
         if cache is not None:
             if self.pre_attn_layers is not None and self.post_attn_layers is not None:
                 cache_pre_attn_layers, cache_model, cache_post_attn_layers = cache
@@ -283,11 +697,36 @@ class MultiIOTransformerWrapper(nn.Module):
             #    num_mems, has_memory_tokens = 0, False
             external_pos_emb = exists(pos) and pos.dtype != torch.long
             intermediates_pre = []
+            xs = []
             out_x = None
-            for i in range(len(self.token_emb)):
-                x_i = x[:, :, i]
-                pos_emb = self.pos_emb[i](x_i, pos=pos, seq_start_pos=seq_start_pos) if not external_pos_emb else pos
-                x_i = self.token_emb[i](x_i) + pos_emb
+
+            # packed token embeddings - one gather for all streams, with the positional embeddings added in place
+
+            packed_emb = None
+            if self.packed_token_emb:
+                packed_emb = self.token_emb(x)
+                for i in range(len(self.pos_emb)):
+                    if isinstance(self.pos_emb[i], always) and not external_pos_emb:
+                        continue
+                    pos_emb = self.pos_emb[i](x[:, :, i], pos=pos, seq_start_pos=seq_start_pos) if not external_pos_emb else pos
+                    packed_emb[:, :, i] += pos_emb
+
+            use_packed_emb_as_concat = self.packed_emb_is_concat and not exists(prepend_embeds)
+
+            if use_packed_emb_as_concat:
+                if emb_frac_gradient < 1:
+                    assert emb_frac_gradient > 0
+                    packed_emb = packed_emb * emb_frac_gradient + packed_emb.detach() * (1 - emb_frac_gradient)
+                packed_emb = self.emb_dropout[0](packed_emb)
+                xs = list(packed_emb.unbind(dim=-2))
+
+            for i in range(len(self.emb_dim) if not use_packed_emb_as_concat else 0):
+                if exists(packed_emb):
+                    x_i = packed_emb[:, :, i]
+                else:
+                    x_i = x[:, :, i]
+                    pos_emb = self.pos_emb[i](x_i, pos=pos, seq_start_pos=seq_start_pos) if not external_pos_emb else pos
+                    x_i = self.token_emb[i](x_i) + pos_emb
                 if exists(self.embeds):
                     assert len(embed_ids[i]) == len(self.embeds)
 
@@ -315,26 +754,47 @@ class MultiIOTransformerWrapper(nn.Module):
                     x_i = x_i * emb_frac_gradient + x_i.detach() * (1 - emb_frac_gradient)
                 x_i = self.emb_dropout[i](x_i)
                 x_i = self.project_emb[i](x_i)
-                if self.pre_attn_layers is not None:
-                    cur_mem = mems_pre[i] if exists(mems_pre) else None
-                    if self.shift_mem_down and exists(cur_mem):
-                        mems_l, mems_r = cur_mem[:self.shift_mem_down], cur_mem[self.shift_mem_down:]
-                        cur_mem = [*mems_r, *mems_l]
-                    x_i, intermediates_pre_attn_layer = self.pre_attn_layers[i](x_i, mask=mask,
-                                                                                mems=cur_mem,
-                                                                                cache=cache_pre_attn_layers[
-                                                                                    i] if cache_pre_attn_layers is not None else None,
-                                                                                return_hiddens=True,
-                                                                                seq_start_pos=seq_start_pos,
-                                                                                **kwargs)
-                    intermediates_pre.append(intermediates_pre_attn_layer)
-                if out_x is None:
-                    out_x = x_i
+                xs.append(x_i)
+
+            if self.pre_attn_layers is not None:
+                if self.fuse_pre_attn_layers and not exists(mems_pre):
+                    xs, intermediates_pre = fused_attn_layers_forward(self.pre_attn_layers, xs,
+                                                                      caches=cache_pre_attn_layers,
+                                                                      stacked_weights=self.stacked_pre_attn_weights,
+                                                                      mask=mask,
+                                                                      seq_start_pos=seq_start_pos,
+                                                                      capture=capture,
+                                                                      **kwargs)
                 else:
-                    if self.concat_emb_dim:
-                        out_x = torch.cat((out_x, x_i), dim=-1)
-                    else:
-                        out_x = out_x + x_i
+                    def pre_branch(i):
+                        cur_mem = mems_pre[i] if exists(mems_pre) else None
+                        if self.shift_mem_down and exists(cur_mem):
+                            mems_l, mems_r = cur_mem[:self.shift_mem_down], cur_mem[self.shift_mem_down:]
+                            cur_mem = [*mems_r, *mems_l]
+                        return self.pre_attn_layers[i](xs[i], mask=mask,
+                                                       mems=cur_mem,
+                                                       cache=cache_pre_attn_layers[
+                                                           i] if cache_pre_attn_layers is not None else None,
+                                                       return_hiddens=True,
+                                                       seq_start_pos=seq_start_pos,
+                                                       capture=capture,
+                                                       **kwargs)
+
+                    pre_outs = run_branches([partial(pre_branch, i) for i in range(len(xs))],
+                                            num_threads=self.branch_threads,
+                                            intra_op_threads=self.branch_intra_op_threads)
+                    xs = [x_i for x_i, _ in pre_outs]
+                    intermediates_pre = [intermediates_pre_attn_layer for _, intermediates_pre_attn_layer in pre_outs]
+
+            # combine the streams, the packed embeddings are already laid out as their concatenation
+
+            if use_packed_emb_as_concat and self.pre_attn_layers is None and self.concat_emb_dim:
+                out_x = rearrange(packed_emb, 'b n s d -> b n (s d)')
+            elif self.concat_emb_dim:
+                out_x = torch.cat(xs, dim=-1)
+            else:
+                for x_i in xs:
+                    out_x = x_i if out_x is None else out_x + x_i
             x = out_x
             x = self.pre_attn_layers_map(x)
 
@@ -357,7 +817,7 @@ class MultiIOTransformerWrapper(nn.Module):
                 mems_pre_out = []
                 for i in range(len(intermediates_pre)):
                     hiddens = intermediates_pre[i].hiddens
-                    new_mems = list(map(lambda pair: torch.cat(pair, dim=-2), zip(mems_pre, hiddens))) if exists(
+                    new_mems = list(map(lambda pair: torch.cat(pair, dim=-2), zip(mems_pre[i], hiddens))) if exists(
                         mems_pre) else hiddens
                     new_mems = list(map(lambda t: t[..., -self.max_mem_len:, :].detach(), new_mems))
 
@@ -374,7 +834,9 @@ class MultiIOTransformerWrapper(nn.Module):
                 mems_model = [*mems_r, *mems_l]
             x, intermediates_model = self.attn_layers(x, mask=mask, mems=mems_model, mem_masks=mem_masks,
                                                       cache=cache_model,
-                                                      return_hiddens=True, seq_start_pos=seq_start_pos, **kwargs)
+                                                      return_hiddens=True, seq_start_pos=seq_start_pos,
+                                                      capture=capture, output_positions=model_output_positions,
+                                                      **kwargs)
         else:
             if return_hiddens:
                 x, intermediates_model = self.model(x, return_embeddings, return_logits_and_embeddings,
@@ -383,11 +845,13 @@ class MultiIOTransformerWrapper(nn.Module):
                                                     prepend_embeds,
                                                     prepend_mask, embed_ids,
                                                     sum_embeds, return_attn_z_loss, attn_z_loss_weight, seq_start_pos,
-                                                    cache)
+                                                    cache_model, capture=capture,
+                                                    output_positions=model_output_positions)
             else:
                 x = self.model(x, False, False, False, mask,
                                False, False, mems_model, mem_masks, pos, prepend_embeds, prepend_mask, embed_ids,
-                               sum_embeds, False, attn_z_loss_weight, seq_start_pos, cache)
+                               sum_embeds, False, attn_z_loss_weight, seq_start_pos, cache_model, capture=capture,
+                               output_positions=model_output_positions)
 
         """
         Output processing for middle (model) layers
@@ -420,30 +884,36 @@ class MultiIOTransformerWrapper(nn.Module):
 
         if self.multi_output:
             if self.post_attn_layers is not None:
-                outputs = []
-                intermediates_post = []
-                x_values = []
-                for i, layer in enumerate(self.post_attn_layers):
+                def post_branch(i):
+                    layer = self.post_attn_layers[i]
                     post_x = self.post_mapping[i](x)
                     mems_cur = mems_post[i] if exists(mems_post) else None
                     if self.shift_mem_down and exists(mems_cur):
                         mems_l, mems_r = mems_cur[:self.shift_mem_down], mems_cur[self.shift_mem_down:]
                         mems_cur = [*mems_r, *mems_l]
                     if return_hiddens:
-                        post_x, inter = layer(post_x, mask=mask,
-                                              mems=mems_cur,
-                                              mem_masks=mem_masks,
-                                              cache=cache_post_attn_layers[
-                                                  i] if cache_post_attn_layers is not None else None,
-                                              return_hiddens=True, seq_start_pos=seq_start_pos, **kwargs)
-                        intermediates_post.append(inter)
-                        x_values.append(post_x)
-                    else:
-                        x_values.append(
-                            layer(post_x, mask=mask, mems=mems_cur,
-                                  cache=cache_post_attn_layers[i] if cache_post_attn_layers is not None else None,
-                                  return_hiddens=False, seq_start_pos=seq_start_pos, **kwargs))
-                    outputs.append(self.to_logits[i](x_values[i]))
+                        return layer(post_x, mask=mask,
+                                     mems=mems_cur,
+                                     mem_masks=mem_masks,
+                                     cache=cache_post_attn_layers[
+                                         i] if cache_post_attn_layers is not None else None,
+                                     return_hiddens=True, seq_start_pos=seq_start_pos, capture=capture,
+                                     output_positions=output_positions, **kwargs)
+                    return layer(post_x, mask=mask, mems=mems_cur,
+                                 cache=cache_post_attn_layers[i] if cache_post_attn_layers is not None else None,
+                                 return_hiddens=False, seq_start_pos=seq_start_pos,
+                                 output_positions=output_positions, **kwargs), None
+
+                post_outs = run_branches([partial(post_branch, i) for i in range(len(self.post_attn_layers))],
+                                         num_threads=self.branch_threads,
+                                         intra_op_threads=self.branch_intra_op_threads)
+                x_values = [x_value for x_value, _ in post_outs]
+                intermediates_post = [inter for _, inter in post_outs if exists(inter)]
+
+                if isinstance(self.to_logits, FusedToLogits):
+                    outputs = self.to_logits(x_values)
+                else:
+                    outputs = [self.to_logits[i](x_value) for i, x_value in enumerate(x_values)]
                 if return_logits_and_embeddings:
                     out = (outputs, x_values)
                 elif return_embeddings:
@@ -461,20 +931,22 @@ class MultiIOTransformerWrapper(nn.Module):
                     return_intermediates = True
 
                 if return_mems:
+                    mems_post_out = []
                     for i in range(len(intermediates_post)):
                         hiddens = intermediates_post[i].hiddens
-                        new_mems = list(map(lambda pair: torch.cat(pair, dim=-2), zip(mems_post, hiddens))) if exists(
+                        new_mems = list(map(lambda pair: torch.cat(pair, dim=-2), zip(mems_post[i], hiddens))) if exists(
                             mems_post) else hiddens
                         new_mems = list(map(lambda t: t[..., -self.max_mem_len:, :].detach(), new_mems))
 
-                        if not return_intermediates:
-                            if self.pre_attn_layers is not None:
-                                return out, (mems_pre_out, mems_model, new_mems)
-                            else:
-                                return out, (mems_model, new_mems)
-
+                        mems_post_out.append(new_mems)
                         intermediates_post[i].mems = new_mems
 
+                    if not return_intermediates:
+                        if self.pre_attn_layers is not None:
+                            return out, (mems_pre_out, mems_model, mems_post_out)
+                        else:
+                            return out, (mems_model, mems_post_out)
+
                 if return_intermediates:
                     if self.pre_attn_layers is not None:
                         return out, (intermediates_pre, intermediates_model, intermediates_post)
@@ -494,13 +966,14 @@ class MultiIOTransformerWrapper(nn.Module):
                 """
                 Output processing for multi-output no attention layers
                 """
-                x_values = []
-                for i in self.to_logits:
-                    x_values.append(i(x))
+                if isinstance(self.to_logits, FusedToLogits):
+                    x_values = self.to_logits(x)
+                else:
+                    x_values = [to_logits(x) for to_logits in self.to_logits]
 
                 if return_mems:
                     if self.pre_attn_layers is not None:
-                        return x_values, (mems_pre, mems_model)
+                        return x_values, (mems_pre_out, mems_model)
                     else:
                         return x_values, mems_model
 
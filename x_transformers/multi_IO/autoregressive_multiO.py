@@ -1,5 +1,71 @@
+from typing import List
+
+from einops import repeat
+
 from x_transformers.autoregressive_wrapper import *
-from x_transformers.multi_IO.IO_wrapper import MultiIOTransformerWrapper
+from x_transformers.sampling import gumbel_noise
+from x_transformers.multi_IO.IO_wrapper import MultiIOTransformerWrapper, iter_layer_intermediates, set_token_emb_padding_idx
+
+
+# vectorized sampling across all output heads
+
+def pad_head_logits(logits: List[Tensor]):
+    # [b, logits dim] per head -> [b, heads, max logits dim], padded with -inf so the padding is never sampled
+
+    logits_dims = [t.shape[-1] for t in logits]
+
+    if len(set(logits_dims)) == 1:
+        return torch.stack(logits, dim=1)
+
+    padded = logits[0].new_full((logits[0].shape[0], len(logits), max(logits_dims)), float('-inf'))
+    for i, t in enumerate(logits):
+        padded[:, i, :t.shape[-1]] = t
+
+    return padded
+
+
+def top_k_per_head(logits, logits_dims: List[int], frac_num_tokens=0.1, k=None):
+    # same as top_k, with the fraction of tokens taken relative to the vocabulary of each head
+
+    ks = [min(default(k, ceil(frac_num_tokens * logits_dim)), logits_dim) for logits_dim in logits_dims]
+
+    values, _ = logits.topk(max(ks), dim=-1)
+    kth_index = torch.tensor(ks, device=logits.device) - 1
+    kth_values = values.gather(-1, repeat(kth_index, 'h -> b h 1', b=logits.shape[0]))
+
+    return logits.masked_fill(logits < kth_values, float('-inf'))
+
+
+def sample_heads(
+        logits: List[Tensor],
+        temperature=1.,
+        filter_logits_fn: Callable = top_k,
+        filter_kwargs: dict = dict(),
+        sampler: Optional[Sampler] = None
+):
+    """
+    samples the next token of every output head in one pass
+    the per-head logits of shape [b, logits dim] are padded into [b, heads, max logits dim]
+    greedy takes the argmax, otherwise the filtered logits are sampled with gumbel-max, which matches sampling from the softmax
+    a sampler takes over from the temperature and filter, with its parameters per row shared by all heads
+    returns [b, heads]
+    """
+    logits_dims = [t.shape[-1] for t in logits]
+    logits = pad_head_logits(logits)
+
+    if exists(sampler):
+        return sampler(logits)
+
+    if temperature == 0.:
+        return logits.argmax(dim=-1)
+
+    if filter_logits_fn is top_k:
+        filtered_logits = top_k_per_head(logits, logits_dims, **filter_kwargs)
+    else:
+        filtered_logits = filter_logits_fn(rearrange(logits, 'b h l -> (b h) l'), **filter_kwargs)
+        filtered_logits = rearrange(filtered_logits, '(b h) l -> b h l', h=len(logits_dims))
+
+    return (filtered_logits / temperature + gumbel_noise(filtered_logits)).argmax(dim=-1)
 
 
 class MultiOAutoregressiveWrapper(Module):
@@ -26,9 +92,7 @@ class MultiOAutoregressiveWrapper(Module):
         if type(net) == MultiIOTransformerWrapper:
             self.outputs = len(net.logits_dim)
             net.autoregressive = True
-            for i, token_emb in enumerate(net.token_emb):
-                token_emb.padding_idx = int(pad_value[i])
-                token_emb.emb.padding_idx = int(pad_value[i])
+            set_token_emb_padding_idx(net.token_emb, pad_value)
         # paper shows masking (MLM) in conjunction with autoregressive decoder-only training leads to big improvements https://arxiv.org/abs/2210.13432
         assert mask_prob < 1.
         self.mask_prob = mask_prob
@@ -55,6 +119,10 @@ class MultiOAutoregressiveWrapper(Module):
             #    alpha=0.1
             # ),
             cache_kv=True,
+            prefix_cache: Optional[PrefixKVCache] = None,
+            compact_every: Optional[int] = None,
+            prefill_chunk_size: Optional[int] = None,
+            sampler: Optional[Sampler] = None,
             **kwargs
     ):
         # assumes it is multi-output
@@ -75,78 +143,132 @@ class MultiOAutoregressiveWrapper(Module):
 
         out = prompts
 
+        # with compact_every, every that many steps the rows that reached eos are moved into the results and dropped from the batch decoded
+
+        compact = exists(compact_every) and (exists(eos_token) or exists(index_eos_token))
+
+        if compact:
+            batch_indices = torch.arange(b, device=device)
+            results = repeat(self.pad_value.to(device=device, dtype=out.dtype), 'o -> b n o', b=b, n=t + seq_len).clone()
+
         # kv caches
 
         cache = None
 
+        # seed the cache with the longest prefix of the prompts cached by previous calls, so only the rest is prefilled
+        # prefixes are keyed on the tokens of all streams
+
+        prefix_len = 0
+
+        if exists(prefix_cache) and cache_kv and self.net.can_cache_kv:
+            assert not exists(prompt_lens), 'prefix cache cannot be combined with variable lengthed prompts'
+            assert not restrict_to_max_seq_len or t <= max_seq_len, 'prompts must fit within the max sequence length to be prefix cached'
+
+            cache, prefix_len = prefix_cache.lookup(prompts)
+
+        # with prefill_chunk_size, the prompts are prefilled into the cache of all streams by chunks of that many tokens, the last of which is fed in on the first step
+
+        num_prefilled = prefix_len
+
+        if exists(prefill_chunk_size) and cache_kv and self.net.can_cache_kv:
+            prompt_x = out[:, -max_seq_len:] if restrict_to_max_seq_len else out
+            cache, num_prefilled = prefill_chunks(self.net, prompt_x, prefill_chunk_size, cache=cache, num_cached=prefix_len, seq_start_pos=seq_start_pos, **kwargs)
+
         # sampling up to seq_len
 
-        for _ in range(seq_len):
+        for step in range(seq_len):
+
+            x = out
+            is_prefill = step == 0
 
             if restrict_to_max_seq_len:
-                max_len_exceeded = out.shape[-1] > max_seq_len
+                max_len_exceeded = out.shape[1] > max_seq_len
 
                 assert not (
                         cache_kv and max_len_exceeded and not self.net.can_cache_kv_outside_max_seq_len), 'the network cannot use cached key values when decoding outside the max sequence length. most likely because you are using absolute positional embeddings. you can switch to rotary embeddings to resolve this issue'
 
                 x = out[:, -max_seq_len:]
 
+                # the cache spans the input, main and output attention layers of every stream
+                # with interspersed memory tokens it cannot slide, so it is dropped and the rest is decoded without a cache
+
+                if exists(cache) and max_len_exceeded and not self.net.can_slide_cache_kv:
+                    cache, cache_kv = None, False
+
                 if exists(cache):
-                    for inter in cache.attn_intermediates:
-                        inter.cached_kv = [t[..., -(max_seq_len - 1):, :] for t in inter.cached_kv]
+                    for layer_intermediates in iter_layer_intermediates(cache):
+                        for inter in layer_intermediates.attn_intermediates:
+                            inter.cached_kv = [t[..., -(max_seq_len - 1):, :] for t in inter.cached_kv]
 
-            logits_ = self.net(
+            # the first step only feeds in the tokens of the prompts not in the cache yet, past a cached prefix or the prefilled chunks
+
+            net_kwargs = dict(cache_age=x.shape[1] - num_prefilled) if is_prefill and num_prefilled > 0 else dict()
+
+            logits, new_cache = self.net(
                 x,
                 return_intermediates=True,
+                capture='kv_only',
                 cache=cache,
                 seq_start_pos=seq_start_pos,
+                output_positions=-1,
+                **net_kwargs,
                 **kwargs
             )
-            logits = logits_[0]
-            new_cache = logits_[1:]
-            # if cache_kv and self.net.can_cache_kv:
-            #    cache = new_cache
-
-            # logits is a tuple of outputs
-            # assert len(logits) == self.outputs
-            sample = torch.Tensor([])
-            for i in range(self.outputs):
-
-                # print(logits[0])
-                logits_i = logits[i][:, -1]
-                # handle contrastive decoding, Li et al.
-                # https://arxiv.org/abs/2210.15097
-                # filter by top_k, top_p (nucleus), top_a, or custom
-
-                if greedy:
-                    sample_i = logits_i.argmax(dim=-1, keepdim=True)
-                else:
-                    filtered_logits_i = filter_logits_fn(logits_i, **filter_kwargs)
-                    probs = F.softmax(filtered_logits_i / temperature, dim=-1)
-                    sample_i = torch.multinomial(probs, 1)
-
-                sample = torch.cat((sample, sample_i), dim=-1)
-                # concat sample
-            out = torch.cat((out, sample[None, :, :]), dim=1)
+
+            if is_prefill and exists(prefix_cache) and cache_kv and self.net.can_cache_kv:
+                prefix_cache.insert(prompts, new_cache)
+
+            if cache_kv and self.net.can_cache_kv:
+                cache = new_cache
+
+            # logits is a list with one entry per output, all heads are filtered and sampled at once
+
+            sample = sample_heads(
+                [logits_i[:, -1] for logits_i in logits],
+                temperature=temperature,
+                filter_logits_fn=filter_logits_fn,
+                filter_kwargs=filter_kwargs,
+                sampler=sampler
+            )
+
+            out = torch.cat((out, rearrange(sample, 'b o -> b 1 o')), dim=1)
 
             if not exists(eos_token) and not exists(index_eos_token):
                 continue
 
-            continue_generation = True
+            # a row is done once it has the eos token in all streams, or the eos token of any stream in index_eos_token
+
+            is_done = torch.zeros((out.shape[0],), device=device, dtype=torch.bool)
+
             if exists(index_eos_token):
-                for index, eos_token in index_eos_token.items():
-                    if (out[:, :, index] == eos_token).any(dim=-1):
-                        continue_generation = False
+                for index, index_eos in index_eos_token.items():
+                    is_done |= (out[:, :, index] == index_eos).any(dim=-1)
             if exists(eos_token):
                 is_eos_tokens = torch.all(torch.eq(out[:, :, :], eos_token), dim=-1)
-                if torch.any(is_eos_tokens, dim=-1):
-                    continue_generation = False
-            if not continue_generation:
+                is_done |= is_eos_tokens.any(dim=-1)
+            if is_done.all():
                 break
 
+            # drop the finished rows from the output and every per row state - the cache of all streams, the context, the start positions
+
+            if compact and ((step + 1) % compact_every) == 0 and is_done.any():
+                keep, batch_indices = compact_finished_rows(out, is_done, batch_indices, results)
+
+                out = out[keep]
+                seq_start_pos = select_rows(seq_start_pos, keep)
+                sampler = select_rows(sampler, keep)
+                kwargs = map_batch_kwargs(kwargs, len(is_done), lambda t: t[keep])
+
+                if exists(cache):
+                    reorder_cached_kv(cache, keep)
+
+        if compact:
+            results[batch_indices, :out.shape[1]] = out
+            out = results[:, :out.shape[1]]
 
         if exists(eos_token):
             # mask out everything after the eos tokens
+            is_eos_tokens = torch.all(torch.eq(out, eos_token), dim=-1)
             shifted_is_eos_tokens = F.pad(is_eos_tokens, (1, -1))
             mask = shifted_is_eos_tokens.float().cumsum(dim=-1) >= 1
             out = torch.where(mask.unsqueeze(-1), self.pad_value, out)
@@ -176,6 +298,7 @@ class MultiOAutoregressiveWrapper(Module):
             inp,
             return_intermediates=True,
             return_attn_z_loss=add_attn_z_loss,
+            capture='full' if return_outputs else ('z_loss' if add_attn_z_loss else 'none'),
             mask=mask,
             **kwargs
         )
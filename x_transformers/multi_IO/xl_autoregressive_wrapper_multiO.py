@@ -1,6 +1,9 @@
 from x_transformers import MultiIOTransformerWrapper
+from x_transformers.multi_IO.IO_wrapper import set_token_emb_padding_idx
+from x_transformers.multi_IO.autoregressive_multiO import sample_heads
 from x_transformers.xl_autoregressive_wrapper import *
 from torch import Tensor
+from einops import repeat
 
 class MultiOXLAutoregressiveWrapper(nn.Module):
     def __init__(
@@ -23,9 +26,7 @@ class MultiOXLAutoregressiveWrapper(nn.Module):
         self.net = net
         if type(net) == MultiIOTransformerWrapper:
             net.autoregressive = True
-            for i, token_emb in enumerate(net.token_emb):
-                token_emb.padding_idx = int(pad_value[i])
-                token_emb.emb.padding_idx = int(pad_value[i])
+            set_token_emb_padding_idx(net.token_emb, pad_value)
         self.max_seq_len = net.max_seq_len
 
     @torch.no_grad()
@@ -41,6 +42,8 @@ class MultiOXLAutoregressiveWrapper(nn.Module):
             filter_thres=0.9,
             mems=None,
             filter_kwargs: dict = dict(),
+            compact_every=None,
+            sampler: Optional[Sampler] = None,
             **kwargs
     ):
         device, greedy, max_seq_len = prompts.device, temperature == 0, self.max_seq_len
@@ -67,56 +70,77 @@ class MultiOXLAutoregressiveWrapper(nn.Module):
         curr_pos = len(all_leading_tokens) * max_seq_len
         curr_mems = mems
 
-        cache = None
         out = prompts
 
-        for _ in range(seq_len):
+        # with compact_every, every that many steps the rows that reached eos are moved into the results and dropped from the batch decoded
+
+        compact = exists(compact_every) and (exists(eos_token) or exists(index_eos_token))
+
+        if compact:
+            batch_indices = torch.arange(b, device=device)
+            results = repeat(self.pad_value.to(device=device, dtype=out.dtype), 'o -> b n o', b=b, n=t + seq_len).clone()
+
+        for step in range(seq_len):
             curr_segment_len = out.shape[1]
             is_last_segment_tokens = divisible_by(curr_segment_len, max_seq_len)
 
             x = out[:, curr_pos:]
 
-            logits_ = self.net(
+            logits, mems = self.net(
                 x,
                 mems=curr_mems,
-                cache=cache,
                 return_mems=True,
-                mask=torch.zeros((b, x.shape[1])).bool().to(device),
+                mask=torch.zeros(x.shape[:2], dtype=torch.bool, device=device),
+                output_positions=-1,
                 **kwargs
             )
-            logits = logits_[0].cpu()
-            cache = logits_[1]
-            del logits_
-            sample = torch.Tensor([]).to(device)
-            for i in range(self.outputs):
-                logits_i = logits[i][:, -1]
-                if greedy:
-                    sample_i = logits_i.argmax(dim=-1, keepdim=True)
-                else:
-                    filtered_logits_i = filter_logits_fn(logits_i, **filter_kwargs)
-                    probs_i = F.softmax(filtered_logits_i / temperature, dim=-1)
-                    sample_i = torch.multinomial(probs_i, 1)
-                sample = torch.cat((sample, sample_i), dim=1)
-            out = torch.cat((out, sample[None, :, :]), dim=1)
+
+            # sample all outputs at once, on device
+            sample = sample_heads(
+                [logits_i[:, -1] for logits_i in logits],
+                temperature=temperature,
+                filter_logits_fn=filter_logits_fn,
+                filter_kwargs=filter_kwargs,
+                sampler=sampler
+            )
+            del logits
+
+            out = torch.cat((out, rearrange(sample, 'b o -> b 1 o')), dim=1)
             if is_last_segment_tokens:
                 curr_pos = curr_segment_len
-                curr_mems = cache
+                curr_mems = mems
+
+            # a row is done once it has the eos token in all streams, or the eos token of any stream in index_eos_token
+
+            is_done = torch.zeros((out.shape[0],), device=device, dtype=torch.bool)
 
-            continue_generation = True
             if exists(eos_token):
                 is_eos_tokens = torch.all(torch.eq(out[:, :, :], eos_token), dim=-1)
-                if torch.any(is_eos_tokens, dim=-1):
-                    continue_generation = False
+                is_done |= is_eos_tokens.any(dim=-1)
 
             if exists(index_eos_token):
-                for index, eos_token in index_eos_token.items():
-                    if (out[:, :, index] == eos_token).any(dim=-1):
-                        continue_generation = False
-            if not continue_generation:
+                for index, index_eos in index_eos_token.items():
+                    is_done |= (out[:, :, index] == index_eos).any(dim=-1)
+            if is_done.all():
                 break
 
+            # drop the finished rows from the output and both memories
+
+            if compact and ((step + 1) % compact_every) == 0 and is_done.any():
+                keep, batch_indices = compact_finished_rows(out, is_done, batch_indices, results)
+
+                out = out[keep]
+                mems, curr_mems = select_rows(mems, keep), select_rows(curr_mems, keep)
+                sampler = select_rows(sampler, keep)
+                kwargs = map_batch_kwargs(kwargs, len(is_done), lambda t: t[keep])
+
+        if compact:
+            results[batch_indices, :out.shape[1]] = out
+            out = results[:, :out.shape[1]]
+
         if exists(eos_token):
             # mask out everything after the eos tokens
+            is_eos_tokens = torch.all(torch.eq(out, eos_token), dim=-1)
             shifted_is_eos_tokens = F.pad(is_eos_tokens, (1, -1))
             mask = shifted_is_eos_tokens.float().cumsum(dim=-1) >= 1
             out = torch.where(mask.unsqueeze(-1), self.pad_value, out)
@@ -139,15 +163,21 @@ class MultiOXLAutoregressiveWrapper(nn.Module):
             return_outputs=False,
             return_mems=False,
             weighted_loss=None,
+            backward_per_segment=False,
             **kwargs
     ):
+        """
+        the loss of each segment is computed on device and its logits are freed right after, unless return_outputs is set
+        with backward_per_segment, backward is called on the loss of each segment as it is computed (truncated BPTT, the mems
+        carried over are detached), so peak memory is bounded by one segment. the returned loss is then detached and only
+        for logging - do not call backward on it again
+        """
         self.pad_value = self.pad_value.to(x.device)
         if weighted_loss is None:
             weighted_loss = self.weighted_loss
         if return_mems:
             return_outputs=True
         ignore_index, max_seq_len = self.ignore_index, self.max_seq_len
-        device = x.device
         x, labels = x[:, :-1], x[:, 1:]
         seq_len = x.shape[1]
 
@@ -156,72 +186,73 @@ class MultiOXLAutoregressiveWrapper(nn.Module):
         split_labels = labels.split(max_seq_len, dim=1)
         loss_weights = tuple(map(lambda t: t.shape[-2] / seq_len, split_x))
 
-        # go through each chunk and derive weighted losses
-        total_loss = 0.
-        logits_total = None
-        if return_mems:
-            mems_total = []
+        # find the chunks and outputs that do not contribute to the loss up front
+        # so that the loss of each segment can be normalized before its backward
+        segments = []
         padding_adjustment = 0
         for chunk, chunk_labels, loss_weight in zip(split_x, split_labels, loss_weights):
-            chunk = chunk.to(device)
             mask = torch.all(chunk == self.pad_value, dim=2)
             if torch.all(mask, dim=1).all():
                 padding_adjustment += loss_weight
                 continue
 
-            logits_ = self.net(
+            has_labels = [not torch.all(chunk_labels[:, :, i].long() == self.pad_value[i]) for i in range(self.outputs)]
+            if not any(has_labels):
+                padding_adjustment += loss_weight
+
+            segments.append((chunk, chunk_labels, mask, has_labels, loss_weight))
+
+        loss_scale = 1 / (1 - padding_adjustment) if 0 < padding_adjustment < 1 else 1
+
+        # go through each chunk and derive weighted losses
+        total_loss = 0.
+        logits_total = [] if return_outputs else None
+        mems_total = [] if return_mems else None
+        for chunk, chunk_labels, mask, has_labels, loss_weight in segments:
+            logits, mems = self.net(
                 chunk,
                 mems=mems,
                 return_mems=True,
                 mask=mask,
                 **kwargs
             )
-            del chunk, mask
-            if device != "cpu":
-                torch.cuda.empty_cache()
-
-            logits = [logit.cpu() for logit in logits_[0]]
-            mems = logits_[1]
-            if device != "cpu":
-                torch.cuda.empty_cache()
-            if logits_total is None:
-                logits_total = [logit for logit in logits]
-            else:
-                for i in range(len(logits_total)):
-                    logits_total[i] = torch.cat((logits_total[i], logits[i]), dim=1)
-            if return_mems:
-                mems_total.append(mems)
 
             loss = None
-            chunk_labels = chunk_labels.to(device)
             for i in range(self.outputs):
-                if torch.all(chunk_labels[:, :, i].long()==self.pad_value[i]):
+                if not has_labels[i]:
                     continue
                 loss_i = F.cross_entropy(
-                    rearrange(logits[i], 'b n c -> b c n').to(device),
+                    rearrange(logits[i], 'b n c -> b c n'),
                     chunk_labels[:, :, i].long(),
                     ignore_index=int(self.pad_value[i])
                 )
-                if not loss_i.isnan():
-                    if loss is None:
-                        loss = loss_i * weighted_loss[i]
-                    else:
-                        loss = loss + loss_i * weighted_loss[i]
-            del logits, chunk_labels
-            if device != "cpu":
-                torch.cuda.empty_cache()
+                loss = loss_i * weighted_loss[i] if loss is None else loss + loss_i * weighted_loss[i]
+
+            if return_outputs:
+                logits_total.append(logits)
+            if return_mems:
+                mems_total.append(mems)
+            del logits
 
             if loss is None:
-                padding_adjustment += loss_weight
                 continue
-            total_loss = total_loss + loss * loss_weight
 
-        if 0 < padding_adjustment < 1:
-            total_loss = total_loss / (1 - padding_adjustment)
+            segment_loss = loss * loss_weight * loss_scale
+            if backward_per_segment:
+                segment_loss.backward()
+                segment_loss = segment_loss.detach()
+
+            total_loss = total_loss + segment_loss
+
         if padding_adjustment == 1:
             total_loss = torch.tensor([0.0], requires_grad=True).to(x.device)
         if not return_outputs:
             return total_loss
+
+        # concatenate the logits of all segments once, per output
+        logits_total = [torch.cat(output_logits, dim=1) for output_logits in zip(*logits_total)] if len(
+            logits_total) > 0 else None
+
         if not return_mems:
             return total_loss, logits_total
         return total_loss, (logits_total, mems_total)
@@ -0,0 +1,193 @@
+"""
+fused sampling - temperature, top-k, top-p (nucleus), top-a and min-p composed in one pass over the logits, with their parameters given per row of the batch,
+so that sequences sampled with different parameters can share a batch
+"""
+
+from typing import Optional, Union, List
+
+import torch
+from torch import Tensor
+
+# helpers
+
+def exists(val):
+    return val is not None
+
+def default(val, d):
+    return val if exists(val) else d
+
+def gumbel_noise(t):
+    noise = torch.zeros_like(t).uniform_(0, 1)
+    return -(-noise.clamp(min = 1e-20).log()).clamp(min = 1e-20).log()
+
+def per_row(param, logits: Tensor, dtype = None):
+    # a scalar, or a tensor of one value per row (or per any of the leading dimensions of the logits), made broadcastable against the logits
+
+    param = torch.as_tensor(param, device = logits.device, dtype = default(dtype, logits.dtype))
+    return param.reshape(*param.shape, *((1,) * (logits.ndim - param.ndim)))
+
+# sampler
+
+Param = Union[float, Tensor]
+
+class Sampler:
+    """
+    samples from the logits filtered by, in order, temperature, top-k, top-p, top-a and min-p, each applied to the distribution the previous ones left
+    unlike the filter_logits_fn of the wrappers, the temperature comes first, so the thresholds of top-p, top-a and min-p are over the tempered distribution
+
+    top-k and top-p only look at the largest top_k logits of each row (num_candidates of them without top-k), taken with one topk, so the vocabulary is never sorted
+    without top-k, the candidates widen eightfold, up to the whole vocabulary, for the rare step where the nucleus of a row reaches past them
+    rows with top-p off do not widen the candidates, so in a batch with other rows filtered by top-p, they sample among the num_candidates largest logits
+
+    every parameter is either a scalar, or a tensor with one value per row. for a row, temperature 0. is greedy, and top_k 0, top_p 1., top_a 0. and min_p 0. turn the filter off
+    """
+
+    def __init__(
+        self,
+        temperature: Param = 1.,
+        top_k: Optional[Union[int, Tensor]] = None,
+        top_p: Optional[Param] = None,
+        top_a: Optional[Param] = None,
+        top_a_pow: Param = 2.,
+        min_p: Optional[Param] = None,
+        num_candidates = 256
+    ):
+        self.temperature = temperature
+        self.top_k = top_k
+        self.top_p = top_p
+        self.top_a = top_a
+        self.top_a_pow = top_a_pow
+        self.min_p = min_p
+        self.num_candidates = num_candidates
+
+    @property
+    def params(self):
+        return dict(
+            temperature = self.temperature,
+            top_k = self.top_k,
+            top_p = self.top_p,
+            top_a = self.top_a,
+            top_a_pow = self.top_a_pow,
+            min_p = self.min_p
+        )
+
+    def select_rows(self, indices: Tensor):
+        # the sampler for the given rows of the batch, for when rows are dropped or reordered while decoding
+
+        select = lambda t: t.index_select(0, indices.to(t.device)) if torch.is_tensor(t) and t.ndim > 0 else t
+        return Sampler(**{name: select(param) for name, param in self.params.items()}, num_candidates = self.num_candidates)
+
+    def top_k_top_p(self, logits: Tensor, num_candidates: int):
+        # the candidates of each row in descending order, with their indices in the vocabulary, filtered by top-k and top-p
+
+        num_tokens = logits.shape[-1]
+
+        if exists(self.top_k):
+            top_k = per_row(self.top_k, logits, dtype = torch.long)
+            top_k = top_k.masked_fill(top_k <= 0, num_tokens).clamp(max = num_tokens)
+            num_candidates = int(top_k.amax())
+
+        candidates, indices = logits.topk(num_candidates, dim = -1)
+
+        if exists(self.top_k):
+            candidates = candidates.masked_fill(torch.arange(num_candidates, device = logits.device) >= top_k, float('-inf'))
+
+        if not exists(self.top_p):
+            return candidates, indices
+
+        # with top-k, the candidates hold all that is left of the distribution, otherwise the probabilities are over the whole vocabulary
+
+        top_p = per_row(self.top_p, logits)
+
+        lse = (candidates if exists(self.top_k) else logits).logsumexp(dim = -1, keepdim = True)
+        probs = (candidates - lse).exp()
+        cum_probs = probs.cumsum(dim = -1)
+
+        # rows with top_p 1. never reach it, and are left out of the check
+
+        needs_wider = (cum_probs[..., -1:] <= top_p) & (top_p < 1.)
+
+        if not exists(self.top_k) and num_candidates < num_tokens and needs_wider.any():
+            return self.top_k_top_p(logits, min(num_candidates * 8, num_tokens))
+
+        candidates = candidates.masked_fill((cum_probs - probs) > top_p, float('-inf'))
+        return candidates, indices
+
+    def filter_candidates(self, logits: Tensor):
+        """
+        the tempered and filtered logits of the candidates of each row, in descending order, and their indices in the vocabulary
+        without top-k or top-p, nothing is sorted - the indices are None, and the filtered logits are over the whole vocabulary
+        """
+
+        temperature = per_row(self.temperature, logits)
+        is_greedy = temperature == 0.
+
+        logits = logits / temperature.masked_fill(is_greedy, 1.)
+
+        indices = None
+
+        if exists(self.top_k) or exists(self.top_p):
+            logits, indices = self.top_k_top_p(logits, min(self.num_candidates, logits.shape[-1]))
+
+        max_logits = logits[..., :1] if exists(indices) else logits.amax(dim = -1, keepdim = True)
+
+        if exists(self.top_a):
+            # keeps the probabilities of at least max prob ** top_a_pow * top_a, in log space
+
+            lse = logits.logsumexp(dim = -1, keepdim = True)
+            limit = lse + per_row(self.top_a_pow, logits) * (max_logits - lse) + per_row(self.top_a, logits).log()
+            logits = logits.masked_fill(logits < limit, float('-inf'))
+
+        if exists(self.min_p):
+            # keeps the probabilities of at least max prob * min_p
+
+            limit = max_logits + per_row(self.min_p, logits).log()
+            logits = logits.masked_fill(logits < limit, float('-inf'))
+
+        if is_greedy.any():
+            ranks = torch.arange(logits.shape[-1], device = logits.device)
+            argmax = 0 if exists(indices) else logits.argmax(dim = -1, keepdim = True)
+            logits = logits.masked_fill(is_greedy & (ranks != argmax), float('-inf'))
+
+        return logits, indices
+
+    def filter(self, logits: Tensor):
+        # the tempered and filtered logits over the whole vocabulary, for when the distribution itself is needed, as for speculative decoding
+
+        filtered, indices = self.filter_candidates(logits)
+
+        if not exists(indices):
+            return filtered
+
+        return filtered.new_full(logits.shape, float('-inf')).scatter(-1, indices, filtered)
+
+    def __call__(self, logits: Tensor):
+        # samples a token for each row of the logits, with gumbel-max over the filtered candidates, which matches sampling from their softmax. returns logits.shape[:-1]
+
+        filtered, indices = self.filter_candidates(logits)
+
+        sampled = (filtered + gumbel_noise(filtered)).argmax(dim = -1, keepdim = True)
+
+        if exists(indices):
+            sampled = indices.gather(-1, sampled)
+
+        return sampled[..., 0]
+
+def stack_samplers(samplers: List[Sampler]):
+    # one sampler for a batch whose rows are each sampled with the scalar parameters of their own sampler. a filter set for only some rows is off for the others
+
+    off = dict(temperature = 1., top_k = 0, top_p = 1., top_a = 0., top_a_pow = 2., min_p = 0.)
+
+    params = dict()
+
+    for name, off_value in off.items():
+        values = [sampler.params[name] for sampler in samplers]
+
+        if not any(exists(value) for value in values):
+            params[name] = None
+            continue
+
+        dtype = torch.long if name == 'top_k' else torch.float
+        params[name] = torch.tensor([float(default(value, off_value)) for value in values], dtype = dtype)
+
+    return Sampler(**params, num_candidates = max(sampler.num_candidates for sampler in samplers))
@@ -16,8 +16,9 @@ from typing import List, Callable, Optional, Union
 from einops import rearrange, repeat, reduce, pack, unpack
 from einops.layers.torch import Rearrange
 
-from x_transformers.attend import Attend, Intermediates
+from x_transformers.attend import Attend, Intermediates, CAPTURE_POLICIES, capture_at_least, cache_mask
 from x_transformers.autoregressive_wrapper import AutoregressiveWrapper
+from x_transformers.kv_cache import StaticKVCache, PagedKVCache, StreamingKVCache
 
 # constants
 
@@ -93,12 +94,45 @@ def pad_at_dim(t, pad, dim = -1, value = 0.):
     zeros = ((0, 0) * dims_from_right)
     return F.pad(t, (*zeros, *pad), value = value)
 
+def gather_positions(t, positions, dim = -2):
+    # the entries of t at the given positions (b, k) along dim, for each row of the batch
+    dim = dim % t.ndim
+    positions = positions.reshape(positions.shape[0], *((1,) * (dim - 1)), positions.shape[-1], *((1,) * (t.ndim - dim - 1)))
+    return t.gather(dim, positions.expand(*t.shape[:dim], positions.shape[dim], *t.shape[(dim + 1):]))
+
 def or_reduce(masks):
     head, *body = masks
     for rest in body:
         head = head | rest
     return head
 
+# intermediates capture helpers
+
+def get_capture_policy(
+    capture = None,
+    return_intermediates = False,
+    return_attn = False,
+    return_attn_z_loss = False,
+    return_mems = False
+):
+    # by default, only capture what the requested outputs need
+
+    if not exists(capture):
+        if return_intermediates or return_attn:
+            capture = 'full'
+        elif return_attn_z_loss:
+            capture = 'z_loss'
+        elif return_mems:
+            capture = 'mems'
+        else:
+            capture = 'none'
+
+    assert capture in CAPTURE_POLICIES, f'capture must be one of {CAPTURE_POLICIES}'
+    assert not (return_attn and not capture_at_least(capture, 'full')), 'returning attention maps requires the full capture policy'
+    assert not (return_attn_z_loss and not capture_at_least(capture, 'z_loss')), 'attention z-loss requires at least the z_loss capture policy'
+    assert not (return_mems and not capture_at_least(capture, 'mems')), 'returning memories requires at least the mems capture policy'
+    return capture
+
 # auxiliary loss helpers
 
 def calc_z_loss(
@@ -259,6 +293,12 @@ class RelativePositionBias(nn.Module):
         self.max_distance = max_distance
         self.relative_attention_bias = nn.Embedding(num_buckets, heads)
 
+        # buckets saturate beyond the max distance, so a table of the buckets for all relative positions within it covers every distance
+
+        rel_pos_range = torch.arange(-max_distance, max_distance + 1, dtype = torch.long)
+        rp_bucket_table = self._relative_position_bucket(rel_pos_range, causal = causal, num_buckets = num_buckets, max_distance = max_distance)
+        self.register_buffer('rp_bucket_table', rp_bucket_table, persistent = False)
+
     @staticmethod
     def _relative_position_bucket(relative_position, causal = True, num_buckets = 32, max_distance = 128):
         ret = 0
@@ -285,14 +325,18 @@ class RelativePositionBias(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
-    def forward(self, i, j):
+    def forward(self, i, j, query_positions = None):
+        # query_positions, of shape (i,) or (b, i), are the positions of the queries among the keys, by default the last i
+        # only the bias of those queries is then computed, of shape (h, b, i, j) for per row positions
+
         device = self.device
-        q_pos = torch.arange(j - i, j, dtype = torch.long, device = device)
+        q_pos = default(query_positions, torch.arange(j - i, j, dtype = torch.long, device = device))
         k_pos = torch.arange(j, dtype = torch.long, device = device)
-        rel_pos = k_pos[None, :] - q_pos[:, None]
-        rp_bucket = self._relative_position_bucket(rel_pos, causal = self.causal, num_buckets = self.num_buckets, max_distance = self.max_distance)
+        rel_pos = k_pos - rearrange(q_pos, '... i -> ... i 1')
+        rel_pos = rel_pos.clamp(-self.max_distance, self.max_distance) + self.max_distance
+        rp_bucket = self.rp_bucket_table[rel_pos]
         values = self.relative_attention_bias(rp_bucket)
-        bias = rearrange(values, 'i j h -> h i j')
+        bias = rearrange(values, '... i j h -> h ... i j')
         return bias * self.scale
 
 class DynamicPositionBias(nn.Module):
@@ -322,14 +366,15 @@ class DynamicPositionBias(nn.Module):
     def device(self):
         return next(self.parameters()).device
 
-    def forward(self, i, j):
-        assert i == j
+    def forward(self, i, j, query_positions = None):
+        # query_positions, of shape (i,) or (b, i), are the positions of the queries among the keys, by default the last i
+
         n, device = j, self.device
 
-        # get the (n x n) matrix of distances
-        seq_arange = torch.arange(n, device = device)
+        # get the (i x n) matrix of distances
+        seq_arange = default(query_positions, torch.arange(n - i, n, device = device))
         context_arange = torch.arange(n, device = device)
-        indices = rearrange(seq_arange, 'i -> i 1') - rearrange(context_arange, 'j -> 1 j')
+        indices = rearrange(seq_arange, '... i -> ... i 1') - context_arange
         indices += (n - 1)
 
         # input to continuous positions MLP
@@ -344,7 +389,7 @@ class DynamicPositionBias(nn.Module):
 
         # get position biases        
         bias = pos[indices]
-        bias = rearrange(bias, 'i j h -> h i j')
+        bias = rearrange(bias, '... i j h -> h ... i j')
         return bias
 
 class AlibiPositionalBias(nn.Module):
@@ -381,9 +426,17 @@ class AlibiPositionalBias(nn.Module):
     def device(self):
         return next(self.buffers()).device
 
-    def forward(self, i, j):
+    def forward(self, i, j, query_positions = None):
         h, device = self.total_heads, self.device
 
+        # query_positions, of shape (i,) or (b, i), are the positions of the queries among the keys
+        # only the bias of those queries is computed, and it is not kept in the buffer
+
+        if exists(query_positions):
+            bias = -torch.abs(torch.arange(j, device = device) - rearrange(query_positions, '... i -> ... i 1'))
+            bias = bias * self.slopes.reshape(-1, *((1,) * bias.ndim))
+            return pad_at_dim(bias, (0, h - bias.shape[0]), dim = 0)
+
         if exists(self.bias) and self.bias.shape[-1] >= j and self.bias.shape[-2] >= i:
             return self.bias[..., -i:, -j:]
 
@@ -418,6 +471,12 @@ class RotaryEmbedding(nn.Module):
         assert interpolation_factor >= 1.
         self.interpolation_factor = interpolation_factor
 
+        # cos / sin table, built on demand
+
+        self.cached_cos = None
+        self.cached_sin = None
+        self.cached_pos_start = 0
+
         if not use_xpos:
             self.register_buffer('scale', None)
             return
@@ -427,6 +486,57 @@ class RotaryEmbedding(nn.Module):
         self.scale_base = scale_base
         self.register_buffer('scale', scale)
 
+    @property
+    def cached_cos_sin_range(self):
+        return (self.cached_pos_start, self.cached_pos_start + self.cached_cos.shape[0]) if exists(self.cached_cos) else None
+
+    @autocast(enabled = False)
+    def get_cos_sin(self, start, end):
+        # cos and sin of the frequencies (half the rotary dimension) for the integer positions start ..< end
+        # kept in a table indexed by absolute position that grows on demand, so that forwards only slice it
+        # the table is a plain attribute, not a buffer, so it is left out of the state dict and the module's buffers
+
+        inv_freq = self.inv_freq
+        table_range = self.cached_cos_sin_range
+
+        is_stale = not exists(table_range) or self.cached_cos.device != inv_freq.device or self.cached_cos.dtype != inv_freq.dtype
+
+        if is_stale or start < table_range[0] or end > table_range[1]:
+            table_start, table_end = (start, end) if is_stale else table_range
+
+            # grow geometrically, so that decoding one token at a time rebuilds the table a logarithmic number of times
+
+            if not is_stale and end > table_end:
+                table_end = max(end, table_start + 2 * (table_end - table_start))
+
+            table_start = min(start, table_start)
+
+            t = torch.arange(table_start, table_end, device = inv_freq.device).type_as(inv_freq)
+            t = t / self.interpolation_factor
+
+            freqs = torch.einsum('i , j -> i j', t, inv_freq)
+
+            self.cached_cos, self.cached_sin = freqs.cos(), freqs.sin()
+            self.cached_pos_start = table_start
+
+        offset = start - self.cached_pos_start
+        return self.cached_cos[offset:(offset + end - start)], self.cached_sin[offset:(offset + end - start)]
+
+    @autocast(enabled = False)
+    def forward_cos_sin(self, start, end):
+        # returns the cos and sin for the queries and the keys, with the xpos scale folded in
+
+        cos, sin = self.get_cos_sin(start, end)
+
+        if not exists(self.scale):
+            return cos, sin, cos, sin
+
+        seq_len = end - start
+        power = (torch.arange(seq_len, device = cos.device) - (seq_len // 2)) / self.scale_base
+        scale = self.scale ** rearrange(power, 'n -> n 1')
+
+        return cos * scale, sin * scale, cos * scale ** -1., sin * scale ** -1.
+
     def forward_from_seq_len(self, seq_len):
         device = self.inv_freq.device
 
@@ -454,6 +564,19 @@ class RotaryEmbedding(nn.Module):
         return freqs, scale
 
 
+def rotary_freqs_to_cos_sin(freqs, scale = 1.):
+    # converts the (freqs, xpos scale) returned by RotaryEmbedding.forward to the (q cos, q sin, k cos, k sin) taken by the attention layers
+
+    half = freqs.shape[-1] // 2
+    freqs = freqs[..., :half]
+    cos, sin = freqs.cos(), freqs.sin()
+
+    if not torch.is_tensor(scale):
+        return cos, sin, cos, sin
+
+    scale = scale[..., :half]
+    return cos * scale, sin * scale, cos * scale ** -1., sin * scale ** -1.
+
 def rotate_half(x):
     x = rearrange(x, '... (j d) -> ... j d', j = 2)
     x1, x2 = x.unbind(dim = -2)
@@ -472,6 +595,19 @@ def apply_rotary_pos_emb(t, freqs, scale = 1):
     t = (t * freqs.cos() * scale) + (rotate_half(t) * freqs.sin() * scale)
     return torch.cat((t, t_unrotated), dim = -1)
 
+@autocast(enabled = False)
+def apply_rotary_cos_sin(t, cos, sin):
+    # same as apply_rotary_pos_emb, with the cos and sin precomputed once per forward, and the rotation done on the halves directly
+    rot_dim, seq_len = cos.shape[-1] * 2, t.shape[-2]
+    cos, sin = cos[..., -seq_len:, :], sin[..., -seq_len:, :]
+
+    if t.ndim == 4 and cos.ndim == 3:
+        cos, sin = map(lambda m: rearrange(m, 'b n d -> b 1 n d'), (cos, sin))
+
+    # partial rotary embeddings, Wang et al. GPT-J
+    t1, t2, t_unrotated = t[..., :(rot_dim // 2)], t[..., (rot_dim // 2):rot_dim], t[..., rot_dim:]
+    return torch.cat((t1 * cos - t2 * sin, t2 * cos + t1 * sin, t_unrotated), dim = -1)
+
 # norms
 
 class Scale(nn.Module):
@@ -695,7 +831,10 @@ class Attention(nn.Module):
         tensor_product = False,      # https://arxiv.org/abs/2208.06061
         add_zero_kv = False,         # same as add_zero_attn in pytorch
         rotary_embed_values = False,
-        onnxable = False
+        onnxable = False,
+        chunked = False,
+        q_bucket_size = 512,
+        k_bucket_size = 1024
     ):
         super().__init__()
         dim_kv = default(dim_context, dim)
@@ -774,7 +913,10 @@ class Attention(nn.Module):
             scale = qk_norm_scale if qk_norm else self.scale,
             add_zero_kv = add_zero_kv,
             flash = flash,
-            onnxable = onnxable
+            onnxable = onnxable,
+            chunked = chunked,
+            q_bucket_size = q_bucket_size,
+            k_bucket_size = k_bucket_size
         )
 
         # head scaling
@@ -802,6 +944,71 @@ class Attention(nn.Module):
         if zero_init_output:
             init_zero_(self.to_out)
 
+    def build_attn_mask(
+        self,
+        i, j, n,
+        mask = None,
+        context_mask = None,
+        attn_mask = None,
+        mem = None,
+        mem_mask = None,
+        has_context = False,
+        query_positions = None,
+        device = None
+    ):
+        # query_positions, of shape (b, i), are the positions of the queries among the keys when only some of the queries are computed
+        # otherwise the queries are the last i positions
+
+        input_mask = context_mask
+
+        if not exists(input_mask) and not has_context:
+            input_mask = mask
+
+            if (exists(input_mask) or exists(mem_mask)) and exists(mem):
+                seq_len, mem_len = n, mem.shape[-2]
+
+                if not exists(mem_mask):
+                    input_mask = pad_at_dim(input_mask, (mem_len, 0), dim = -1, value = True)
+                elif not exists(input_mask):
+                    input_mask = pad_at_dim(mem_mask, (0, seq_len), dim = -1, value = True)
+                else:
+                    input_mask = torch.cat((mem_mask, input_mask), dim = -1)
+
+        if self.num_mem_kv > 0 and exists(input_mask):
+            input_mask = pad_at_dim(input_mask, (self.num_mem_kv, 0), dim = -1, value = True)
+
+        masks = []
+
+        if exists(input_mask):
+            input_mask = rearrange(input_mask, 'b j -> b 1 1 j')
+            masks.append(~input_mask)
+
+        if exists(attn_mask):
+            assert 2 <= attn_mask.ndim <= 4, 'attention mask must have greater than 2 dimensions but less than or equal to 4'
+            if attn_mask.ndim == 2:
+                attn_mask = rearrange(attn_mask, 'i j -> i 1 j 1')
+            elif attn_mask.ndim == 3:
+                attn_mask = rearrange(attn_mask, 'h i j -> 1 h i j')
+            masks.append(~attn_mask)
+
+        range_q = rearrange(query_positions, 'b i -> b 1 i 1') if exists(query_positions) else rearrange(torch.arange(j - i, j, device = device), 'i -> 1 1 i 1')
+        range_k = rearrange(torch.arange(j, device = device), 'j -> 1 1 1 j')
+
+        if exists(self.max_attend_past):
+            dist = range_q - range_k
+            max_attend_past_mask = dist > self.max_attend_past
+            masks.append(max_attend_past_mask)
+
+        # the causal mask of attend lines the queries up with the last keys, which only covers the queries at other positions from above
+
+        if exists(query_positions) and self.causal:
+            masks.append(range_k > range_q)
+
+        if len(masks) == 0:
+            return None
+
+        return ~or_reduce(masks)
+
     def forward(
         self,
         x,
@@ -816,11 +1023,23 @@ class Attention(nn.Module):
         mem_mask = None,
         return_intermediates = False,
         cache: Optional[Intermediates] = None,
+        capture = 'full',
+        mask_cache: Optional[Dict] = None,
+        query_positions: Optional[Tensor] = None
     ):
         b, n, h, kv_h, head_scale, device, has_context = x.shape[0], x.shape[1], self.heads, self.kv_heads, self.head_scale, x.device, exists(context)
 
         kv_input = default(context, x)
 
+        # with query positions (b, k), in increasing order, only the queries at those positions are computed, attending to the keys / values of all positions
+        # done in the last self attention layer when only some of the outputs are needed
+
+        if exists(query_positions):
+            assert not exists(attn_mask), 'query positions cannot be combined with an explicit attention mask'
+
+            x = gather_positions(x, query_positions)
+            prev_attn = maybe(gather_positions)(prev_attn, query_positions)
+
         q_input = x
         k_input = kv_input
         v_input = kv_input
@@ -831,23 +1050,39 @@ class Attention(nn.Module):
             v_input, _ = pack([mem, v_input], 'b * d')
 
         q = self.to_q(q_input)
-        k = self.to_k(k_input)
-        v = self.to_v(v_input) if exists(self.to_v) else k
         r = self.to_r(r_input) if exists(self.to_r) else None
 
         q = rearrange(q, 'b n (h d) -> b h n d', h = h)
+        r = maybe(rearrange)(r, 'b n (h d) -> b h n d', h = kv_h)
 
-        k, v, r = map(lambda t: maybe(rearrange)(t, 'b n (h d) -> b h n d', h = kv_h), (k, v, r))
+        # the context does not change while decoding, so its keys / values are projected on the first step, and taken from the cache after
 
-        if exists(cache) and not has_context:
-            ck, cv = cache.cached_kv
+        if exists(cache) and has_context and exists(cache.cached_kv):
+            k, v = cache.cached_kv
+        else:
+            k = self.to_k(k_input)
+            v = self.to_v(v_input) if exists(self.to_v) else k
+
+            k, v = map(lambda t: rearrange(t, 'b n (h d) -> b h n d', h = kv_h), (k, v))
+
+        is_static_cache = exists(cache) and not has_context and isinstance(cache.cached_kv, StaticKVCache)
+        is_paged_cache = exists(cache) and not has_context and isinstance(cache.cached_kv, PagedKVCache)
+        is_streaming_cache = exists(cache) and not has_context and isinstance(cache.cached_kv, StreamingKVCache)
+        is_inplace_cache = is_static_cache or is_paged_cache or is_streaming_cache
 
+        if exists(cache) and not has_context:
             if exists(mem):
                 mk, k = unpack(k, mem_packed_shape, 'b h * d')
                 mv, v = unpack(v, mem_packed_shape, 'b h * d')
 
-            k = torch.cat((ck, k), dim = -2)
-            v = torch.cat((cv, v), dim = -2)
+            # a static, paged or streaming cache is written to in place, rather than grown by concatenation
+
+            if is_inplace_cache:
+                k, v = cache.cached_kv.append(k, v)
+            else:
+                ck, cv = cache.cached_kv
+                k = torch.cat((ck, k), dim = -2)
+                v = torch.cat((cv, v), dim = -2)
 
             if exists(mem):
                 k = torch.cat((mk, k), dim = -2)
@@ -855,7 +1090,7 @@ class Attention(nn.Module):
 
         if return_intermediates:
             mem_len = mem.shape[-2] if exists(mem) else 0
-            cached_kv = (k[..., mem_len:, :], v[..., mem_len:, :])
+            cached_kv = (k[..., mem_len:, :], v[..., mem_len:, :]) if not is_inplace_cache else cache.cached_kv
 
         if self.qk_norm:
             qk_l2norm = partial(l2norm, groups = self.qk_norm_groups)
@@ -866,29 +1101,28 @@ class Attention(nn.Module):
             k = k * self.qk_norm_k_scale
 
         if exists(rotary_pos_emb) and not has_context:
-            freqs, xpos_scale = rotary_pos_emb
-            q_xpos_scale, k_xpos_scale = (xpos_scale, xpos_scale ** -1.) if exists(xpos_scale) else (1., 1.)
+            q_cos, q_sin, k_cos, k_sin = rotary_pos_emb
 
-            q = apply_rotary_pos_emb(q, freqs, q_xpos_scale)
-            k = apply_rotary_pos_emb(k, freqs, k_xpos_scale)
+            # sequences in a paged cache are of different lengths, so each row of queries is at its own positions
 
-            if self.rotary_embed_values:
-                v = apply_rotary_pos_emb(v, freqs, k_xpos_scale)
+            if is_paged_cache:
+                paged_positions = cache.cached_kv.query_positions
+                q_cos, q_sin = q_cos[paged_positions], q_sin[paged_positions]
 
-        input_mask = context_mask
+            if exists(query_positions):
+                q_cos, q_sin = map(lambda t: t[..., -n:, :], (q_cos, q_sin))
+                q_cos, q_sin = map(lambda t: t[query_positions] if t.ndim == 2 else gather_positions(t, query_positions), (q_cos, q_sin))
 
-        if not exists(input_mask) and not has_context:
-            input_mask = mask
+            q = apply_rotary_cos_sin(q, q_cos, q_sin)
+            k = apply_rotary_cos_sin(k, k_cos, k_sin)
 
-            if (exists(input_mask) or exists(mem_mask)) and exists(mem):
-                seq_len, mem_len = n, mem.shape[-2]
+            if self.rotary_embed_values:
+                v = apply_rotary_cos_sin(v, k_cos, k_sin)
 
-                if not exists(mem_mask):
-                    input_mask = pad_at_dim(input_mask, (mem_len, 0), dim = -1, value = True)
-                elif not exists(input_mask):
-                    input_mask = pad_at_dim(mem_mask, (0, seq_len), dim = -1, value = True)
-                else:
-                    input_mask = torch.cat((mem_mask, input_mask), dim = -1)
+        # a streaming cache evicts once the keys are embedded, as its policy may rank them by the attention they receive
+
+        if is_streaming_cache:
+            cache.cached_kv.evict(q = q, k = k, scale = self.attend.scale)
 
         if self.num_mem_kv > 0:
             mem_k, mem_v = map(lambda t: repeat(t, 'h n d -> b h n d', b = b), (self.mem_k, self.mem_v))
@@ -900,44 +1134,57 @@ class Attention(nn.Module):
             k = torch.cat((mem_k, k), dim = -2)
             v = torch.cat((mem_v, v), dim = -2)
 
-            if exists(input_mask):
-                input_mask = pad_at_dim(input_mask, (self.num_mem_kv, 0), dim = -1, value = True)
-
         i, j = map(lambda t: t.shape[-2], (q, k))
 
         # determine masking
+        # the mask is the same for every layer with the same attention shape and memories, so AttentionLayers passes in a cache to build it once per forward
 
-        mask_value = max_neg_value(q)
-        masks = []
-        final_attn_mask = None
+        # when only some queries are computed, the mask is built for their positions among the keys - which with a paged cache are per row
 
-        if exists(input_mask):
-            input_mask = rearrange(input_mask, 'b j -> b 1 1 j')
-            masks.append(~input_mask)
+        if exists(query_positions):
+            query_key_positions = query_positions + (j - n) if not is_paged_cache else (cache.cached_kv.query_positions + self.num_mem_kv).gather(-1, query_positions)
+            final_attn_mask = self.build_attn_mask(i, j, n, mask = mask, context_mask = context_mask, mem = mem, mem_mask = mem_mask, has_context = has_context, query_positions = query_key_positions, device = device)
+        else:
+            final_attn_mask = cache_mask(
+                mask_cache,
+                ('attn', has_context, i, j, mem.shape[-2] if exists(mem) else 0, self.num_mem_kv, self.max_attend_past),
+                partial(self.build_attn_mask, i, j, n, mask = mask, context_mask = context_mask, attn_mask = attn_mask, mem = mem, mem_mask = mem_mask, has_context = has_context, device = device),
+                anchor = mem_mask
+            )
 
-        if exists(attn_mask):
-            assert 2 <= attn_mask.ndim <= 4, 'attention mask must have greater than 2 dimensions but less than or equal to 4'
-            if attn_mask.ndim == 2:
-                attn_mask = rearrange(attn_mask, 'i j -> i 1 j 1')
-            elif attn_mask.ndim == 3:
-                attn_mask = rearrange(attn_mask, 'h i j -> 1 h i j')
-            masks.append(~attn_mask)
+        # prepare relative positional bias, if needed
+        # it only depends on the attention shape and is shared by all layers, so is computed once per forward when a cache is passed in
 
-        if exists(self.max_attend_past):
-            range_q = torch.arange(j - i, j, device = device)
-            range_k = torch.arange(j, device = device)
-            dist = rearrange(range_q, 'i -> 1 1 i 1') - rearrange(range_k, 'j -> 1 1 1 j')
-            max_attend_past_mask = dist > self.max_attend_past
-            masks.append(max_attend_past_mask)
+        # paged caches are right padded, and the new tokens of each sequence start at its own length
 
-        if len(masks) > 0:
-            final_attn_mask = ~or_reduce(masks)
+        if is_paged_cache:
+            paged_attn_mask = cache_mask(
+                mask_cache,
+                ('paged', self.num_mem_kv),
+                lambda: pad_at_dim(cache.cached_kv.attn_mask, (self.num_mem_kv, 0), dim = -1, value = True),
+                anchor = cache.cached_kv.attn_mask
+            )
 
-        # prepare relative positional bias, if needed
+            if exists(query_positions):
+                paged_attn_mask = gather_positions(paged_attn_mask, query_positions)
+
+            final_attn_mask = paged_attn_mask if not exists(final_attn_mask) else (final_attn_mask & paged_attn_mask)
 
         attn_bias = None
-        if exists(rel_pos):
-            attn_bias = rel_pos(i, j)
+        if exists(rel_pos) and exists(query_positions):
+            attn_bias = rearrange(rel_pos(i, j, query_positions = query_key_positions), 'h b i j -> b h i j')
+
+        elif exists(rel_pos) and not is_paged_cache:
+            attn_bias = cache_mask(mask_cache, ('rel_pos', i, j), partial(rel_pos, i, j))
+
+        elif exists(rel_pos):
+            # with a paged cache, the bias of each row of queries is computed at its own positions
+
+            def paged_rel_pos():
+                query_positions = cache.cached_kv.query_positions + self.num_mem_kv
+                return rearrange(rel_pos(i, j, query_positions = query_positions), 'h b i j -> b h i j')
+
+            attn_bias = cache_mask(mask_cache, ('paged_rel_pos', j), paged_rel_pos, anchor = cache.cached_kv.query_positions)
 
         # attention is all we need
 
@@ -945,7 +1192,9 @@ class Attention(nn.Module):
             q, k, v,
             mask = final_attn_mask,
             attn_bias = attn_bias,
-            prev_attn = prev_attn
+            prev_attn = prev_attn,
+            capture = capture,
+            mask_cache = mask_cache
         )
 
         # https://arxiv.org/abs/2208.06061 proposes to add a residual for better gradients
@@ -979,6 +1228,9 @@ class Attention(nn.Module):
         out = self.to_out(out)
 
         if exists(mask):
+            if exists(query_positions):
+                mask = gather_positions(mask, query_positions, dim = -1)
+
             mask = rearrange(mask, 'b n -> b n 1')
             out = out.masked_fill(~mask, 0.)
 
@@ -1096,6 +1348,7 @@ class AttentionLayers(nn.Module):
         self.residual_attn = residual_attn
         self.cross_residual_attn = cross_residual_attn
         assert not (flash_attn and (residual_attn or cross_residual_attn)), 'flash attention is not compatible with residual attention'
+        assert not (attn_kwargs.get('chunked', False) and (residual_attn or cross_residual_attn)), 'chunked attention is not compatible with residual attention'
 
         self.cross_attend = cross_attend
 
@@ -1176,6 +1429,7 @@ class AttentionLayers(nn.Module):
         # calculate token shifting
 
         shift_tokens = cast_tuple(shift_tokens, len(layer_types))
+        self.has_shift_tokens = any(layer_shift_tokens > 0 for layer_shift_tokens in shift_tokens)
 
         # whether it has post norm
 
@@ -1220,6 +1474,26 @@ class AttentionLayers(nn.Module):
                 residual
             ]))
 
+    def get_cache_self_attn(self):
+        # whether each entry of the cache, in order, is of a self attention layer - cross attention layers cache the keys / values of the context instead
+
+        executed_layer_types = [self.layer_types[i] for i in self.layers_execute_order]
+        return [layer_type == 'a' for layer_type in executed_layer_types if layer_type in ('a', 'c')]
+
+    def init_cache(self, make_cached_kv: Callable):
+        # an empty cache to decode from, with the cache made by make_cached_kv for every self attention layer, filled in on the first forward
+
+        return LayerIntermediates(attn_intermediates = [Intermediates(cached_kv = make_cached_kv() if is_self_attn else None) for is_self_attn in self.get_cache_self_attn()])
+
+    def get_cached_seq_len(self, cache: LayerIntermediates):
+        # length of the cached self attention keys
+
+        for is_self_attn, inter in zip(self.get_cache_self_attn(), cache.attn_intermediates):
+            if is_self_attn:
+                return inter.cached_kv.seq_len if isinstance(inter.cached_kv, (StaticKVCache, PagedKVCache, StreamingKVCache)) else inter.cached_kv[0].shape[-2]
+
+        return 0
+
     def forward(
         self,
         x,
@@ -1234,7 +1508,9 @@ class AttentionLayers(nn.Module):
         cache: Optional[LayerIntermediates] = None,
         cache_age = 1,
         return_hiddens = False,
-        rotary_pos_emb = None
+        rotary_pos_emb = None,
+        capture = 'full',
+        output_positions: Optional[Tensor] = None
     ):
         assert not (self.cross_attend ^ exists(context)), 'context must be passed in if cross_attend is set to True'
 
@@ -1247,13 +1523,32 @@ class AttentionLayers(nn.Module):
         prev_attn = None
         prev_cross_attn = None
 
+        # what to keep from each layer - residual attention always needs the pre-softmax attention of the previous layer
+
+        capture = capture if return_hiddens else 'none'
+
+        capture_hiddens = capture_at_least(capture, 'mems')
+        capture_layer_hiddens = capture_at_least(capture, 'full')
+        capture_intermediates = capture_at_least(capture, 'kv_only')
+
+        self_attn_capture = 'z_loss' if self.residual_attn and not capture_at_least(capture, 'z_loss') else capture
+        cross_attn_capture = 'z_loss' if self.cross_residual_attn and not capture_at_least(capture, 'z_loss') else capture
+
         mems = mems.copy() if exists(mems) else [None] * self.num_attn_layers
         mem_masks = mem_masks.copy() if exists(mem_masks) else [None] * self.num_attn_layers
 
+        # when decoding with a cache, the caller may pass in only the new tokens (as the multi-IO wrapper does between its stacks)
+        # positions and the left padding mask then need to span the cached keys as well
+
+        seq_len = x.shape[-2]
+
+        if exists(cache) and cache_age > 0:
+            seq_len = self.get_cached_seq_len(cache) + min(cache_age, seq_len)
+
         # handle left padded sequences
 
         if exists(seq_start_pos):
-            seq_arange = torch.arange(x.shape[-2], device = x.device, dtype = torch.long)
+            seq_arange = torch.arange(seq_len, device = x.device, dtype = torch.long)
             left_pad_mask = seq_arange >= seq_start_pos[..., None]
 
             if exists(self_attn_kv_mask):
@@ -1264,13 +1559,15 @@ class AttentionLayers(nn.Module):
         # rotary positions
 
         if not exists(rotary_pos_emb) and exists(self.rotary_pos_emb):
-            max_rotary_emb_length = max(list(map(lambda m: (m.shape[1] if exists(m) else 0) + x.shape[1], mems)))
+            max_rotary_emb_length = max(list(map(lambda m: (m.shape[1] if exists(m) else 0) + seq_len, mems)))
 
             maybe_mem = mems[0] # todo - handle edge case where different layers get different memory lengths. don't think this will ever come up but who knows
             mem_len = maybe_mem.shape[1] if exists(maybe_mem) else 0
 
-            pos = torch.arange(x.shape[1] + mem_len, device = x.device) - mem_len
-            rotary_pos_emb = self.rotary_pos_emb(pos)
+            rotary_pos_emb = self.rotary_pos_emb.forward_cos_sin(-mem_len, seq_len)
+
+        elif exists(rotary_pos_emb) and len(rotary_pos_emb) == 2:
+            rotary_pos_emb = rotary_freqs_to_cos_sin(*rotary_pos_emb)
 
         # assume cached key / values
 
@@ -1286,9 +1583,9 @@ class AttentionLayers(nn.Module):
 
         iter_attn_cache = iter(attn_cache)
 
-        # outer residual - for resiDual paper
+        # masks are the same across layers, so are built once per distinct attention shape and shared
 
-        outer_residual = x * self.resi_dual_scale
+        mask_cache = dict()
 
         # get layers to be executed
 
@@ -1300,16 +1597,50 @@ class AttentionLayers(nn.Module):
 
         layer_variables = tuple(tuple(layer_variable[i] for i in self.layers_execute_order) for layer_variable in layer_variables)
 
+        # with output positions, of shape (k,) or (b, k) and in increasing order, only those positions are output
+        # the last self attention layer computes the queries at those positions only, and the layers after it only see those positions
+        # token shifting mixes in the neighbouring positions, so with it every position is computed, and the output positions are taken at the end
+
+        output_layer_index = None
+        gather_output_positions_last = False
+
+        if exists(output_positions):
+            if output_positions.ndim == 1:
+                output_positions = repeat(output_positions, 'k -> b k', b = x.shape[0])
+
+            output_positions = output_positions % x.shape[-2]
+
+            self_attn_indices = [ind for ind, layer_type in enumerate(layer_variables[0]) if layer_type == 'a']
+            output_layer_index = self_attn_indices[-1] if len(self_attn_indices) > 0 else None
+
+            if self.has_shift_tokens:
+                output_layer_index = None
+                gather_output_positions_last = True
+
+            elif not exists(output_layer_index):
+                x = gather_positions(x, output_positions)
+                mask = maybe(gather_positions)(mask, output_positions, dim = -1)
+
+        # outer residual - for resiDual paper
+
+        outer_residual = x * self.resi_dual_scale
+
         # go through the attention and feedforward layers
 
         for ind, (layer_type, (norm, block, residual_fn), layer_dropout) in enumerate(zip(*layer_variables)):
             is_last = ind == (len(self.layers) - 1)
+            is_output_layer = exists(output_layer_index) and ind == output_layer_index
 
             if self.training and layer_dropout > 0. and random() < layer_dropout:
+                if is_output_layer:
+                    x, outer_residual = map(lambda t: gather_positions(t, output_positions), (x, outer_residual))
+                    mask = maybe(gather_positions)(mask, output_positions, dim = -1)
+                    prev_cross_attn = maybe(gather_positions)(prev_cross_attn, output_positions)
+
                 continue
 
             if layer_type == 'a':
-                if return_hiddens:
+                if capture_hiddens:
                     hiddens.append(x)
 
                 layer_mem = mems.pop(0) if mems else None
@@ -1321,7 +1652,7 @@ class AttentionLayers(nn.Module):
 
             inner_residual = x
 
-            if return_hiddens:
+            if capture_layer_hiddens:
                 layer_hiddens.append(x)
 
             pre_norm, post_branch_norm, post_main_norm = norm
@@ -1333,12 +1664,17 @@ class AttentionLayers(nn.Module):
                     layer_mem = pre_norm(layer_mem)
 
             if layer_type == 'a':
-                out, inter = block(x, mask = mask, context_mask = self_attn_kv_mask, attn_mask = attn_mask, rel_pos = self.rel_pos, rotary_pos_emb = rotary_pos_emb, prev_attn = prev_attn, cache = next(iter_attn_cache, None), mem = layer_mem, mem_mask = layer_mem_mask, return_intermediates = True)
+                out, inter = block(x, mask = mask, context_mask = self_attn_kv_mask, attn_mask = attn_mask, rel_pos = self.rel_pos, rotary_pos_emb = rotary_pos_emb, prev_attn = prev_attn, cache = next(iter_attn_cache, None), mem = layer_mem, mem_mask = layer_mem_mask, return_intermediates = True, capture = self_attn_capture, mask_cache = mask_cache, query_positions = output_positions if is_output_layer else None)
             elif layer_type == 'c':
-                out, inter = block(x, context = context, mask = mask, context_mask = context_mask, prev_attn = prev_cross_attn, cache = next(iter_attn_cache, None), return_intermediates = True)
+                out, inter = block(x, context = context, mask = mask, context_mask = context_mask, prev_attn = prev_cross_attn, cache = next(iter_attn_cache, None), return_intermediates = True, capture = cross_attn_capture, mask_cache = mask_cache)
             elif layer_type == 'f':
                 out = block(x)
 
+            if is_output_layer:
+                inner_residual, outer_residual = map(lambda t: gather_positions(t, output_positions), (inner_residual, outer_residual))
+                mask = maybe(gather_positions)(mask, output_positions, dim = -1)
+                prev_cross_attn = maybe(gather_positions)(prev_cross_attn, output_positions)
+
             if self.resi_dual:
                 outer_residual = outer_residual + out * self.resi_dual_scale
 
@@ -1347,7 +1683,7 @@ class AttentionLayers(nn.Module):
 
             x = residual_fn(out, inner_residual)
 
-            if layer_type in ('a', 'c') and return_hiddens:
+            if layer_type in ('a', 'c') and capture_intermediates:
                 intermediates.append(inter)
 
             if layer_type == 'a' and self.residual_attn:
@@ -1358,7 +1694,7 @@ class AttentionLayers(nn.Module):
             if exists(post_main_norm):
                 x = post_main_norm(x)
 
-        if return_hiddens:
+        if capture_layer_hiddens:
             layer_hiddens.append(x)
 
         if self.resi_dual:
@@ -1366,6 +1702,9 @@ class AttentionLayers(nn.Module):
         else:
             x = self.final_norm(x)
 
+        if gather_output_positions_last:
+            x = gather_positions(x, output_positions)
+
         if not return_hiddens:
             return x
 
@@ -1573,9 +1912,24 @@ class TransformerWrapper(nn.Module):
         self.memory_tokens_interspersed_every = memory_tokens_interspersed_every
 
         # whether can do cached kv decoding
+        # token shifting mixes in the previous positions, which a cached forward over the new tokens alone does not have
+        # memory tokens are cached along with the tokens. interspersed ones are laid out from the first token of the window, so once the window slides
+        # over the max sequence length every position moves, and the cache cannot slide along with it
 
-        self.can_cache_kv = self.num_memory_tokens == 0
+        self.can_cache_kv = not attn_layers.has_shift_tokens
         self.can_cache_kv_outside_max_seq_len = no_abs_pos_emb
+        self.can_slide_cache_kv = not (self.num_memory_tokens > 0 and exists(memory_tokens_interspersed_every))
+
+    def num_positions(self, num_tokens):
+        # number of positions the attention layers see for the given number of tokens, with the memory tokens - leading ones, or ones starting every segment
+
+        if self.num_memory_tokens == 0 or num_tokens == 0:
+            return num_tokens
+
+        mem_every = self.memory_tokens_interspersed_every
+        num_segments = math.ceil(num_tokens / mem_every) if exists(mem_every) else 1
+
+        return num_tokens + num_segments * self.num_memory_tokens
 
     def init_(self):
         if self.l2norm_embed:
@@ -1606,11 +1960,24 @@ class TransformerWrapper(nn.Module):
         attn_z_loss_weight = 1e-4,
         seq_start_pos = None,
         cache: Optional[LayerIntermediates] = None,
+        capture = None,
+        output_positions: Optional[Union[int, Tensor]] = None,
         **kwargs
     ):
         b, n, device, num_mems, has_memory_tokens, emb_frac_gradient = x.shape[0], x.shape[1], x.device, self.num_memory_tokens, self.num_memory_tokens > 0, self.emb_frac_gradient
         return_hiddens = return_mems | return_attn | return_intermediates | return_attn_z_loss
 
+        # output positions, an index or indices of shape (k,) or (b, k) in increasing order, restrict the logits (or embeddings) to those positions of the output
+        # the last self attention layer then only computes the queries at those positions, and the logits are projected for those alone
+        # -1 gives the last position only, all that is needed to sample the next token
+
+        if isinstance(output_positions, int):
+            output_positions = torch.tensor([output_positions], device = device)
+
+        # only capture the intermediates needed for what is returned, unless a capture policy is given
+
+        capture = get_capture_policy(capture, return_intermediates, return_attn, return_attn_z_loss, return_mems)
+
         # absolute positional embedding
 
         external_pos_emb = exists(pos) and pos.dtype != torch.long
@@ -1686,13 +2053,56 @@ class TransformerWrapper(nn.Module):
             if exists(mem_every):
                 x = rearrange(x, '(b n) m d -> b (n m) d', b = b)
 
+            # when decoding with a cache, the padding of the last segment is left out, so the cache only holds tokens and memory tokens
+            # and the positions new to the cache are the new tokens, along with the memory tokens of the segments they start
+
+            if exists(cache):
+                num_positions = self.num_positions(n)
+                x = x[:, :num_positions]
+
+                cache_age = kwargs.get('cache_age', 1)
+                num_new = min(cache_age, n) if cache_age > 0 else n
+                num_new_positions = num_positions - self.num_positions(n - num_new)
+
+                kwargs.update(cache_age = num_new_positions)
+
+            # positions of the tokens among the positions out of the attention layers, which with a cache are only the new ones
+            # the output positions are given over the tokens, and are moved over to those positions
+
+            if exists(cache) or exists(output_positions):
+                num_tokens = n if exists(mem_every) else (x.shape[-2] - num_mems)
+
+                token_positions = torch.arange(num_tokens, device = device)
+                token_positions = token_positions + ((token_positions // mem_every) if exists(mem_every) else 0) * num_mems + num_mems
+
+                if exists(cache):
+                    first_new_position = num_positions - num_new_positions
+                    token_positions = token_positions[token_positions >= first_new_position] - first_new_position
+
+                if exists(output_positions):
+                    output_positions = token_positions[output_positions]
+
         if self.shift_mem_down and exists(mems):
             mems_l, mems_r = mems[:self.shift_mem_down], mems[self.shift_mem_down:]
             mems = [*mems_r, *mems_l]
 
-        x, intermediates = self.attn_layers(x, mask = mask, mems = mems, mem_masks = mem_masks, cache = cache, return_hiddens = True, seq_start_pos = seq_start_pos, **kwargs)
+        x, intermediates = self.attn_layers(x, mask = mask, mems = mems, mem_masks = mem_masks, cache = cache, return_hiddens = True, seq_start_pos = seq_start_pos, capture = capture, output_positions = output_positions, **kwargs)
 
-        if has_memory_tokens:
+        if has_memory_tokens and exists(mem_every) and not exists(cache):
+            # the cached key / values leave out the padding of the last segment, same as when decoding with a cache
+
+            for inter in intermediates.attn_intermediates:
+                if exists(inter.cached_kv):
+                    inter.cached_kv = [t[..., :self.num_positions(n), :] for t in inter.cached_kv]
+
+        # with output positions, only the tokens at those positions come out of the attention layers
+
+        if has_memory_tokens and exists(cache) and not exists(output_positions):
+            # only the new positions come out of the attention layers, of which the tokens are kept
+
+            x = x[:, token_positions]
+
+        elif has_memory_tokens and not exists(output_positions):
             if exists(mem_every):
                 x = rearrange(x, 'b (n m) d -> (b n) m d', m = (mem_every + num_mems))
 
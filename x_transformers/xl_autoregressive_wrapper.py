@@ -1,11 +1,14 @@
 from math import ceil
+from typing import Optional
 
 import torch
 from torch import nn, Tensor
 import torch.nn.functional as F
 
 from einops import rearrange, pack, unpack
-from x_transformers.autoregressive_wrapper import top_p, top_k, eval_decorator
+from x_transformers.autoregressive_wrapper import top_p, top_k, eval_decorator, select_rows, map_batch_kwargs, compact_finished_rows
+from x_transformers.sampling import Sampler
+from x_transformers.kv_cache import reorder_cached_kv
 
 
 # helper functions
@@ -49,6 +52,8 @@ class XLAutoregressiveWrapper(nn.Module):
             filter_thres=0.9,
             mems=None,
             filter_kwargs: dict = dict(),
+            compact_every=None,
+            sampler: Optional[Sampler] = None,
             **kwargs
     ):
         device, greedy, max_seq_len = prompts.device, temperature == 0., self.max_seq_len
@@ -77,7 +82,15 @@ class XLAutoregressiveWrapper(nn.Module):
         cache = None
         out = prompts
 
-        for _ in range(seq_len):
+        # with compact_every, every that many steps the rows that reached eos are moved into the results and dropped from the batch decoded
+
+        compact = exists(compact_every) and exists(eos_token)
+
+        if compact:
+            batch_indices = torch.arange(b, device=device)
+            results = torch.full((b, t + seq_len), self.pad_value, device=device, dtype=out.dtype)
+
+        for step in range(seq_len):
             curr_segment_len = out.shape[-1]
             is_last_segment_tokens = divisible_by(curr_segment_len, max_seq_len)
 
@@ -89,13 +102,17 @@ class XLAutoregressiveWrapper(nn.Module):
                 cache=cache,
                 return_mems=True,
                 return_intermediates=True,
+                capture='mems',
+                output_positions=-1,
                 **kwargs
             )
 
             mems = cache.mems
 
             logits = logits[:, -1]
-            if greedy:
+            if exists(sampler):
+                sample = rearrange(sampler(logits), 'b -> b 1')
+            elif greedy:
                 sample = logits.argmax(dim=-1, keepdim=True)
             else:
                 filtered_logits_i = filter_logits_fn(logits, **filter_kwargs)
@@ -107,14 +124,36 @@ class XLAutoregressiveWrapper(nn.Module):
                 curr_mems = mems
 
             out = torch.cat((out, sample), dim=-1)
-            if exists(eos_token):
-                is_eos_tokens = (out == eos_token)
-                if is_eos_tokens.any(dim=-1).all():
-                    # mask out everything after the eos tokens
-                    shifted_is_eos_tokens = F.pad(is_eos_tokens, (1, -1))
-                    mask = shifted_is_eos_tokens.float().cumsum(dim=-1) >= 1
-                    out = torch.where(mask.unsqueeze(-1), self.pad_value, out)
-                    break
+
+            if not exists(eos_token):
+                continue
+
+            is_done = (out == eos_token).any(dim=-1)
+
+            if is_done.all():
+                break
+
+            # drop the finished rows from the output, the cache and both memories
+
+            if compact and ((step + 1) % compact_every) == 0 and is_done.any():
+                keep, batch_indices = compact_finished_rows(out, is_done, batch_indices, results)
+
+                out = out[keep]
+                mems, curr_mems = select_rows(mems, keep), select_rows(curr_mems, keep)
+                sampler = select_rows(sampler, keep)
+                kwargs = map_batch_kwargs(kwargs, len(is_done), lambda t: t[keep])
+                reorder_cached_kv(cache, keep)
+
+        if compact:
+            results[batch_indices, :out.shape[1]] = out
+            out = results[:, :out.shape[1]]
+
+        if exists(eos_token):
+            # mask out everything after the eos tokens
+            is_eos_tokens = (out == eos_token)
+            shifted_is_eos_tokens = F.pad(is_eos_tokens, (1, -1))
+            mask = shifted_is_eos_tokens.float().cumsum(dim=-1) >= 1
+            out = out.masked_fill(mask, self.pad_value)
 
         out = out[:, t:]
 
@@ -8,7 +8,7 @@ import torch
 from torch import nn, Tensor
 import torch.nn.functional as F
 
-from typing import Callable
+from typing import Callable, Optional
 from collections import namedtuple
 
 from einops import rearrange
@@ -26,6 +26,8 @@ from x_transformers.autoregressive_wrapper import (
     top_p
 )
 
+from x_transformers.sampling import Sampler
+
 # constants
 
 LossBreakdown = namedtuple('LossBreakdown', ['cross_entropy_loss', 'numerical_mse_loss'])
@@ -208,6 +210,7 @@ class XValAutoregressiveWrapper(nn.Module):
         filter_logits_fn: Callable = top_k,
         filter_kwargs: dict = dict(),
         temperature = 1.,
+        sampler: Optional[Sampler] = None,
         **kwargs
     ):
         device = start_tokens.device
@@ -232,11 +235,14 @@ class XValAutoregressiveWrapper(nn.Module):
             last_logits = logits[:, -1]
             last_num_pred = numerical_pred[:, -1:]
 
-            filtered_logits = filter_logits_fn(last_logits, **filter_kwargs)
+            if exists(sampler):
+                sample = rearrange(sampler(last_logits), 'b -> b 1')
+            else:
+                filtered_logits = filter_logits_fn(last_logits, **filter_kwargs)
 
-            probs = F.softmax(filtered_logits / temperature, dim=-1)
+                probs = F.softmax(filtered_logits / temperature, dim=-1)
 
-            sample = torch.multinomial(probs, 1)
+                sample = torch.multinomial(probs, 1)
 
             out = torch.cat((out, sample), dim = -1)
             num_out = torch.cat((num_out, last_num_pred), dim = -1)